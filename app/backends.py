@@ -0,0 +1,153 @@
+import os
+import zlib
+
+from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient, DEFAULT_CONNECTION_LIMITS
+from openai.types.chat import ChatCompletion, ChatCompletionChunk
+
+from canned_replies import canned_response, completion_body, completion_chunks, estimate_prompt_tokens, request_prompt_text
+from model_interaction import self_consistency_samples
+
+
+# Limits of the HTTP library the installed openai package is built on
+ConnectionLimits = type(DEFAULT_CONNECTION_LIMITS)
+
+
+class OpenAIBackend:
+    '''sends chat completions requests to the OpenAI API or, with
+    model.base_url, any OpenAI-compatible server (vLLM, llama.cpp, a local
+    mock). sync and async requests each go through one pooled HTTP client
+    that keeps its connections alive between requests. the async client is
+    created inside the event loop that uses it and closed with aclose when
+    that loop is done'''
+
+    name = 'openai'
+
+    def __init__(self, api_key, base_url=None, max_retries=2, limits=None):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_retries = max_retries
+        self.limits = limits or DEFAULT_CONNECTION_LIMITS
+        self.client = OpenAI(api_key=api_key, base_url=base_url, max_retries=max_retries,
+                             http_client=DefaultHttpxClient(limits=self.limits))
+        self.async_client = None
+
+    def create(self, **params):
+        return self.client.chat.completions.create(**params)
+
+    async def create_async(self, **params):
+        if self.async_client is None:
+            self.async_client = AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=self.max_retries,
+                                            http_client=DefaultAsyncHttpxClient(limits=self.limits))
+        return await self.async_client.chat.completions.create(**params)
+
+    async def aclose(self):
+        if self.async_client is not None:
+            await self.async_client.close()
+            self.async_client = None
+
+    def close(self):
+        self.client.close()
+
+
+class _LocalStream:
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+    def close(self):
+        pass
+
+
+class _AsyncLocalStream(_LocalStream):
+    async def close(self):
+        pass
+
+
+class LocalBackend:
+    '''answers requests in-process with the canned replies the mock server
+    also sends, so a run goes through the whole pipeline (prompts, parsing,
+    streaming, self-consistency, result files) without any network call. the same
+    request always gets the same reply; with a temperature above 0 the
+    extra samples of an n > 1 request vary deterministically'''
+
+    name = 'local'
+
+    def _answer(self, prompt_text, sample, temperature):
+        '''the option a choice answers, None for the prompt-derived answer'''
+        if not temperature or sample == 0:
+            return None
+        draw = zlib.crc32(f"{sample}:{prompt_text}".encode('utf-8'))
+        return None if draw % 10 < 6 else draw // 10 % 4 + 1
+
+    def _complete(self, params, stream_class):
+        prompt_text = request_prompt_text(params)
+        prompt_tokens = estimate_prompt_tokens(prompt_text)
+        contents = [canned_response(prompt_text, self._answer(prompt_text, sample, params.get('temperature')))
+                    for sample in range(int(params.get('n') or 1))]
+        if params.get('stream'):
+            chunks = completion_chunks(params, contents[0], prompt_text, prompt_tokens)
+            return stream_class([ChatCompletionChunk.model_validate(chunk) for chunk in chunks])
+        return ChatCompletion.model_validate(completion_body(params, contents, prompt_text, prompt_tokens))
+
+    def create(self, **params):
+        return self._complete(params, _LocalStream)
+
+    async def create_async(self, **params):
+        return self._complete(params, _AsyncLocalStream)
+
+    async def aclose(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def connection_limits(current_config, max_concurrency=1):
+    '''pool limits of the HTTP clients. enough connections are kept alive
+    for every request that can be in flight (max_concurrency times the
+    self-consistency samples), and idle ones are kept for
+    model.keepalive_expiry seconds (default 30) so they survive rate limit
+    waits and the gaps between the runs of a sweep'''
+    model_config = current_config.get('model', {})
+    in_flight = max(1, max_concurrency) * self_consistency_samples(current_config)
+    max_keepalive = model_config.get('max_keepalive_connections', max(DEFAULT_CONNECTION_LIMITS.max_keepalive_connections, in_flight))
+    return ConnectionLimits(
+        max_connections=model_config.get('max_connections', max(DEFAULT_CONNECTION_LIMITS.max_connections, max_keepalive)),
+        max_keepalive_connections=max_keepalive,
+        keepalive_expiry=model_config.get('keepalive_expiry', 30.0)
+    )
+
+
+def create_backend(current_config, max_concurrency=1, replay=False):
+    '''creates the backend named by model.provider: openai (the default) for
+    the OpenAI API or any OpenAI-compatible server at model.base_url, or
+    local for the deterministic in-process backend. the API key is read
+    from the environment variable named by model.api_key_env (default
+    OPENAI_API_KEY); it may be left unset in replay mode, where nothing is
+    sent, and for a server at model.base_url. when a rate_limit section is
+    configured the retries are left to the RateLimiter instead of the
+    client's own retry loop'''
+    model_config = current_config.get('model', {})
+    provider = (model_config.get('provider') or 'openai').lower()
+    if provider == 'local':
+        return LocalBackend()
+    if provider not in ('openai', 'openai_compatible'):
+        raise ValueError(f"Unknown model.provider '{provider}', expected openai, openai_compatible or local.")
+
+    api_key_env = model_config.get('api_key_env', 'OPENAI_API_KEY')
+    base_url = model_config.get('base_url')
+    api_key = os.environ.get(api_key_env)
+    if not api_key and replay:
+        api_key = "replay-mode"
+    elif not api_key and base_url:
+        api_key = "not-needed"
+    if not api_key:
+        raise ValueError(f"The environment variable {api_key_env} is not set.")
+    client_max_retries = 0 if current_config.get('rate_limit') else 2
+    return OpenAIBackend(api_key, base_url, client_max_retries, connection_limits(current_config, max_concurrency))
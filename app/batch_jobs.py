@@ -0,0 +1,220 @@
+import json
+import os
+import time
+
+from tqdm import tqdm
+
+from dataset_index import load_index
+from evaluation_processor import iter_dialog_tasks, build_results, count_tasks
+from model_interaction import build_api_params, unpack_completion
+from response_cache import ResponseCache
+from result_writer import open_result_writer
+from sharding import parse_shard, shard_suffix
+from sweep_runner import expand_sweep
+from task_journal import TaskJournal
+
+
+BATCH_URL = '/v1/chat/completions'
+MANIFEST_NAME = 'batch_manifest.json'
+
+
+def iter_runs(config, args):
+    '''yields (base_prefix, run_config, dataset, positions) for every run
+    of the config: the run itself, or every combination of a sweep section.
+    the prefixes are the ones a normal run would write to, positions are
+    the dialogs of args.shard (None for all)'''
+    shard = parse_shard(args.shard) if args.shard else None
+    for base_prefix, run_config in expand_sweep(config):
+        try:
+            dataset = load_index(run_config['data']['path'], config.get('data', {}).get('index_dir'))
+        except SystemExit:
+            print(f"Skipping {base_prefix}: data file could not be loaded.")
+            continue
+        positions = None
+        if shard:
+            positions = dataset.select_shard(*shard)
+            base_prefix += shard_suffix(*shard)
+        yield base_prefix, run_config, dataset, positions
+
+
+def iter_batch_requests(base_prefix, run_config, dialogs_data, skip_task_ids=None):
+    '''yields (custom_id, api_params, task) for every task of a run, built
+    by the same code as the requests of a normal run. custom_id is
+    "{base_prefix}/{task_id}", so it is stable and unique across the runs of
+    a sweep'''
+    iterations = count_tasks(dialogs_data, run_config)
+    with tqdm(total=iterations, desc=base_prefix, unit="task") as progress_bar:
+        for task in iter_dialog_tasks(dialogs_data, run_config, 1, iterations, progress_bar, skip_task_ids):
+            api_params = build_api_params(task['messages'], run_config, task['task_type'])
+            api_params.pop('timeout', None)
+            yield f"{base_prefix}/{task['task_id']}", api_params, task
+
+
+class ChunkedJsonlWriter:
+    '''writes JSON lines into {prefix}_001.jsonl, {prefix}_002.jsonl, ...,
+    starting a new file before one would exceed max_lines lines or
+    max_bytes bytes (the per-file limits of a provider's batch API)'''
+
+    def __init__(self, directory, prefix, max_lines, max_bytes):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_lines = max_lines
+        self.max_bytes = max_bytes
+        self.paths = []
+        self.handle = None
+        self.lines = 0
+        self.bytes = 0
+
+    def write(self, line):
+        data = (line + "\n").encode('utf-8')
+        if self.handle is None or self.lines >= self.max_lines or self.bytes + len(data) > self.max_bytes:
+            self._next_file()
+        self.handle.write(data)
+        self.lines += 1
+        self.bytes += len(data)
+
+    def _next_file(self):
+        self.close()
+        path = os.path.join(self.directory, f"{self.prefix}_{len(self.paths) + 1:03d}.jsonl")
+        self.handle = open(path, 'wb')
+        self.paths.append(path)
+        self.lines = 0
+        self.bytes = 0
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+
+def export_batch(config, args, results_dir, batch_dir):
+    '''writes every request of the config as batch API input lines
+    ({"custom_id", "method", "url", "body"}) into batch_dir, split into files
+    of at most batch.max_requests lines and batch.max_file_mb MB. a manifest
+    records the custom_ids with a hash of each request, so import_batch can
+    check that every request was answered and that the prompts still match.
+    with args.resume, tasks finished in an earlier run (per the journals in
+    results_dir) are left out'''
+    batch_config = config.get('batch') or {}
+    os.makedirs(batch_dir, exist_ok=True)
+    writer = ChunkedJsonlWriter(batch_dir, 'batch_input', batch_config.get('max_requests', 50000),
+                                int(batch_config.get('max_file_mb', 200) * 1024 * 1024))
+    requests = {}
+    try:
+        for base_prefix, run_config, dataset, positions in iter_runs(config, args):
+            completed_task_ids = set()
+            if args.resume:
+                completed_task_ids, _ = TaskJournal.load(os.path.join(results_dir, f"{base_prefix}_journal.jsonl"))
+            dialogs_data = dataset.load_dialogs(positions, run_config, completed_task_ids)
+            for custom_id, api_params, _ in iter_batch_requests(base_prefix, run_config, dialogs_data, completed_task_ids):
+                writer.write(json.dumps({'custom_id': custom_id, 'method': 'POST', 'url': BATCH_URL, 'body': api_params}, ensure_ascii=False))
+                requests[custom_id] = ResponseCache.make_key(api_params)[:16]
+    finally:
+        writer.close()
+
+    manifest = {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'config': config.get('loaded_config_path'),
+        'files': [os.path.basename(path) for path in writer.paths], 'requests': requests
+    }
+    with open(os.path.join(batch_dir, MANIFEST_NAME), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    print(f"Exported {len(requests)} requests into {len(writer.paths)} file(s) in {batch_dir}:")
+    for path in writer.paths:
+        print(f"  {path}")
+    return len(requests)
+
+
+def load_batch_results(result_paths):
+    '''{custom_id: result line} from batch API output/error files. when a
+    custom_id appears more than once, a successful response wins'''
+    responses = {}
+    for path in result_paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Warning: Skipping malformed line {line_number} of {path}.")
+                    continue
+                custom_id = entry.get('custom_id')
+                if custom_id is None:
+                    continue
+                if custom_id not in responses or _batch_error(entry) is None:
+                    responses[custom_id] = entry
+    return responses
+
+
+def _batch_error(entry):
+    '''the error of a batch result line, None for a successful response'''
+    if entry.get('error'):
+        error = entry['error']
+        return f"Batch Error: {error.get('code', '')}: {error.get('message', '')}" if isinstance(error, dict) else f"Batch Error: {error}"
+    response = entry.get('response') or {}
+    if response.get('status_code') != 200:
+        message = ((response.get('body') or {}).get('error') or {}).get('message', '')
+        return f"Batch Error: HTTP {response.get('status_code')}: {message}"
+    return None
+
+
+def import_batch(config, args, results_dir, batch_dir, result_paths):
+    '''reads batch API result files and writes the normal result files of
+    every run (with journals, so --resume can run failed tasks online).
+    every request of the config is checked against the results: requests
+    without a response, with an error, or whose prompt changed since the
+    export (per the manifest) are saved as error rows. returns the number
+    of result rows written'''
+    responses = load_batch_results(result_paths)
+    manifest_path = os.path.join(batch_dir, MANIFEST_NAME)
+    exported = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            exported = json.load(f).get('requests', {})
+    else:
+        print(f"Warning: No manifest found at {manifest_path}, so changed prompts cannot be detected.")
+    print(f"Loaded {len(responses)} batch results from {len(result_paths)} file(s).")
+
+    written = 0
+    counts = {'answered': 0, 'failed': 0, 'missing': 0, 'changed': 0}
+    seen = set()
+    for base_prefix, run_config, dataset, positions in iter_runs(config, args):
+        result_writer, completed_task_ids = open_result_writer(
+            results_dir, base_prefix, resume=args.resume, fsync_interval=config.get('save_interval', 100),
+            output_config=config.get('output')
+        )
+        dialogs_data = dataset.load_dialogs(positions, run_config, completed_task_ids)
+        with result_writer:
+            for custom_id, api_params, task in iter_batch_requests(base_prefix, run_config, dialogs_data, completed_task_ids):
+                seen.add(custom_id)
+                entry = responses.get(custom_id)
+                request_hash = ResponseCache.make_key(api_params)[:16]
+                if entry is None:
+                    counts['missing'] += 1
+                    model_response = (None, None, 0, 0, 0, f"Batch Error: no response for custom_id {custom_id}", {})
+                elif custom_id in exported and exported[custom_id] != request_hash:
+                    counts['changed'] += 1
+                    model_response = (None, None, 0, 0, 0, "Batch Error: the request changed since it was exported", {})
+                elif _batch_error(entry) is not None:
+                    counts['failed'] += 1
+                    model_response = (None, None, 0, 0, 0, _batch_error(entry), {})
+                else:
+                    try:
+                        model_response = unpack_completion(entry['response']['body'], api_params)
+                        counts['answered'] += 1
+                    except Exception as e:
+                        counts['failed'] += 1
+                        model_response = (None, None, 0, 0, 0, f"Batch Error: unreadable response: {e}", {})
+                for result in build_results(task, model_response):
+                    result_writer.write(result)
+                    written += 1
+        print(f"{base_prefix}: {result_writer.counts['MCQ']} MCQ and {result_writer.counts['QA']} QA results written.")
+
+    unknown = [custom_id for custom_id in responses if custom_id not in seen]
+    print(f"Batch import: {counts['answered']} answered, {counts['failed']} failed, {counts['missing']} without a response, "
+          f"{counts['changed']} with a changed prompt.")
+    if counts['failed'] or counts['missing'] or counts['changed']:
+        print("These were saved as errors; run again with --resume to send them online, or export-batch --resume to batch them again.")
+    if unknown:
+        print(f"Warning: {len(unknown)} results do not belong to any request of this config (e.g. {unknown[0]}).")
+    return written
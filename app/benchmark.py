@@ -0,0 +1,202 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from backends import create_backend
+from evaluation_processor import process_dialogs, count_tasks
+from metrics import RunMetrics
+from mock_server import add_mock_arguments
+from rate_limiter import build_rate_limiter
+from result_writer import ResultWriter
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def make_synthetic_dialogs(dialog_count, turns=3, questions=2, seed=0):
+    '''GRICE-shaped dialogs (MCQ turns under 'dialog', QA questions under
+    'question') for benchmarking without the real data files'''
+    rng = random.Random(seed)
+    places = ['kitchen', 'den', 'hallway', 'garden', 'dining_room', 'attic']
+    items = ['cucumber', 'limes', 'keys', 'umbrella', 'book', 'scarf']
+    dialogs = []
+    for dialog_id in range(dialog_count):
+        mcq_turns = []
+        for _ in range(turns):
+            item, place, other = rng.choice(items), rng.choice(places), rng.choice(places)
+            mcq_turns.append({
+                'question': f"did you leave the {item} in the {place}",
+                'answer': f"I was in the {other}",
+                'explict_answer': f"I didn't leave the {item} in the {place}",
+                'option': [f"I didn't leave the {item} in the {place}", f"the {item} is in the {other}",
+                           f"I left the {item} in the {other}", f"I leave the {item} in the {place}"],
+                'answer_index': rng.randint(0, 3)
+            })
+        qa_questions = [{'question': f"where is the {rng.choice(items)}", 'answer': rng.choice(['yes', 'no', 'unknown'] + places)}
+                        for _ in range(questions)]
+        dialogs.append({'dialog_id': dialog_id, 'dialog': mcq_turns, 'question': qa_questions})
+    return dialogs
+
+
+def percentile(sorted_values, fraction):
+    '''nearest-rank percentile of an already sorted list'''
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def peak_rss_mb():
+    '''peak resident set size of this process in MB (None where the
+    resource module is missing, e.g. on Windows)'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class _LatencyRecorder:
+    '''result writer wrapper that keeps the response time of every row'''
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.latencies = []
+        self.errors = 0
+
+    def write(self, result):
+        self.writer.write(result)
+        if result['error_type']:
+            self.errors += 1
+        elif result['response_time'] is not None:
+            self.latencies.append(result['response_time'])
+
+
+@contextlib.contextmanager
+def mock_server_process(mock_args):
+    '''starts mock_server.py on a free port in a separate process, so the
+    mock does not compete with the pipeline for the GIL, and yields its
+    base_url'''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py')
+    process = subprocess.Popen([sys.executable, '-u', script, '--port', '0'] + mock_args,
+                               stdout=subprocess.PIPE, text=True)
+    try:
+        line = process.stdout.readline()
+        if 'listening on ' not in line:
+            raise RuntimeError(f"Mock server did not start: {line.strip()}")
+        yield line.split('listening on ')[1].split()[0]
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run_benchmark(dialogs_data, base_url, max_concurrency, prompt_style='cot', rate_limit=None, quiet=True, prompt_layout='standard', stream=False,
+                  self_consistency=1):
+    '''runs process_dialogs over dialogs_data against base_url and returns
+    the throughput, latency percentiles, peak RSS and per-phase times of
+    the run. stream sets model.stream, so MCQ responses are closed once
+    their answer is parsed. self_consistency above 1 samples that many
+    chains per MCQ item (at temperature 0.7)'''
+    config = {
+        'model': {'model': 'mock-model', 'base_url': base_url, 'temperature': 0.7 if self_consistency > 1 else 0,
+                  'max_tokens': 200, 'prompt_style': prompt_style, 'prompt_layout': prompt_layout, 'stream': stream,
+                  'self_consistency': self_consistency},
+        'execution': {'max_concurrency': max_concurrency},
+        'type_code': 'bench'
+    }
+    if rate_limit:
+        config['rate_limit'] = rate_limit
+    backend = create_backend(config, max_concurrency)
+    rate_limiter = build_rate_limiter(config)
+
+    with tempfile.TemporaryDirectory() as results_dir:
+        output = io.StringIO() if quiet else sys.stdout
+        with ResultWriter(results_dir, 'bench') as writer, contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            recorder = _LatencyRecorder(writer)
+            metrics = RunMetrics()
+            start = time.perf_counter()
+            written = process_dialogs(dialogs_data, config, 1, backend, recorder, rate_limiter=rate_limiter, metrics=metrics)
+            elapsed = time.perf_counter() - start
+    backend.close()
+
+    latencies = sorted(recorder.latencies)
+    tokens = metrics.snapshot()['tokens']
+    return {
+        'prompt_style': prompt_style, 'prompt_layout': prompt_layout, 'stream': stream, 'samples': self_consistency, 'max_concurrency': max_concurrency, 'tasks': written,
+        'errors': recorder.errors, 'seconds': round(elapsed, 3),
+        'tasks_per_sec': round(written / elapsed, 2) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1) if resource is not None else None,
+        'cached_pct': round(tokens['cached'] / tokens['prompt'] * 100, 1) if tokens['prompt'] else None,
+        'phase_seconds': {phase: round(values['seconds'], 3) for phase, values in metrics.snapshot()['phases'].items()}
+    }
+
+
+def print_table(rows):
+    columns = ['prompt_style', 'prompt_layout', 'stream', 'samples', 'max_concurrency', 'tasks', 'errors', 'seconds', 'tasks_per_sec', 'p50_ms', 'p95_ms', 'p99_ms', 'peak_rss_mb', 'cached_pct']
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    print("  ".join(column.rjust(widths[column]) for column in columns))
+    for row in rows:
+        print("  ".join(str(row[column]).rjust(widths[column]) for column in columns))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the evaluation pipeline end to end against a local mock server.")
+    parser.add_argument('--dialogs', type=int, default=100, help='Number of synthetic dialogs (default: 100)')
+    parser.add_argument('--turns', type=int, default=3, help='MCQ turns per dialog (default: 3)')
+    parser.add_argument('--questions', type=int, default=2, help='QA questions per dialog (default: 2)')
+    parser.add_argument('--data', type=str, default=None, help='Benchmark on a dataset JSON instead of synthetic dialogs')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='max_concurrency values to run (default: 1 8 32)')
+    parser.add_argument('--prompt_style', type=str, nargs='+', default=['cot'], help='Prompt styles to run (default: cot)')
+    parser.add_argument('--prompt_layout', type=str, nargs='+', default=['standard'], help='Prompt layouts to run, standard and/or prefix (default: standard)')
+    parser.add_argument('--stream', action='store_true', help='Stream MCQ responses and stop at the parsed answer (model.stream); use with --token_ms')
+    parser.add_argument('--self_consistency', type=int, default=1, help='Reasoning chains sampled per MCQ item (model.self_consistency, n); use with --ignore_n to measure the top-up requests')
+    parser.add_argument('--max_retries', type=int, default=None, help='Add a rate_limit section with this many retries (useful with --error_rate/--rate_limit_rate)')
+    parser.add_argument('--json_out', type=str, default=None, help='Write the results as JSON to this path, e.g. to keep a baseline')
+    parser.add_argument('--verbose', action='store_true', help='Show the pipeline output and progress bars')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    os.environ.setdefault('OPENAI_API_KEY', 'mock')
+    if args.data:
+        from data_handler import load_data_from_json
+        dialogs_data = load_data_from_json(args.data)
+    else:
+        dialogs_data = make_synthetic_dialogs(args.dialogs, args.turns, args.questions)
+    rate_limit = {'max_retries': args.max_retries} if args.max_retries is not None else None
+
+    mock_args = []
+    for name in ('latency_ms', 'latency_dist', 'latency_sigma', 'error_rate', 'rate_limit_rate', 'retry_after_ms', 'answer', 'seed', 'token_ms'):
+        value = getattr(args, name)
+        if value is not None:
+            mock_args += [f"--{name}", str(value)]
+    for name in ('prompt_cache', 'ignore_n'):
+        if getattr(args, name):
+            mock_args.append(f"--{name}")
+
+    print(f"Benchmarking {count_tasks(dialogs_data, {})} tasks per run, mock latency {args.latency_ms} ms ({args.latency_dist}).")
+    rows = []
+    for prompt_style in args.prompt_style:
+        for prompt_layout in args.prompt_layout:
+            for max_concurrency in args.concurrency:
+                # a fresh mock per run, so its prompt cache starts out empty
+                with mock_server_process(mock_args) as base_url:
+                    rows.append(run_benchmark(dialogs_data, base_url, max_concurrency, prompt_style, rate_limit, quiet=not args.verbose,
+                                              prompt_layout=prompt_layout, stream=args.stream, self_consistency=args.self_consistency))
+                print(f"  {prompt_style} ({prompt_layout}) x{max_concurrency}: {rows[-1]['tasks_per_sec']} tasks/sec")
+    print_table(rows)
+
+    if args.json_out:
+        with open(args.json_out, 'w', encoding='utf-8') as f:
+            json.dump({'settings': vars(args), 'runs': rows}, f, indent=2)
+        print(f"Results written to {args.json_out}")
@@ -0,0 +1,117 @@
+import math
+import random
+import re
+import time
+import zlib
+
+
+# deterministic chat completion replies in the shape the pipeline expects,
+# shared by the mock server and the local backend
+
+
+BATCH_TURN_PATTERN = re.compile(r'^Turn (\d+) options:$', re.MULTILINE)
+
+
+def canned_response(prompt_text, answer=None):
+    '''a response in the shape the pipeline expects for the prompt: a CoT
+    "Reasoning: ... Final Answer: N" or a bare choice for MCQ prompts, and a
+    short answer for QA prompts. batched MCQ prompts (with "Turn N options:"
+    blocks) get one answer per turn. without a fixed answer the choice is
+    derived from the prompt, so the same prompt always gets the same reply'''
+    is_cot = 'step-by-step' in prompt_text
+    batch_turns = BATCH_TURN_PATTERN.findall(prompt_text)
+    if batch_turns:
+        lines = []
+        for number in batch_turns:
+            turn_choice = answer or zlib.crc32(f"{number}:{prompt_text}".encode('utf-8')) % 4 + 1
+            if is_cot:
+                lines.append(f"Turn {number} Reasoning: The answer in this turn implies option {turn_choice} given the dialogue context.")
+                lines.append(f"Turn {number} Final Answer: {turn_choice}")
+            else:
+                lines.append(f"Turn {number}: {turn_choice}")
+        return "\n".join(lines)
+    choice = answer or zlib.crc32(prompt_text.encode('utf-8')) % 4 + 1
+    if 'Options:' in prompt_text:
+        if is_cot:
+            return (f"Reasoning: The last answer implies option {choice} given the dialogue context.\nFinal Answer: {choice}\n"
+                    f"The other options do not fit what the speaker is implying in this dialogue.")
+        return str(choice)
+    qa_answer = ('yes', 'no', 'unknown', 'in the kitchen')[choice - 1]
+    if is_cot:
+        return f"Reasoning: The conversation history answers the question.\nAnswer: {qa_answer}"
+    return qa_answer
+
+
+def canned_logprobs(tokens, prompt_text, top_n=20):
+    '''logprobs content for the tokens of a response. option digit tokens get
+    a distribution over the four options that favours the answered one,
+    derived from the prompt; every other token is certain'''
+    rng = random.Random(zlib.crc32(prompt_text.encode('utf-8')))
+    weights = [rng.random() for _ in range(4)]
+    content = []
+    for token in tokens:
+        digit = token.strip()
+        if digit in ('1', '2', '3', '4'):
+            option_weights = list(weights)
+            option_weights[int(digit) - 1] += 2.0
+            total = sum(option_weights)
+            prefix = token[:len(token) - 1]
+            top = sorted(((prefix + str(index + 1), math.log(weight / total)) for index, weight in enumerate(option_weights)),
+                         key=lambda item: -item[1])
+        else:
+            top = [(token, 0.0)]
+        content.append({
+            'token': token, 'logprob': dict(top)[token], 'bytes': list(token.encode('utf-8')),
+            'top_logprobs': [{'token': candidate, 'logprob': logprob, 'bytes': list(candidate.encode('utf-8'))}
+                             for candidate, logprob in top[:top_n]]
+        })
+    return content
+
+
+def request_prompt_text(request):
+    return "\n".join(str(message.get('content', '')) for message in request.get('messages', []))
+
+
+def estimate_prompt_tokens(prompt_text):
+    return len(prompt_text) // 4 + 1
+
+
+def completion_body(request, contents, prompt_text, prompt_tokens, cached_chars=0):
+    '''the chat completion JSON of a request answered with contents (one
+    per choice), with logprobs when the request asks for them'''
+    completion_tokens = sum(len(text) // 4 + 1 for text in contents)
+    choices = [{'index': index, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}
+               for index, text in enumerate(contents)]
+    if request.get('logprobs'):
+        for choice, text in zip(choices, contents):
+            choice['logprobs'] = {'content': canned_logprobs(re.findall(r'\s*\S+', text), prompt_text, request.get('top_logprobs') or 0)}
+    return {
+        'id': 'chatcmpl-mock', 'object': 'chat.completion', 'created': int(time.time()),
+        'model': request.get('model', 'mock'),
+        'choices': choices,
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                  'total_tokens': prompt_tokens + completion_tokens,
+                  'prompt_tokens_details': {'cached_tokens': cached_chars // 4}}
+    }
+
+
+def completion_chunks(request, content, prompt_text, prompt_tokens, cached_chars=0):
+    '''yields the chunks of a streamed chat completion of content, one word
+    per chunk, then the finish chunk and, when stream_options.include_usage
+    is set, the usage chunk'''
+    chunk = {'id': 'chatcmpl-mock', 'object': 'chat.completion.chunk', 'created': int(time.time()),
+             'model': request.get('model', 'mock')}
+    tokens = re.findall(r'\s*\S+', content)
+    logprobs = canned_logprobs(tokens, prompt_text, request.get('top_logprobs') or 0) if request.get('logprobs') else None
+    for index, token in enumerate(tokens):
+        delta = {'role': 'assistant', 'content': token} if index == 0 else {'content': token}
+        choice = {'index': 0, 'delta': delta, 'finish_reason': None}
+        if logprobs is not None:
+            choice['logprobs'] = {'content': [logprobs[index]]}
+        yield {**chunk, 'choices': [choice]}
+    yield {**chunk, 'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+    if (request.get('stream_options') or {}).get('include_usage'):
+        yield {**chunk, 'choices': [], 'usage': {
+            'prompt_tokens': prompt_tokens, 'completion_tokens': len(tokens),
+            'total_tokens': prompt_tokens + len(tokens),
+            'prompt_tokens_details': {'cached_tokens': cached_chars // 4}}}
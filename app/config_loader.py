@@ -3,15 +3,40 @@ import yaml
 import sys
 import os
 
+from prompt_builder import config_prompt_styles
+
+
+class _DuplicateKeyWarningLoader(yaml.SafeLoader):
+    '''safe loader that warns when a mapping repeats a key, since YAML then
+    silently keeps only the last value (e.g. several data.path lines)'''
+
+    def construct_mapping(self, node, deep=False):
+        seen = set()
+        for key_node, _ in node.value:
+            key = self.construct_object(key_node, deep=deep)
+            if key in seen:
+                print(f"Warning: Duplicate key '{key}' in configuration (line {key_node.start_mark.line + 1}), only the last value is used. Use data.paths with a sweep section to run several files.")
+            seen.add(key)
+        return super().construct_mapping(node, deep=deep)
+
+
 def load_config(config_path='config.yaml'):
     '''loads the config file of choice'''
     try:
         with open(config_path, 'r') as file:
-            config = yaml.safe_load(file)
+            config = yaml.load(file, Loader=_DuplicateKeyWarningLoader)
             print(f"Loaded config from: {config_path}")
             if 'data' in config and 'path' in config['data']:
                  config['data']['path'] = config['data']['path'].replace('\\', '/')
                  print(f"Adjusted data path to: {config['data']['path']}")
+            if 'data' in config and 'paths' in config['data']:
+                 config['data']['paths'] = [path.replace('\\', '/') for path in config['data']['paths']]
+            model_config = config.get('model') or {}
+            if (model_config.get('self_consistency') or 1) > 1 and not model_config.get('temperature'):
+                print("Warning: model.self_consistency samples several reasoning chains, but with temperature 0 they will mostly be identical.")
+            if config.get('prompt_styles'):
+                styles = config_prompt_styles(config)
+                print(f"Loaded prompt styles from config: {', '.join(styles)}")
             return config
     except FileNotFoundError:
         print(f"Error: Configuration file not found at '{config_path}'")
@@ -19,6 +44,9 @@ def load_config(config_path='config.yaml'):
     except yaml.YAMLError as e:
         print(f"Error parsing configuration file '{config_path}': {str(e)}")
         sys.exit(1)
+    except ValueError as e:
+        print(f"Error in prompt_styles of '{config_path}': {e}")
+        sys.exit(1)
     except Exception as e:
         print(f"An unexpected error occurred while loading config: {e}")
         sys.exit(1)
@@ -1,5 +1,6 @@
 
 import json
+import math
 import re
 import sys
 
@@ -27,6 +28,16 @@ def load_data_from_json(filepath):
         sys.exit(1)
 
 
+def extract_type_code(filename: str) -> str:
+    '''extracts which implicature type is in the current JSON file based on the two-letter combination in the file name'''
+    match = re.search(r'impl_dial_v0\.1_([a-z]{2})\.json$', filename, re.IGNORECASE)
+    if match:
+        return match.group(1).lower()
+    else:
+        print(f"Warning: Could not extract type code from filename '{filename}'. Using 'unknown_type'.")
+        return "unknown_type"
+
+
 def detect_task_type(item):
     """Detects if the task is MCQ or QA based on presence of 'option' key."""
     if isinstance(item, dict) and 'option' in item and 'answer_index' in item:
@@ -36,25 +47,102 @@ def detect_task_type(item):
     else:
         return 'Unknown'
 
+# MCQ response parsing, shared by build_result and the offline re-scoring in
+# rescore.py. the choice is the digit after "Final Answer:", or else the
+# last 1-4 digit in the response
+FINAL_ANSWER_PATTERN = re.compile(r'Final Answer:\s*([1-4])')
+LAST_CHOICE_PATTERN = re.compile(r'([1-4])[^1-4]*$')
+REASONING_PATTERN = re.compile(r'Reasoning:(.*?)Final Answer:', re.DOTALL | re.IGNORECASE)
+
+# batched MCQ responses answer several turns, each introduced by "Turn N"
+# at the start of a line ("Turn 3: 2", "Turn 3 Final Answer: 2", "**Turn 3**")
+TURN_MARKER_PATTERN = re.compile(r'^\W*Turn\s*(\d+)', re.MULTILINE | re.IGNORECASE)
+INLINE_TURN_ANSWER_PATTERN = re.compile(r'Turn\s*(\d+)\W{0,4}([1-4])\b', re.IGNORECASE)
+
+
 def parse_mcq_choice_number(response_text):
     """Extracts the single digit choice (1, 2, 3, 4) from the model response."""
     if not isinstance(response_text, str):
         return None
 
-    match = re.search(r'Final Answer:\s*([1-4])', response_text)
+    match = FINAL_ANSWER_PATTERN.search(response_text)
     if match:
         return int(match.group(1))
 
-    match = re.search(r'[^1-4]*([1-4])[^1-4]*$', response_text)
+    match = LAST_CHOICE_PATTERN.search(response_text)
     if match:
         return int(match.group(1))
 
-    if len(response_text) == 1 and response_text in ['1', '2', '3', '4']:
-        return int(response_text) 
-
     return None
 
 
+def split_batch_response(response_text, turn_numbers):
+    '''splits a batched MCQ response into one text per turn, so that each
+    turn is scored by parse_mcq_choice_number like a single-turn response.
+    lines starting with "Turn N" are collected per turn with the marker
+    removed ("Turn 3 Reasoning: ..." and "Turn 3 Final Answer: 2" become
+    "Reasoning: ...\\nFinal Answer: 2"). turns without such lines fall back
+    to inline "Turn N: c" answers, and a response without any turn markers
+    is matched by position when it holds exactly one choice per turn. when
+    a turn is answered more than once, its first answer wins.
+    returns {turn number: text or None}'''
+    segments = {number: [] for number in turn_numbers}
+    answered = set()
+    markers = list(TURN_MARKER_PATTERN.finditer(response_text))
+    for marker, next_marker in zip(markers, markers[1:] + [None]):
+        number = int(marker.group(1))
+        if number in segments and number not in answered:
+            end = next_marker.start() if next_marker else len(response_text)
+            text = response_text[marker.end():end]
+            # several answers on one line: "Turn 1: 2, Turn 2: 4"
+            inline = INLINE_TURN_ANSWER_PATTERN.search(text)
+            if inline:
+                text = text[:inline.start()]
+            text = re.sub(r'^[\s:*.)\-]+', '', text).rstrip(' ,;').strip()
+            if text:
+                segments[number].append(text)
+                if FINAL_ANSWER_PATTERN.search(text) or re.fullmatch(r'[1-4]\W*', text):
+                    answered.add(number)
+    texts = {number: "\n".join(parts) if parts else None for number, parts in segments.items()}
+
+    for number, choice in INLINE_TURN_ANSWER_PATTERN.findall(response_text):
+        if int(number) in texts and texts[int(number)] is None:
+            texts[int(number)] = choice
+    if not markers and all(text is None for text in texts.values()):
+        choices = re.findall(r'(?<![\d.])[1-4](?![\d.])', response_text)
+        if len(choices) == len(turn_numbers):
+            texts = dict(zip(turn_numbers, choices))
+    return texts
+
+
+def option_probabilities(token_logprobs):
+    '''distribution over options 1-4 at the token parse_mcq_choice_number
+    reads the choice from. token_logprobs is the response as a list of
+    (token, top_logprobs) with top_logprobs as (token, logprob) pairs. the
+    probabilities of option tokens among the top logprobs ("2", " 2", ...)
+    are summed per option and normalized to sum to 1, so an equal logit
+    bias on all four options does not change them. returns None when the
+    response has no choice or no option token is among the top logprobs'''
+    text = ''.join(token for token, _ in token_logprobs)
+    match = FINAL_ANSWER_PATTERN.search(text) or LAST_CHOICE_PATTERN.search(text)
+    if not match:
+        return None
+    end = 0
+    for token, top_logprobs in token_logprobs:
+        end += len(token)
+        if end > match.start(1):
+            break
+    mass = [0.0, 0.0, 0.0, 0.0]
+    for candidate, logprob in top_logprobs:
+        candidate = candidate.strip()
+        if candidate in ('1', '2', '3', '4'):
+            mass[int(candidate) - 1] += math.exp(logprob)
+    total = sum(mass)
+    if total == 0:
+        return None
+    return [value / total for value in mass]
+
+
 if __name__ == '__main__':
     print("Testing data handler functions...")
     mcq_item = {"question": "q", "answer": "a", "explict_answer": "ea", "option": ["1","2","3","4"], "answer_index": 0}
@@ -0,0 +1,302 @@
+import argparse
+import codecs
+import hashlib
+import json
+import os
+import sys
+
+from data_handler import detect_task_type
+from sharding import shard_of
+from task_journal import make_task_id
+
+
+INDEX_VERSION = 1
+READ_SIZE = 1 << 20
+TYPE_CODES = {'MCQ': 'M', 'QA': 'Q'}
+
+
+class _JsonStream:
+    '''reads a JSON document piece by piece with JSONDecoder.raw_decode, so
+    only the value being decoded (one dialog) is held in memory. keeps the
+    byte offset of the read position and a sha256 of everything read'''
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.decoder = json.JSONDecoder()
+        self.sha256 = hashlib.sha256()
+        self.text = ''
+        self.pos = 0
+        self.mark = 0
+        self.base = 0
+        self.eof = False
+
+    def _read(self, size=None):
+        # the text before the read position is no longer needed
+        self.offset()
+        self.text = self.text[self.pos:]
+        self.pos = self.mark = 0
+        data = self.handle.read(size or READ_SIZE)
+        self.sha256.update(data)
+        self.eof = not data
+        self.text += self.utf8.decode(data, final=self.eof)
+
+    def offset(self):
+        '''byte offset of the read position in the file'''
+        self.base += len(self.text[self.mark:self.pos].encode('utf-8'))
+        self.mark = self.pos
+        return self.base
+
+    def peek(self):
+        '''the next non-whitespace character, '' at the end of the file'''
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in ' \t\r\n':
+                self.pos += 1
+            if self.pos < len(self.text) or self.eof:
+                return self.text[self.pos:self.pos + 1]
+            self._read()
+
+    def expect(self, characters):
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError(f"expected one of {characters!r} at byte {self.offset()}, found {character or 'end of file'!r}")
+        self.pos += 1
+        return character
+
+    def value(self):
+        '''decodes the next JSON value, reading more of the file while it is
+        incomplete (the read size doubles so a large value is not decoded
+        over and over)'''
+        self.peek()
+        size = READ_SIZE
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._read(size)
+                size *= 2
+                continue
+            if end == len(self.text) and not self.eof:
+                # a number at the end of the buffer may continue in the next chunk
+                self._read(size)
+                continue
+            self.pos = end
+            return value
+
+    def find_key(self, key):
+        '''walks the object at the read position up to the value of key.
+        returns False when the object does not have the key'''
+        self.expect('{')
+        if self.peek() == '}':
+            return False
+        while True:
+            name = self.value()
+            self.expect(':')
+            if name == key:
+                return True
+            self.value()
+            if self.expect(',}') == '}':
+                return False
+
+    def finish(self):
+        '''reads the rest of the file, so the hash covers all of it'''
+        while not self.eof:
+            self._read()
+        return self.sha256.hexdigest()
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class DatasetIndex:
+    '''compiled task index of a dataset file. per dialog (in file order) it
+    holds [dialog_id, byte offset, byte length, MCQ turn types, QA question
+    types], the types as one letter per item ("M", "Q", "U" for unknown).
+    task ids, shards and the history position of every task can be worked
+    out from it without parsing the dataset, and the dialogs that are
+    actually needed are read from their byte ranges'''
+
+    def __init__(self, data_path, sha256, dialogs):
+        self.data_path = data_path
+        self.sha256 = sha256
+        self.dialogs = dialogs
+        self.dialog_cache = {}
+
+    def __len__(self):
+        return len(self.dialogs)
+
+    def task_count(self, positions=None):
+        '''number of MCQ turns and QA questions, as counted by count_tasks'''
+        positions = range(len(self.dialogs)) if positions is None else positions
+        return sum(len(self.dialogs[position][3]) + len(self.dialogs[position][4]) for position in positions)
+
+    def select_shard(self, shard_index, shard_count):
+        '''positions of the dialogs of a shard, the same dialogs select_shard picks'''
+        return [position for position, entry in enumerate(self.dialogs) if shard_of(entry[0], shard_count) == shard_index]
+
+    def dialog_order(self):
+        return {str(entry[0]): position for position, entry in enumerate(self.dialogs)}
+
+    def iter_tasks(self, positions, type_code, prompt_style):
+        '''yields (position, task_id, task_type, index, history_position) in
+        the order iter_turn_tasks walks them. history_position is the number
+        of MCQ turns of the dialog before the task, i.e. the history its
+        prompt is built from'''
+        for position in positions:
+            dialog_id, _, _, turn_types, question_types = self.dialogs[position]
+            history_position = 0
+            for turn_index, type_letter in enumerate(turn_types):
+                if type_letter == 'M':
+                    yield position, make_task_id(type_code, dialog_id, 'MCQ', turn_index, prompt_style), 'MCQ', turn_index, history_position
+                    history_position += 1
+            for qa_index, type_letter in enumerate(question_types):
+                if type_letter == 'Q':
+                    yield position, make_task_id(type_code, dialog_id, 'QA', qa_index, prompt_style), 'QA', qa_index, history_position
+
+    def pending_positions(self, positions, current_config, skip_task_ids):
+        '''positions of the dialogs with at least one task not in
+        skip_task_ids. dialogs whose tasks are all done need not be read at
+        all, since the history of a task only comes from its own dialog.
+        with max_iterations set, the skipped tasks still count towards the
+        limit, so every dialog is kept'''
+        if not skip_task_ids or current_config.get('max_iterations') is not None:
+            return list(positions)
+        type_code = current_config.get('type_code', 'unknown_type')
+        prompt_style = current_config.get('model', {}).get('prompt_style', 'cot').lower()
+        pending = []
+        for position, task_id, _, _, _ in self.iter_tasks(positions, type_code, prompt_style):
+            if task_id not in skip_task_ids and (not pending or pending[-1] != position):
+                pending.append(position)
+        return pending
+
+    def load_dialogs(self, positions=None, current_config=None, skip_task_ids=None):
+        '''reads the dialogs at positions (all by default) from their byte
+        ranges in the data file. with skip_task_ids, dialogs whose tasks are
+        all done are left out. parsed dialogs are kept, so the runs of a
+        sweep over the same file parse each dialog once'''
+        positions = range(len(self.dialogs)) if positions is None else positions
+        if skip_task_ids:
+            selected = len(positions)
+            positions = self.pending_positions(positions, current_config or {}, skip_task_ids)
+            if len(positions) < selected:
+                print(f"{selected - len(positions)} of {selected} dialogs have no tasks left to run and are not loaded.")
+        missing = [position for position in positions if position not in self.dialog_cache]
+        if missing:
+            with open(self.data_path, 'rb') as f:
+                for position in missing:
+                    _, offset, length, _, _ = self.dialogs[position]
+                    f.seek(offset)
+                    self.dialog_cache[position] = json.loads(f.read(length).decode('utf-8'))
+        return [self.dialog_cache[position] for position in positions]
+
+    def to_json(self, stat):
+        return {'version': INDEX_VERSION, 'data_path': os.path.abspath(self.data_path), 'sha256': self.sha256,
+                'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'dialogs': self.dialogs}
+
+
+def compile_index(data_path):
+    '''builds the DatasetIndex of a dataset file in one streaming pass'''
+    dialogs = []
+    with open(data_path, 'rb') as f:
+        stream = _JsonStream(f)
+        if not stream.find_key('data') or not stream.find_key('dialogs'):
+            raise ValueError("JSON structure is missing 'data' or 'data.dialogs' key.")
+        stream.expect('[')
+        if stream.peek() == ']':
+            stream.pos += 1
+        else:
+            while True:
+                stream.peek()
+                start = stream.offset()
+                dialog = stream.value()
+                end = stream.offset()
+                if not isinstance(dialog, dict):
+                    raise ValueError(f"dialog {len(dialogs)} at byte {start} is not an object.")
+                dialogs.append([
+                    dialog.get('dialog_id'), start, end - start,
+                    ''.join(TYPE_CODES.get(detect_task_type(item), 'U') for item in dialog.get('dialog', [])),
+                    ''.join(TYPE_CODES.get(detect_task_type(item), 'U') for item in dialog.get('question', []))
+                ])
+                if stream.expect(',]') == ']':
+                    break
+        sha256 = stream.finish()
+    return DatasetIndex(data_path, sha256, dialogs)
+
+
+def index_path(data_path, index_dir=None):
+    '''{index_dir}/{data file name}.index.json, index_dir defaulting to an
+    .index directory next to the data file'''
+    index_dir = index_dir or os.path.join(os.path.dirname(os.path.abspath(data_path)), '.index')
+    return os.path.join(index_dir, os.path.basename(data_path) + '.index.json')
+
+
+def _write_index(path, index, stat):
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(index.to_json(stat), f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(temporary_path, path)
+    except OSError as e:
+        print(f"Warning: Could not save the task index to {path}: {e}")
+
+
+def load_index(data_path, index_dir=None):
+    '''returns the DatasetIndex of data_path, compiling it on first use. the
+    saved index is used as long as the file's size and mtime are unchanged;
+    if they changed, it is still used (and its stat updated) when the
+    file's sha256 matches, otherwise the file is compiled again. exits like
+    load_data_from_json when the file cannot be read'''
+    path = index_path(data_path, index_dir)
+    try:
+        stat = os.stat(data_path)
+        saved = None
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    saved = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                saved = None
+            if saved is not None and saved.get('version') != INDEX_VERSION:
+                saved = None
+        if saved is not None and (saved['size'], saved['mtime_ns']) == (stat.st_size, stat.st_mtime_ns):
+            index = DatasetIndex(data_path, saved['sha256'], saved['dialogs'])
+        elif saved is not None and saved['sha256'] == file_sha256(data_path):
+            index = DatasetIndex(data_path, saved['sha256'], saved['dialogs'])
+            _write_index(path, index, stat)
+        else:
+            index = compile_index(data_path)
+            _write_index(path, index, stat)
+            print(f"Compiled task index of {data_path}: {len(index)} dialogs, {index.task_count()} tasks.")
+    except FileNotFoundError:
+        print(f"Error: Data file not found at {data_path}")
+        sys.exit(1)
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        print(f"Error: Could not decode JSON from {data_path}: {e}")
+        sys.exit(1)
+    except ValueError as ve:
+        print(f"Error in data file structure: {ve}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"An unexpected error occurred loading data: {e}")
+        sys.exit(1)
+    print(f"Indexed {len(index)} dialogs from {data_path}")
+    return index
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compile the task index of dataset files ahead of a run.")
+    parser.add_argument('data_paths', nargs='+', help='Dataset JSON files, e.g. jsons/impl_dial_v0.1_*.json')
+    parser.add_argument('--index_dir', type=str, default=None, help='Directory of the index files (default: .index next to each data file)')
+    args = parser.parse_args()
+
+    for data_path in args.data_paths:
+        index = load_index(data_path, args.index_dir)
+        print(f"  {index_path(data_path, args.index_dir)}: {index.task_count()} tasks")
@@ -1,43 +1,53 @@
-
-import re
-import os
-import pandas as pd
+import asyncio
+import time
+from collections import deque
 from tqdm import tqdm
 
 
-from data_handler import detect_task_type, parse_mcq_choice_number
-from model_interaction import get_model_response
-from openai import OpenAI 
+from data_handler import detect_task_type, parse_mcq_choice_number, split_batch_response, REASONING_PATTERN
+from model_interaction import get_model_response, get_model_response_async
+from prompt_builder import DialogHistory, resolve_prompt_style, resolve_prompt_layout, resolve_turn_batch
+from task_journal import make_task_id
 
-def process_dialogs(dialogs_data, current_config, results_dir, start_iteration, openai_client):
-    """Processes all dialogs and tasks, returning a list of results."""
 
-    results = []
-    iterations = 0
-    max_iterations = current_config.get('max_iterations', float('inf'))
-    prompt_style = current_config.get('model', {}).get('prompt_style', 'cot').lower() 
-    start_iteration_0_based = max(0, start_iteration - 1) 
-    print(f"--- Start Iteration Info ---")
-    print(f"Command line start_iteration (1-based): {start_iteration}")
-    print(f"Effective start index (0-based): {start_iteration_0_based}")
-    print(f"Tasks will be processed starting from index {start_iteration_0_based}.")
-    print(f"--------------------------")
-    
+def iter_dialog_tasks(dialogs_data, current_config, start_iteration, effective_max_iterations, progress_bar, skip_task_ids=None):
+    """Walks the dialogs in order and yields one task dict (prompt plus the
+    metadata needed for its result row) per MCQ turn and QA question.
+    Tasks whose task_id is in skip_task_ids are already done and are not
+    built at all; only the dialogue history is carried past them.
 
-    total_estimated_iterations = 0
-    for dialog in dialogs_data:
-        total_estimated_iterations += len(dialog.get('dialog', [])) 
-        total_estimated_iterations += len(dialog.get('question', []))
-    effective_max_iterations = min(max_iterations, total_estimated_iterations)
+    With model.turn_batch the MCQ turns of a dialog are grouped into
+    batched tasks instead (see batch_turn_tasks)."""
+    style = resolve_prompt_style(current_config)
+    turn_batch = resolve_turn_batch(current_config)
+    if turn_batch is not None and style.batch_mcq is None:
+        print(f"Warning: Prompt style '{style.name}' has no batch_mcq template. Sending one request per turn.")
+        turn_batch = None
+    tasks = iter_turn_tasks(dialogs_data, current_config, start_iteration, effective_max_iterations, progress_bar,
+                            skip_task_ids, style, batched=turn_batch is not None)
+    if turn_batch is None:
+        return tasks
+    return batch_turn_tasks(tasks, turn_batch, style)
 
-    progress_bar = tqdm(total=effective_max_iterations, desc=f"Processing Tasks ({prompt_style})", unit="task")
+
+def iter_turn_tasks(dialogs_data, current_config, start_iteration, effective_max_iterations, progress_bar, skip_task_ids, style, batched=False):
+    """The per-turn tasks of iter_dialog_tasks. batched MCQ tasks get no
+    prompt of their own but a reference to the dialog history and their
+    position in it, from which batch_turn_tasks builds the batched prompt."""
+
+    iterations = 0
+    prompt_style = current_config.get('model', {}).get('prompt_style', 'cot').lower()
+    layout = resolve_prompt_layout(current_config)
+    type_code = current_config.get('type_code', 'unknown_type')
+    skip_task_ids = skip_task_ids or set()
+    start_iteration_0_based = max(0, start_iteration - 1)
 
     for dialog_info in dialogs_data:
         if iterations >= effective_max_iterations:
             break
 
         dialog_id = dialog_info['dialog_id']
-        full_dialog_history_text = "" 
+        history = DialogHistory()
 
         mcq_tasks = dialog_info.get('dialog', [])
         for turn_index, turn_data in enumerate(mcq_tasks):
@@ -51,15 +61,16 @@ def process_dialogs(dialogs_data, current_config, results_dir, start_iteration,
             iterations += 1
             progress_bar.update(1)
 
-            current_iteration_0_based = iterations - 1 
+            current_iteration_0_based = iterations - 1
+            task_id = make_task_id(type_code, dialog_id, task_type, turn_index, prompt_style)
 
-            if current_iteration_0_based < start_iteration_0_based:
+            if current_iteration_0_based < start_iteration_0_based or task_id in skip_task_ids:
                 progress_bar.set_postfix_str(f"Skipping task {iterations}/{effective_max_iterations} (idx {current_iteration_0_based})")
-                
+
                 current_q_skipped = turn_data.get('question', '[Fråga saknas]')
                 current_a_skipped = turn_data.get('answer', '[Svar saknas]')
-                full_dialog_history_text += f"Question: {current_q_skipped}\nAnswer: {current_a_skipped}\n\n" 
-                continue 
+                history.add_turn(current_q_skipped, current_a_skipped)
+                continue
             progress_bar.set_postfix_str(f"Processing Dialog {dialog_id}, MCQ Turn {turn_index} (Task {iterations})")
 
             current_q = turn_data.get('question', '[Fråga saknas]')
@@ -68,84 +79,22 @@ def process_dialogs(dialogs_data, current_config, results_dir, start_iteration,
             correct_index = turn_data.get('answer_index', -1)
             explicit_a = turn_data.get('explict_answer', 'N/A')
 
-            current_turn_text = f"Last Question: {current_q}\nLast Answer: {current_a}" 
-            options_text = "\n".join([f"{i+1}) {opt}" for i, opt in enumerate(options_list)])
-
-            if prompt_style == 'cot':
-                prompt_text = f"""Consider the dialogue context below, paying close attention to the final Question-Answer pair.
-
-Dialogue Context:
-{full_dialog_history_text}
-{current_turn_text}
-
-Task: What is the most likely implied meaning (implicature) of the *last Answer* ("{current_a}") in response to the *last Question* ("{current_q}"), given the preceding dialogue?First, perform reasoning step-by-step based on the Dialogue Context to determine the implied meaning of the last Answer, then choose the best option (1-4) representing this implied meaning.
-
-Options:
-{options_text}
-
-[Reasoning and answer here]:
-""" 
-                
-            elif prompt_style == 'zero-shot':
-                prompt_text = f"""Consider the dialogue context below, paying close attention to the final Question-Answer pair.
-
-Dialogue Context:
-{full_dialog_history_text}
-{current_turn_text}
-
-Task: What is the most likely implied meaning (implicature) of the *last Answer* ("{current_a}") in response to the *last Question* ("{current_q}"), given the preceding dialogue? Choose the best option representing this implied meaning.
-
-Options:
-{options_text}
-
-Choice (1-4):"""
-            else:
-                print(f"Warning: Unknown prompt_style '{prompt_style}'. Defaulting to 'cot'.")
-
-
-            messages = [{"role": "user", "content": prompt_text}]
-
-            model_response_content, response_time, p_tokens, c_tokens, t_tokens, error = get_model_response(openai_client, messages, current_config, task_type)
-
-            predicted_choice_number = None
-            predicted_index = -1 
-            is_correct = False
-            reasoning = "" 
-
-            if model_response_content and not error:
-                 predicted_choice_number = parse_mcq_choice_number(model_response_content)
-                 if predicted_choice_number is not None:
-                     predicted_index = predicted_choice_number - 1
-                     if correct_index != -1:
-                         is_correct = (predicted_index == correct_index)
-
-                 if prompt_style == 'cot':
-                     reasoning_match = re.search(r'Reasoning:(.*?)Final Answer:', model_response_content, re.DOTALL | re.IGNORECASE)
-                     if reasoning_match:
-                         reasoning = reasoning_match.group(1).strip()
-                     elif predicted_choice_number is None: 
-                         reasoning = f"[Parse Error or No Final Answer] Full Response: {model_response_content}"
-
-                 elif predicted_choice_number is None:
-                     reasoning = f"[Parse Error] Full Response: {model_response_content}"
-
-
-            result = {
-                'dialog_id': dialog_id, 'turn_index': turn_index, 'qa_question_index': None,
-                'task_type': task_type, 'question': current_q,
+            task = {
+                'iteration': iterations, 'task_id': task_id, 'dialog_id': dialog_id, 'turn_index': turn_index,
+                'qa_question_index': None, 'task_type': task_type, 'question': current_q,
                 'agent_answer_raw': current_a, 'options': options_list,
-                'correct_index': correct_index, 'predicted_index': predicted_index,
-                'predicted_choice': predicted_choice_number, 'is_correct': is_correct,
-                'model_response_full': model_response_content or "", 'model_reasoning': reasoning,
-                'response_time': response_time, 'prompt_tokens': p_tokens, 'completion_tokens': c_tokens,
-                'total_tokens': t_tokens, 'error_type': error, 'ground_truth_answer': None,
-                'prompt_style': prompt_style, 
-                'full_prompt': prompt_text
+                'correct_index': correct_index, 'ground_truth_answer': None,
+                'prompt_style': prompt_style, 'parse_reasoning': style.reasoning, 'prompt_layout': layout,
+                'config': current_config
             }
-            results.append(result)
+            if batched:
+                task.update({'history': history, 'history_position': len(history.segments)})
+            else:
+                prompt_text = style.mcq_prompt(history, current_q, current_a, options_list, layout)
+                task.update({'prompt_text': prompt_text, 'messages': [{"role": "user", "content": prompt_text}]})
+            yield task
 
-            full_dialog_history_text += f"Question: {current_q}\nAnswer: {current_a}\n\n"
-            progress_bar.set_postfix_str(f"Dialog {dialog_id}, MCQ Turn {turn_index}")
+            history.add_turn(current_q, current_a)
 
 
         qa_tasks = dialog_info.get('question', [])
@@ -157,69 +106,344 @@ Choice (1-4):"""
                 print(f"Warning: Expected QA task, found {task_type}. Skipping.")
                 continue
 
-            iterations += 1 
-            progress_bar.update(1) 
+            iterations += 1
+            progress_bar.update(1)
 
-            current_iteration_0_based = iterations - 1 
+            current_iteration_0_based = iterations - 1
+            task_id = make_task_id(type_code, dialog_id, task_type, qa_index, prompt_style)
 
-            if current_iteration_0_based < start_iteration_0_based:
+            if current_iteration_0_based < start_iteration_0_based or task_id in skip_task_ids:
                 progress_bar.set_postfix_str(f"Skipping task {iterations}/{effective_max_iterations} (idx {current_iteration_0_based})")
-                continue 
+                continue
             progress_bar.set_postfix_str(f"Processing Dialog {dialog_id}, QA Task {qa_index} (Task {iterations})")
             qa_question = qa_data.get('question', '[Fråga saknas]')
             qa_ground_truth = qa_data.get('answer', '[Referenssvar saknas]')
 
-            if prompt_style == 'zero-shot':
+            qa_prompt_text = style.qa_prompt(history, qa_question, layout)
+
+            yield {
+                'iteration': iterations, 'task_id': task_id, 'dialog_id': dialog_id, 'turn_index': None,
+                'qa_question_index': qa_index, 'task_type': task_type, 'question': qa_question,
+                'agent_answer_raw': None, 'options': None, 'correct_index': None,
+                'ground_truth_answer': qa_ground_truth, 'prompt_style': prompt_style,
+                'parse_reasoning': style.reasoning, 'prompt_layout': layout, 'prompt_text': qa_prompt_text,
+                'messages': [{"role": "user", "content": qa_prompt_text}], 'config': current_config
+            }
 
-                qa_prompt_text = f"""Based on the conversation history provided below and the question: Answer the question about the conversation.
 
-    Conversation History:
-    {full_dialog_history_text}
-    Question: {qa_question}
+def batch_turn_tasks(tasks, turn_batch, style):
+    """Groups consecutive MCQ tasks of a dialog, up to turn_batch of them,
+    into one MCQ_BATCH task whose prompt asks about all of them. The
+    grouped tasks are kept under 'batch' to build their result rows; QA
+    tasks pass through unchanged."""
+
+    def make_batch(window):
+        prompt_text = style.batch_mcq_prompt(window[0]['history'], [
+            (turn['history_position'], turn['question'], turn['agent_answer_raw'], turn['options']) for turn in window
+        ])
+        for turn in window:
+            del turn['history']
+            turn['prompt_text'] = prompt_text
+        return {
+            'iteration': window[0]['iteration'], 'task_id': window[0]['task_id'], 'dialog_id': window[0]['dialog_id'],
+            'task_type': 'MCQ_BATCH', 'batch': window, 'prompt_style': window[0]['prompt_style'],
+            'prompt_layout': window[0]['prompt_layout'], 'prompt_text': prompt_text,
+            'messages': [{"role": "user", "content": prompt_text}], 'config': window[0]['config']
+        }
+
+    window = []
+    for task in tasks:
+        if window and (task['task_type'] != 'MCQ' or task['dialog_id'] != window[0]['dialog_id']):
+            yield make_batch(window)
+            window = []
+        if task['task_type'] != 'MCQ':
+            yield task
+            continue
+        window.append(task)
+        if len(window) >= turn_batch:
+            yield make_batch(window)
+            window = []
+    if window:
+        yield make_batch(window)
+
+
+def majority_vote(chains):
+    '''self-consistency: parses the choice of every reasoning chain and
+    returns the vote histogram over options 1-4 and a chain that gave the
+    majority answer (ties go to the option voted for first)'''
+    votes = [0, 0, 0, 0]
+    first_chain = {}
+    for chain in chains:
+        choice = parse_mcq_choice_number(chain)
+        if choice is not None:
+            votes[choice - 1] += 1
+            first_chain.setdefault(choice, chain)
+    if not first_chain:
+        return votes, chains[0]
+    # first_chain keeps the order in which options were first voted for, and
+    # max returns the first of equally voted options
+    majority = max(first_chain, key=lambda choice: votes[choice - 1])
+    return votes, first_chain[majority]
+
+
+def build_result(task, model_response):
+    """Scores a model response for a task and returns its result row."""
+    model_response_content, response_time, p_tokens, c_tokens, t_tokens, error, details = model_response
+    prompt_style = task['prompt_style']
+
+    if task['task_type'] == 'QA':
+        return {
+            'dialog_id': task['dialog_id'], 'turn_index': None, 'qa_question_index': task['qa_question_index'],
+            'task_type': task['task_type'], 'question': task['question'], 'agent_answer_raw': None,
+            'options': None, 'correct_index': None, 'predicted_index': None,
+            'predicted_choice': None, 'is_correct': None,
+            'model_response_full': model_response_content or "", 'model_reasoning': None,
+            'response_time': response_time, 'prompt_tokens': p_tokens, 'completion_tokens': c_tokens,
+            'total_tokens': t_tokens, 'error_type': error, 'ground_truth_answer': task['ground_truth_answer'],
+            'prompt_style': 'qa',
+            'qa_full_prompt': task['prompt_text'], 'task_id': task['task_id'],
+            'cached_tokens': details.get('cached_tokens')
+        }
+
+    correct_index = task['correct_index']
+    option_probs = details.get('option_probs') or [None] * 4
+    votes = [None] * 4
+    predicted_choice_number = None
+    predicted_index = -1
+    is_correct = False
+    reasoning = ""
+
+    if details.get('samples') and not error:
+        votes, model_response_content = majority_vote(details['samples'])
+
+    if model_response_content and not error:
+         predicted_choice_number = parse_mcq_choice_number(model_response_content)
+         if predicted_choice_number is not None:
+             predicted_index = predicted_choice_number - 1
+             if correct_index != -1:
+                 is_correct = (predicted_index == correct_index)
+
+         if task.get('parse_reasoning', prompt_style == 'cot'):
+             reasoning_match = REASONING_PATTERN.search(model_response_content)
+             if reasoning_match:
+                 reasoning = reasoning_match.group(1).strip()
+             elif predicted_choice_number is None:
+                 reasoning = f"[Parse Error or No Final Answer] Full Response: {model_response_content}"
+
+         elif predicted_choice_number is None:
+             reasoning = f"[Parse Error] Full Response: {model_response_content}"
+
+    return {
+        'dialog_id': task['dialog_id'], 'turn_index': task['turn_index'], 'qa_question_index': None,
+        'task_type': task['task_type'], 'question': task['question'],
+        'agent_answer_raw': task['agent_answer_raw'], 'options': task['options'],
+        'correct_index': correct_index, 'predicted_index': predicted_index,
+        'predicted_choice': predicted_choice_number, 'is_correct': is_correct,
+        'model_response_full': model_response_content or "", 'model_reasoning': reasoning,
+        'response_time': response_time, 'prompt_tokens': p_tokens, 'completion_tokens': c_tokens,
+        'total_tokens': t_tokens, 'error_type': error, 'ground_truth_answer': None,
+        'prompt_style': prompt_style,
+        'full_prompt': task['prompt_text'], 'task_id': task['task_id'],
+        'cached_tokens': details.get('cached_tokens'),
+        'time_to_first_token': details.get('time_to_first_token'),
+        'time_to_answer': details.get('time_to_answer'),
+        'stream_stopped_early': details.get('stream_stopped_early'),
+        'prob_option_1': option_probs[0], 'prob_option_2': option_probs[1],
+        'prob_option_3': option_probs[2], 'prob_option_4': option_probs[3],
+        'vote_option_1': votes[0], 'vote_option_2': votes[1], 'vote_option_3': votes[2], 'vote_option_4': votes[3]
+    }
+
+
+def build_batch_results(task, model_response):
+    """Result rows of an MCQ_BATCH task: the response is split per turn and
+    every turn is scored by build_result as if it had been answered alone.
+    The tokens of the request are shared out over the rows (so they still
+    add up) and every row gets the latency of the whole request. Rows of a
+    response that did not answer every turn are flagged batch_partial."""
+    model_response_content, response_time, p_tokens, c_tokens, t_tokens, error, details = model_response
+    turns = task['batch']
+    numbers = [turn['history_position'] + 1 for turn in turns]
+    segments = split_batch_response(model_response_content, numbers) if model_response_content and not error else {}
+    parsed = sum(1 for segment in segments.values() if segment is not None)
+
+    def share(total, index):
+        if total is None:
+            return None
+        return total // len(turns) + (1 if index < total % len(turns) else 0)
+
+    results = []
+    for index, (turn, number) in enumerate(zip(turns, numbers)):
+        segment = segments.get(number)
+        turn_response = (segment, response_time, share(p_tokens, index), share(c_tokens, index), share(t_tokens, index),
+                         error, {'cached_tokens': share(details.get('cached_tokens'), index)})
+        result = build_result(turn, turn_response)
+        if segment is None and not error:
+            result['model_reasoning'] = f"[Parse Error: no answer for turn {number}] Full Response: {model_response_content}"
+        result['batch_size'] = len(turns)
+        result['batch_partial'] = parsed < len(turns)
+        results.append(result)
+    return results
+
+
+def build_results(task, model_response):
+    """The result rows of a task: one, or one per turn of an MCQ_BATCH task."""
+    if task['task_type'] == 'MCQ_BATCH':
+        return build_batch_results(task, model_response)
+    return [build_result(task, model_response)]
+
+
+async def dispatch_tasks_async(tasks, backend, max_concurrency, on_result, rate_limiter=None, response_cache=None, metrics=None):
+    """Sends tasks through the backend's async interface with at most
+    max_concurrency requests in flight and hands results to on_result in
+    task order.
+
+    Tasks are pulled from the generator lazily: a completed result is only
+    released once every earlier task has finished, and the reorder window is
+    capped so a slow request cannot make the queue grow without bound. A
+    rate_limiter can lower the number of requests in flight further while
+    the provider is returning rate limit errors.
+
+    Tasks built with the prefix prompt layout are chained per dialog: a
+    turn is only sent once the previous task of its dialog has completed, so
+    its prompt prefix is already in the provider's prompt cache. Other
+    dialogs fill the remaining slots, and the window is widened so enough
+    dialogs are open at once."""
+    semaphore = asyncio.Semaphore(max_concurrency)
+    window_size = max_concurrency * 4
+    dialog_tails = {}
+
+    async def run_task(task, previous=None):
+        queued_at = time.perf_counter()
+        if previous is not None:
+            await asyncio.wait([previous])
+        async with semaphore:
+            started_at = time.perf_counter()
+            model_response = await get_model_response_async(backend, task['messages'], task['config'], task['task_type'], rate_limiter, response_cache, metrics)
+        scored_at = time.perf_counter()
+        results = build_results(task, model_response)
+        if metrics is not None:
+            finished_at = time.perf_counter()
+            metrics.add_time('queue_wait', started_at - queued_at)
+            metrics.add_time('scoring', finished_at - scored_at)
+            for result in results:
+                metrics.task_finished(finished_at - started_at, result)
+        return task, results
+
+    def schedule(task):
+        if task.get('prompt_layout') != 'prefix':
+            return asyncio.ensure_future(run_task(task))
+        nonlocal window_size
+        window_size = max_concurrency * 16
+        dialog_key = (id(task['config']), task['dialog_id'])
+        future = asyncio.ensure_future(run_task(task, dialog_tails.get(dialog_key)))
+        dialog_tails[dialog_key] = future
+        return future
+
+    async def release(future):
+        task, results = await future
+        if task.get('prompt_layout') == 'prefix':
+            dialog_key = (id(task['config']), task['dialog_id'])
+            if dialog_tails.get(dialog_key) is future:
+                del dialog_tails[dialog_key]
+        write_start = time.perf_counter()
+        for result in results:
+            on_result(task, result)
+        if metrics is not None:
+            metrics.add_time('writing', time.perf_counter() - write_start)
+
+    window = deque()
+    for task in tasks:
+        window.append(schedule(task))
+        while window and (window[0].done() or len(window) >= window_size):
+            await release(window.popleft())
+    while window:
+        await release(window.popleft())
+
+
+def run_tasks(tasks, backend, max_concurrency, on_result, rate_limiter=None, response_cache=None, metrics=None):
+    """Runs tasks through the model backend one after another, or
+    concurrently when max_concurrency > 1, calling on_result(task, result)
+    in task order (once per result row, so several times for a batched
+    task). metrics, when given, records where the time goes."""
+    if metrics is not None:
+        tasks = metrics.timed_iter(tasks, 'task_build')
+    if max_concurrency > 1:
+        tqdm.write(f"Dispatching requests concurrently (max_concurrency={max_concurrency}).")
+
+        async def dispatch():
+            try:
+                await dispatch_tasks_async(tasks, backend, max_concurrency, on_result, rate_limiter, response_cache, metrics)
+            finally:
+                # the async connection pool belongs to this event loop
+                await backend.aclose()
+
+        asyncio.run(dispatch())
+        return
+    for task in tasks:
+        started_at = time.perf_counter()
+        model_response = get_model_response(backend, task['messages'], task['config'], task['task_type'], rate_limiter, response_cache, metrics)
+        scored_at = time.perf_counter()
+        results = build_results(task, model_response)
+        written_at = time.perf_counter()
+        for result in results:
+            on_result(task, result)
+        if metrics is not None:
+            metrics.add_time('scoring', written_at - scored_at)
+            metrics.add_time('writing', time.perf_counter() - written_at)
+            for result in results:
+                metrics.task_finished(written_at - started_at, result)
+
+
+def count_tasks(dialogs_data, current_config):
+    """Number of tasks a run over dialogs_data will walk, capped by max_iterations."""
+    max_iterations = current_config.get('max_iterations', float('inf'))
+    total_estimated_iterations = 0
+    for dialog in dialogs_data:
+        total_estimated_iterations += len(dialog.get('dialog', []))
+        total_estimated_iterations += len(dialog.get('question', []))
+    return min(max_iterations, total_estimated_iterations)
 
-    Answer:"""
-            else:
-                qa_prompt_text = f"""Based on the conversation history provided below and the question: First provide step-by-step reasoning to determine the answer to the question about the conversation and then write down your answer.
 
-    Conversation History:
-    {full_dialog_history_text}
-    Question: {qa_question}
+def process_dialogs(dialogs_data, current_config, start_iteration, backend, result_writer, rate_limiter=None, response_cache=None, skip_task_ids=None, metrics=None):
+    """Processes all dialogs and tasks, streaming each result row to
+    result_writer as soon as it is available. Returns the number of
+    results written. Tasks listed in skip_task_ids (from the journal of a
+    resumed run) are skipped.
 
-    Answer:"""
+    With execution.max_concurrency > 1, requests are dispatched
+    concurrently; results are still written in dialog/turn order."""
+
+    written = 0
+    prompt_style = current_config.get('model', {}).get('prompt_style', 'cot').lower()
+    max_concurrency = current_config.get('execution', {}).get('max_concurrency', 1)
+    start_iteration_0_based = max(0, start_iteration - 1)
+    print(f"--- Start Iteration Info ---")
+    print(f"Command line start_iteration (1-based): {start_iteration}")
+    print(f"Effective start index (0-based): {start_iteration_0_based}")
+    print(f"Tasks will be processed starting from index {start_iteration_0_based}.")
+    print(f"--------------------------")
 
-            messages = [{"role": "user", "content": qa_prompt_text}]
+    effective_max_iterations = count_tasks(dialogs_data, current_config)
 
-            model_response_content, response_time, p_tokens, c_tokens, t_tokens, error = get_model_response(openai_client, messages, current_config, task_type)
+    progress_bar = tqdm(total=effective_max_iterations, desc=f"Processing Tasks ({prompt_style})", unit="task")
+    tasks = iter_dialog_tasks(dialogs_data, current_config, start_iteration, effective_max_iterations, progress_bar, skip_task_ids)
 
-            result = {
-                'dialog_id': dialog_id, 'turn_index': None, 'qa_question_index': qa_index,
-                'task_type': task_type, 'question': qa_question, 'agent_answer_raw': None,
-                'options': None, 'correct_index': None, 'predicted_index': None,
-                'predicted_choice': None, 'is_correct': None,
-                'model_response_full': model_response_content or "", 'model_reasoning': None,
-                'response_time': response_time, 'prompt_tokens': p_tokens, 'completion_tokens': c_tokens,
-                'total_tokens': t_tokens, 'error_type': error, 'ground_truth_answer': qa_ground_truth,
-                'prompt_style': 'qa', 
-                'qa_full_prompt': qa_prompt_text
-            }
-            results.append(result)
-            progress_bar.set_postfix_str(f"Dialog {dialog_id}, QA Task {qa_index}")
-    
-        if iterations > 0 and iterations % current_config.get('save_interval', 100) == 0:
-            try:
-                interim_df = pd.DataFrame(results)
-                interim_df = pd.DataFrame(results) 
-                interim_filename = os.path.join(results_dir, f'interim_results_{iterations}.csv')
-                interim_df.to_csv(interim_filename, index=False, encoding='utf-8')
-                tqdm.write(f"Interim results saved to {interim_filename} ({iterations} tasks processed).")
-            except Exception as e:
-                 tqdm.write(f"Warning: Could not save interim results at iteration {iterations}. Error: {e}")
+    def on_result(task, result):
+        nonlocal written
+        result_writer.write(result)
+        written += 1
 
+    run_tasks(tasks, backend, max_concurrency, on_result, rate_limiter, response_cache, metrics)
 
+    iterations = progress_bar.n
     progress_bar.close()
+    if rate_limiter is not None:
+        print(f"Rate limiter: {rate_limiter.summary()}")
+    if response_cache is not None:
+        print(f"Response cache: {response_cache.summary()}")
     if iterations < effective_max_iterations:
          print(f"\nWarning: Processing stopped after {iterations} iterations (max_iterations might be set or loop ended early).")
     elif iterations == 0:
          print("\nWarning: No tasks were processed. Check data file and max_iterations setting.")
 
-    return results
+    return written
@@ -1,31 +1,32 @@
 import argparse
-import pandas as pd
 import os
 import sys
 import traceback
 import shutil
-import re
-from openai import OpenAI
 
 from config_loader import load_config
-from data_handler import load_data_from_json
+from data_handler import extract_type_code
+from dataset_index import load_index
 from evaluation_processor import process_dialogs
-
-def extract_type_code(filename: str) -> str:
-    '''extracts which implicature type is in the current JSON file based on the two-letter combination in the file name'''
-    match = re.search(r'impl_dial_v0\.1_([a-z]{2})\.json$', filename, re.IGNORECASE)
-    if match:
-        return match.group(1).lower()
-    else:
-        print(f"Warning: Could not extract type code from filename '{filename}'. Using 'unknown_type'.")
-        return "unknown_type"
+from backends import create_backend
+from rate_limiter import build_rate_limiter
+from response_cache import build_response_cache
+from metrics import build_metrics
+from prompt_builder import resolve_prompt_layout, effective_turn_batch
+from result_writer import open_result_writer
+from sweep_runner import run_sweep
+from batch_jobs import export_batch, import_batch
+from report import write_report
+from sharding import parse_shard, shard_suffix
 
 def run_evaluation(config_path: str, args: argparse.Namespace):
     '''loads the configuration, handles command-line arguments (especially
     output directory and start iteration), sets up the output directory
-    (handling overwrites), loads data, initializes the OpenAI client,
-    runs the dialogue processing, saves the results into separate MCQ and
-    QA CSV files'''
+    (handling overwrites), creates the model backend, loads data,
+    runs the dialogue processing and streams the results into separate MCQ
+    and QA CSV files (appending to them when resuming with start iteration).
+    configs with a sweep section are handed to run_sweep instead. a summary
+    of the run metrics is printed at the end'''
     
     print("--- Starting Evaluation ---")
     try:
@@ -45,7 +46,9 @@ def run_evaluation(config_path: str, args: argparse.Namespace):
         print(f"Using output directory from config file: {results_dir}")
 
     overwrite = config.get('output', {}).get('overwrite', False)
-    if overwrite and os.path.exists(results_dir):
+    if overwrite and args.resume:
+        print("Resuming: ignoring output.overwrite so the existing results are kept.")
+    elif overwrite and os.path.exists(results_dir):
         print(f"Overwriting existing directory: {results_dir}")
         try:
             shutil.rmtree(results_dir)
@@ -58,12 +61,44 @@ def run_evaluation(config_path: str, args: argparse.Namespace):
         print(f"Error creating directory {results_dir}: {e}")
         return
 
+    try:
+        max_concurrency = config.get('execution', {}).get('max_concurrency', 1)
+        backend = create_backend(config, max_concurrency, replay=args.replay)
+        rate_limiter = build_rate_limiter(config)
+        response_cache = build_response_cache(config, replay=args.replay)
+        metrics = build_metrics(config)
+        print(f"Model backend '{backend.name}' initialized successfully for main_runner.")
+    except ValueError as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    except Exception as e:
+        print(f"Could not initialize the model backend for main_runner: {e}")
+        sys.exit(1)
+
+    if config.get('sweep'):
+        if args.start_iteration > 1:
+            print("Error: --start_iteration is not supported in sweep mode, use --resume instead.")
+            return
+        try:
+            run_sweep(config, args, results_dir, backend, rate_limiter, response_cache, metrics)
+        except Exception as e:
+            print(f"\nAn unexpected error occurred during the sweep : {str(e)}")
+            traceback.print_exc()
+        finally:
+            backend.close()
+            if response_cache is not None:
+                response_cache.close()
+            metrics.close()
+            print(metrics.summary_table())
+        write_run_report(config, results_dir)
+        return
+
     try:
         data_path = config.get('data', {}).get('path', None)
         if not data_path:
             print("Error: Data path not specified in the configuration file.")
             return
-        dialogs_data = load_data_from_json(data_path)
+        dataset = load_index(data_path, config.get('data', {}).get('index_dir'))
     except SystemExit:
         return
     except Exception as e:
@@ -78,78 +113,125 @@ def run_evaluation(config_path: str, args: argparse.Namespace):
         if prompt_style == 'unknown_style':
             print("Warning: 'prompt_style' not found in config. Using 'unknown_style' in filename.")
         base_prefix = f"{type_code}_{prompt_style}"
+        if resolve_prompt_layout(config) == 'prefix':
+            base_prefix += "_prefix"
+        if effective_turn_batch(config) is not None:
+            base_prefix += "_batch"
         print(f"Using base prefix for output files: {base_prefix}")
     except Exception as e:
         print(f"Error determining file prefix: {e}. Using default prefix 'default'.")
+        type_code = "unknown_type"
         base_prefix = "default"
+    config['type_code'] = type_code
 
-    try:
-        api_key_main = os.environ.get("OPENAI_API_KEY")
-        if not api_key_main:
-            print("ERROR: The environment variable OPENAI_API_KEY is not set for main_runner.py.")
-            sys.exit(1) 
-        openai_client_main = OpenAI(api_key=api_key_main)
-        print("OpenAI client initialized successfully for main_runner.")
-    except Exception as e:
-        print(f"Could not initialize OpenAI client for main_runner: {e}")
-        sys.exit(1)
+    positions = None
+    if args.shard:
+        shard_index, shard_count = parse_shard(args.shard)
+        positions = dataset.select_shard(shard_index, shard_count)
+        base_prefix += shard_suffix(shard_index, shard_count)
+        print(f"Shard {shard_index}/{shard_count}: {len(positions)} dialogs, output prefix {base_prefix}")
 
     print(f"--- Processing Dialogs (Style: {prompt_style}) ---")
     try:
         start_iteration_arg = args.start_iteration
         print(f"Starting evaluation from iteration (task number): {start_iteration_arg}")
 
-        results_list = process_dialogs(
-            dialogs_data=dialogs_data,
-            current_config=config,
-            results_dir=results_dir,
-            start_iteration=start_iteration_arg,
-            openai_client=openai_client_main
+        save_interval = config.get('save_interval', 100)
+        result_writer, completed_task_ids = open_result_writer(
+            results_dir, base_prefix, resume=args.resume,
+            append=start_iteration_arg > 1, fsync_interval=save_interval,
+            output_config=config.get('output')
         )
+        dialogs_data = dataset.load_dialogs(positions, config, completed_task_ids)
+        with result_writer:
+            results_written = process_dialogs(
+                dialogs_data=dialogs_data,
+                current_config=config,
+                start_iteration=start_iteration_arg,
+                backend=backend,
+                result_writer=result_writer,
+                rate_limiter=rate_limiter,
+                response_cache=response_cache,
+                skip_task_ids=completed_task_ids,
+                metrics=metrics
+            )
 
-        if not results_list:
+        if not results_written:
             print("Warning: No results were generated from dialog processing.")
-        results_df = pd.DataFrame(results_list)
-        print(f"--- Processing Complete ({len(results_list)} tasks processed after start iteration) ---")
-
-        print("--- Saving Results ---")
-        mcq_results_df = results_df[results_df['task_type'] == 'MCQ'].copy()
-        qa_results_df = results_df[results_df['task_type'] == 'QA'].copy()
-
-        mcq_filename = os.path.join(results_dir, f"{base_prefix}_mcq_results.csv")
-        qa_filename = os.path.join(results_dir, f"{base_prefix}_qa_results.csv")
-
-        save_error = False
-        if not mcq_results_df.empty:
-            try:
-                mcq_results_df.to_csv(mcq_filename, index=False, encoding='utf-8')
-                print(f"MCQ results saved to: {mcq_filename}")
-            except Exception as e:
-                print(f"Error saving MCQ results to {mcq_filename}: {e}")
-                save_error = True
-        else:
-            print("No MCQ results generated to save.")
-
-        if not qa_results_df.empty:
-            try:
-                qa_results_df.to_csv(qa_filename, index=False, encoding='utf-8')
-                print(f"QA results saved to: {qa_filename}")
-            except Exception as e:
-                print(f"Error saving QA results to {qa_filename}: {e}")
-                save_error = True
-        else:
-            print("No QA results generated to save.")
+        print(f"--- Processing Complete ({results_written} tasks processed after start iteration) ---")
 
-        if save_error:
-            print("Warning: One or more errors occurred during file saving.")
+        for task_type in ('MCQ', 'QA'):
+            if result_writer.counts[task_type]:
+                print(f"{task_type} results saved to: {result_writer.paths[task_type]} ({result_writer.counts[task_type]} rows)")
+            else:
+                print(f"No {task_type} results generated to save.")
 
     except Exception as e:
         print(f"\nAn unexpected error occurred during processing : {str(e)}")
         traceback.print_exc()
+    finally:
+        backend.close()
+        if response_cache is not None:
+            response_cache.close()
+        metrics.close()
+        print(metrics.summary_table())
+    write_run_report(config, results_dir)
+
+
+def write_run_report(config: dict, results_dir: str):
+    '''with output.report set, writes report.json and report.md comparing
+    all result files in the output directory'''
+    if not config.get('output', {}).get('report', False):
+        return
+    try:
+        write_report([results_dir], os.path.join(results_dir, 'report'))
+    except Exception as e:
+        print(f"Could not write the results report: {e}")
+        traceback.print_exc()
+
+
+def run_batch_command(config_path: str, args: argparse.Namespace):
+    '''export-batch writes the requests of the configuration (one run or a
+    whole sweep) as batch API input files, import-batch turns the result
+    files of the finished batch job into the normal result files'''
+    try:
+        config = load_config(config_path)
+        config['loaded_config_path'] = config_path
+    except SystemExit:
+        return
+
+    results_dir = args.output_dir or config.get('output', {}).get('directory', './results')
+    batch_dir = args.batch_dir or os.path.join(results_dir, 'batch')
+    try:
+        os.makedirs(results_dir, exist_ok=True)
+    except OSError as e:
+        print(f"Error creating directory {results_dir}: {e}")
+        return
+
+    try:
+        if args.command == 'export-batch':
+            export_batch(config, args, results_dir, batch_dir)
+        else:
+            import_batch(config, args, results_dir, batch_dir, args.batch_results)
+    except Exception as e:
+        print(f"\nAn unexpected error occurred during {args.command}: {str(e)}")
+        traceback.print_exc()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Run evaluation pipeline with a specified configuration file.")
+    parser.add_argument(
+        'command',
+        nargs='?',
+        default='run',
+        choices=['run', 'export-batch', 'import-batch'],
+        help='run (default) sends the requests; export-batch writes them as batch API input files; import-batch reads the result files of a batch job.'
+    )
+    parser.add_argument(
+        'batch_results',
+        nargs='*',
+        help='import-batch: the batch result (and error) JSONL files to import.'
+    )
     parser.add_argument(
         '--config',
         type=str,
@@ -168,6 +250,28 @@ if __name__ == "__main__":
         default=1,
         help='The iteration number (task number) to start processing from (1-based index). Must be 1 or greater.'
     )
+    parser.add_argument(
+        '--replay',
+        action='store_true',
+        help='Answer every request from the response cache (cache.path in the config) without calling the API. Uncached requests are saved as errors.'
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue an earlier run from its task journal: finished tasks are skipped and tasks that ended with an error are run again.'
+    )
+    parser.add_argument(
+        '--shard',
+        type=str,
+        default=None,
+        help='Only process shard i of N (e.g. 2/4). Dialogs are assigned to shards by dialog_id; merge the shard outputs with merge_shards.py.'
+    )
+    parser.add_argument(
+        '--batch_dir',
+        type=str,
+        default=None,
+        help='Directory of the batch input files and manifest (default: <output directory>/batch).'
+    )
     args = parser.parse_args()
 
     config_to_run = args.config
@@ -179,8 +283,34 @@ if __name__ == "__main__":
         print("Error: --start_iteration must be 1 or greater.")
         sys.exit(1)
 
+    if args.shard:
+        try:
+            parse_shard(args.shard)
+        except ValueError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+
+    if args.resume and args.start_iteration > 1:
+        print("Error: --resume and --start_iteration cannot be combined.")
+        sys.exit(1)
+
+    if args.command != 'run' and args.start_iteration > 1:
+        print(f"Error: --start_iteration is not supported by {args.command}, use --resume instead.")
+        sys.exit(1)
+
+    if args.command == 'import-batch' and not args.batch_results:
+        print("Error: import-batch needs the batch result file(s) to import.")
+        sys.exit(1)
+
+    if args.command != 'import-batch' and args.batch_results:
+        print(f"Error: unexpected arguments {' '.join(args.batch_results)}")
+        sys.exit(1)
+
     try:
-        run_evaluation(config_to_run, args)
+        if args.command == 'run':
+            run_evaluation(config_to_run, args)
+        else:
+            run_batch_command(config_to_run, args)
     except KeyboardInterrupt:
         print("\nRun interrupted by user.")
         sys.exit(0)
@@ -0,0 +1,140 @@
+import argparse
+import glob
+import os
+import re
+import sys
+
+import pandas as pd
+
+from dataset_index import load_index
+from result_writer import RESULT_COLUMNS
+from results_store import ParquetResultWriter, load_results
+
+
+def find_shard_files(results_dir, base_prefix, task_type):
+    '''returns {shard_index: path} and the shard count for one task type.
+    a shard's results are a CSV file or, with output.format: parquet, a
+    directory of parquet parts'''
+    pattern = os.path.join(results_dir, f"{base_prefix}_shard*of*_{task_type}_results*")
+    shard_files = {}
+    shard_counts = set()
+    formats = set()
+    for path in glob.glob(pattern):
+        match = re.search(r'_shard(\d+)of(\d+)_' + task_type + r'_results(\.csv)?$', path)
+        if match and (match.group(3) or os.path.isdir(path)):
+            shard_files[int(match.group(1))] = path
+            shard_counts.add(int(match.group(2)))
+            formats.add('csv' if match.group(3) else 'parquet')
+    if len(shard_counts) > 1:
+        raise ValueError(f"Shard files of {base_prefix} were written with different shard counts: {sorted(shard_counts)}")
+    if len(formats) > 1:
+        raise ValueError(f"Shard results of {base_prefix} were written both as CSV and as parquet.")
+    return shard_files, (shard_counts.pop() if shard_counts else 0)
+
+
+def read_shard(path):
+    '''reads a shard's results with every value as a string, the way a
+    result CSV is read. the prompts of a parquet shard are joined back into
+    full_prompt or qa_full_prompt'''
+    if path.endswith('.csv'):
+        return pd.read_csv(path, dtype=str, keep_default_na=False)
+    frame = load_results(path, with_prompts=True)
+    prompt_column = 'qa_full_prompt' if path.rstrip('/\\').endswith('_qa_results') else 'full_prompt'
+    frame[prompt_column] = frame.pop('prompt_text')
+    frame['options'] = frame['options'].map(lambda options: str(list(options)) if options is not None else None)
+    frame = frame.drop(columns=['prompt_hash']).astype(object)
+    frame = frame.where(frame.notna(), None).map(lambda value: '' if value is None else str(value))
+    return frame[[column for column in RESULT_COLUMNS if column in frame.columns]]
+
+
+def merge_shard_results(shard_files, dialog_order=None):
+    '''concatenates shard result files, drops duplicate tasks and restores
+    the dataset order. when a task appears more than once, a row without an
+    error wins over one with an error, and later shards win over earlier
+    ones. returns (merged_df, duplicate_count, conflicting_count)'''
+    frames = []
+    for shard_index in sorted(shard_files):
+        frame = read_shard(shard_files[shard_index])
+        frame['_shard'] = shard_index
+        frames.append(frame)
+    merged = pd.concat(frames, ignore_index=True)
+    if merged.empty:
+        return merged.drop(columns=['_shard']), 0, 0
+
+    if 'task_id' in merged.columns and (merged['task_id'] != '').all():
+        key_columns = ['task_id']
+    else:
+        key_columns = ['dialog_id', 'turn_index', 'qa_question_index']
+
+    merged['_has_error'] = merged['error_type'] != ''
+    merged['_row'] = range(len(merged))
+    merged = merged.sort_values(['_has_error', '_shard', '_row'], ascending=[False, True, True])
+    duplicated = merged.duplicated(subset=key_columns, keep=False)
+    conflicting = 0
+    if duplicated.any():
+        answers = merged.loc[duplicated & ~merged['_has_error']]
+        conflicting = int((answers.groupby(key_columns)['model_response_full'].nunique() > 1).sum())
+    duplicate_count = int(merged.duplicated(subset=key_columns, keep='last').sum())
+    merged = merged.drop_duplicates(subset=key_columns, keep='last')
+
+    dialog_key = merged['dialog_id']
+    if dialog_order is not None:
+        dialog_key = dialog_key.map(dialog_order)
+    else:
+        dialog_key = pd.to_numeric(dialog_key, errors='coerce')
+    merged['_dialog'] = dialog_key
+    merged['_turn'] = pd.to_numeric(merged['turn_index'], errors='coerce')
+    merged['_qa'] = pd.to_numeric(merged['qa_question_index'], errors='coerce')
+    merged = merged.sort_values(['_dialog', 'dialog_id', '_turn', '_qa'], kind='stable')
+    merged = merged.drop(columns=['_shard', '_has_error', '_row', '_dialog', '_turn', '_qa'])
+    return merged, duplicate_count, conflicting
+
+
+def merge_shards(results_dir, base_prefix, data_path=None):
+    '''merges {prefix}_shardIofN_{mcq,qa}_results.csv into the canonical
+    {prefix}_{mcq,qa}_results.csv files, or parquet shard directories into
+    the {prefix}_{mcq,qa}_results/ parquet store'''
+    dialog_order = None
+    if data_path:
+        dialog_order = load_index(data_path).dialog_order()
+
+    parquet_rows = []
+    for task_type in ('mcq', 'qa'):
+        shard_files, shard_count = find_shard_files(results_dir, base_prefix, task_type)
+        if not shard_files:
+            print(f"No {task_type.upper()} shard files found for {base_prefix} in {results_dir}.")
+            continue
+        missing = sorted(set(range(1, shard_count + 1)) - set(shard_files))
+        if missing:
+            print(f"Warning: {task_type.upper()} results of shard(s) {missing} of {shard_count} are missing, the merged file is incomplete.")
+
+        merged, duplicate_count, conflicting = merge_shard_results(shard_files, dialog_order)
+        if duplicate_count:
+            print(f"Dropped {duplicate_count} duplicate {task_type.upper()} rows ({conflicting} tasks had differing responses).")
+        if not next(iter(shard_files.values())).endswith('.csv'):
+            parquet_rows.extend(merged.to_dict('records'))
+            output_path = os.path.join(results_dir, f"{base_prefix}_{task_type}_results")
+        else:
+            output_path = os.path.join(results_dir, f"{base_prefix}_{task_type}_results.csv")
+            merged.to_csv(output_path, index=False, encoding='utf-8')
+        print(f"Merged {len(shard_files)} shard files into {output_path} ({len(merged)} rows).")
+
+    if parquet_rows:
+        # both task types share the prompts side table, so they are written together
+        with ParquetResultWriter(results_dir, base_prefix) as writer:
+            for row in parquet_rows:
+                writer.write(row)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Merge the result files written by main_runner.py --shard i/N into the canonical MCQ/QA result files.")
+    parser.add_argument('--results_dir', '-o', type=str, default='results', help='Directory containing the shard result files or parquet directories (default: results)')
+    parser.add_argument('--prefix', type=str, required=True, help='Output prefix of the run, e.g. cb_cot')
+    parser.add_argument('--data', type=str, default=None, help='Optional dataset JSON, used to restore the original dialog order instead of sorting by dialog_id')
+    args = parser.parse_args()
+
+    try:
+        merge_shards(args.results_dir, args.prefix, args.data)
+    except (ValueError, ImportError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
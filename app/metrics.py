@@ -0,0 +1,305 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# log-spaced latency buckets from 1 ms to ~5 minutes (each 25% wider than the
+# last), fine enough for percentile estimates within a few percent
+LATENCY_BUCKETS = tuple(0.001 * 1.25 ** i for i in range(57))
+
+# phases of a task, in the order they happen
+PHASES = ('task_build', 'queue_wait', 'rate_limit_wait', 'network', 'scoring', 'writing')
+PHASE_LABELS = {
+    'task_build': 'task building', 'queue_wait': 'queue wait', 'rate_limit_wait': 'rate limit wait',
+    'network': 'network', 'scoring': 'scoring', 'writing': 'writing'
+}
+
+
+class Histogram:
+    '''fixed-bucket histogram of durations in seconds'''
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, fraction):
+        '''estimates a quantile by interpolating inside its bucket'''
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            if bucket_count and seen + bucket_count >= target:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return min(self.max, lower + (upper - lower) * (target - seen) / bucket_count)
+            seen += bucket_count
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count, 'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.50), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99),
+            'max': self.max if self.count else None
+        }
+
+
+class RunMetrics:
+    '''counters, phase timers and latency histograms of an evaluation run.
+    all durations come from time.perf_counter. phase totals are summed over
+    tasks, so with concurrent requests they can add up to more than the
+    wall time. with json_path the snapshot is rewritten every
+    flush_interval seconds, and with prometheus_port it is served as
+    Prometheus text on http://127.0.0.1:<port>/metrics'''
+
+    def __init__(self, json_path=None, flush_interval=10.0, prometheus_port=None):
+        self.json_path = json_path
+        self.flush_interval = flush_interval
+        self.prometheus_port = prometheus_port
+        self.lock = threading.Lock()
+        self.start_time = time.perf_counter()
+        self.counters = defaultdict(int)
+        self.errors_by_type = defaultdict(int)
+        self.phase_seconds = defaultdict(float)
+        self.phase_counts = defaultdict(int)
+        self.histograms = {'request_latency': Histogram(), 'task_latency': Histogram(),
+                           'time_to_first_token': Histogram(), 'time_to_answer': Histogram()}
+        self.in_flight = 0
+        self._stop = threading.Event()
+        self._flusher = None
+        self._server = None
+
+    def start(self):
+        '''starts the periodic JSON flush and the Prometheus endpoint'''
+        if self.json_path and self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+        if self.prometheus_port and self._server is None:
+            try:
+                self._server = ThreadingHTTPServer(('127.0.0.1', self.prometheus_port), _PrometheusHandler)
+            except OSError as e:
+                print(f"Warning: Could not serve metrics on port {self.prometheus_port}: {e}")
+                return self
+            self._server.daemon_threads = True
+            self._server.metrics = self
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+            print(f"Serving metrics on http://127.0.0.1:{self.prometheus_port}/metrics")
+        return self
+
+    def close(self):
+        self._stop.set()
+        if self._flusher is not None:
+            self._flusher.join()
+            self._flusher = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.flush()
+
+    def add_time(self, phase, seconds):
+        with self.lock:
+            self.phase_seconds[phase] += seconds
+            self.phase_counts[phase] += 1
+
+    def count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def request_started(self):
+        with self.lock:
+            self.in_flight += 1
+
+    def request_finished(self, seconds, usage=None, details=None):
+        '''records one successful API call. details are the extra result
+        fields of the response (cached_tokens and, for streamed responses,
+        time_to_first_token, time_to_answer and stream_stopped_early)'''
+        details = details or {}
+        with self.lock:
+            self.in_flight -= 1
+            self.counters['requests'] += 1
+            self.phase_seconds['network'] += seconds
+            self.phase_counts['network'] += 1
+            self.histograms['request_latency'].observe(seconds)
+            if usage is not None:
+                self.counters['prompt_tokens'] += usage.prompt_tokens or 0
+                self.counters['completion_tokens'] += usage.completion_tokens or 0
+            if details.get('cached_tokens'):
+                self.counters['cached_tokens'] += details['cached_tokens']
+            for name in ('time_to_first_token', 'time_to_answer'):
+                if details.get(name) is not None:
+                    self.histograms[name].observe(details[name])
+            if details.get('stream_stopped_early'):
+                self.counters['streams_stopped_early'] += 1
+
+    def request_failed(self, seconds, error, retried):
+        '''records a failed API call, by exception type'''
+        with self.lock:
+            self.in_flight -= 1
+            self.counters['requests'] += 1
+            self.counters['request_errors'] += 1
+            if retried:
+                self.counters['retries'] += 1
+            self.phase_seconds['network'] += seconds
+            self.phase_counts['network'] += 1
+            self.errors_by_type[type(error).__name__] += 1
+
+    def task_finished(self, seconds, result):
+        with self.lock:
+            self.counters['tasks_error' if result['error_type'] else 'tasks_ok'] += 1
+            self.histograms['task_latency'].observe(seconds)
+
+    def timed_iter(self, iterable, phase='task_build'):
+        '''yields from iterable, adding the time spent producing each item
+        to phase'''
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.add_time(phase, time.perf_counter() - start)
+            yield item
+
+    def snapshot(self):
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            tasks = self.counters['tasks_ok'] + self.counters['tasks_error']
+            tokens = self.counters['prompt_tokens'] + self.counters['completion_tokens']
+            return {
+                'updated_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'elapsed_seconds': elapsed,
+                'tasks': {'ok': self.counters['tasks_ok'], 'error': self.counters['tasks_error'],
+                          'per_second': tasks / elapsed if elapsed else None},
+                'requests': {'sent': self.counters['requests'], 'errors': self.counters['request_errors'],
+                             'retries': self.counters['retries'], 'cache_hits': self.counters['cache_hits'],
+                             'stopped_early': self.counters['streams_stopped_early'], 'in_flight': self.in_flight},
+                'tokens': {'prompt': self.counters['prompt_tokens'], 'completion': self.counters['completion_tokens'],
+                           'cached': self.counters['cached_tokens'], 'per_second': tokens / elapsed if elapsed else None},
+                'errors_by_type': dict(self.errors_by_type),
+                'phases': {phase: {'seconds': self.phase_seconds[phase], 'count': self.phase_counts[phase]} for phase in PHASES},
+                'latency': {name: histogram.snapshot() for name, histogram in self.histograms.items()}
+            }
+
+    def flush(self):
+        '''writes the snapshot to json_path (atomically, so readers never see
+        a half-written file)'''
+        if not self.json_path:
+            return
+        try:
+            with open(self.json_path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.snapshot(), f, indent=2)
+            os.replace(self.json_path + '.tmp', self.json_path)
+        except OSError as e:
+            print(f"Warning: Could not write metrics to {self.json_path}: {e}")
+
+    def _flush_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append(f"# HELP grice_{name} {help_text}")
+            lines.append(f"# TYPE grice_{name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"grice_{name}{labels} {value}")
+
+        metric('tasks_total', 'counter', 'Finished tasks by status.',
+               [('{status="ok"}', snapshot['tasks']['ok']), ('{status="error"}', snapshot['tasks']['error'])])
+        metric('requests_total', 'counter', 'API requests sent.', [('', snapshot['requests']['sent'])])
+        metric('request_retries_total', 'counter', 'API requests that were retried.', [('', snapshot['requests']['retries'])])
+        metric('cache_hits_total', 'counter', 'Responses answered from the response cache.', [('', snapshot['requests']['cache_hits'])])
+        metric('streams_stopped_early_total', 'counter', 'Streamed responses closed once the answer was parsed.', [('', snapshot['requests']['stopped_early'])])
+        metric('requests_in_flight', 'gauge', 'API requests currently in flight.', [('', snapshot['requests']['in_flight'])])
+        metric('tokens_total', 'counter', 'Tokens reported by the API.',
+               [('{kind="prompt"}', snapshot['tokens']['prompt']), ('{kind="completion"}', snapshot['tokens']['completion'])])
+        metric('cached_prompt_tokens_total', 'counter', "Prompt tokens served from the provider's prompt cache.", [('', snapshot['tokens']['cached'])])
+        metric('request_errors_total', 'counter', 'Failed API requests by exception type.',
+               [(f'{{type="{error_type}"}}', count) for error_type, count in sorted(snapshot['errors_by_type'].items())])
+        metric('phase_seconds_total', 'counter', 'Time spent per task phase, summed over tasks.',
+               [(f'{{phase="{phase}"}}', values['seconds']) for phase, values in snapshot['phases'].items()])
+        with self.lock:
+            for name, histogram in self.histograms.items():
+                lines.append(f"# HELP grice_{name}_seconds Latency histogram.")
+                lines.append(f"# TYPE grice_{name}_seconds histogram")
+                cumulative = 0
+                for upper, bucket_count in zip(histogram.buckets, histogram.counts):
+                    cumulative += bucket_count
+                    lines.append(f'grice_{name}_seconds_bucket{{le="{upper:.6g}"}} {cumulative}')
+                lines.append(f'grice_{name}_seconds_bucket{{le="+Inf"}} {histogram.count}')
+                lines.append(f"grice_{name}_seconds_sum {histogram.sum}")
+                lines.append(f"grice_{name}_seconds_count {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary_table(self):
+        '''end-of-run summary for the console'''
+        snapshot = self.snapshot()
+        tasks = snapshot['tasks']['ok'] + snapshot['tasks']['error']
+        requests = snapshot['requests']
+        lines = [
+            "--- Run Metrics ---",
+            f"Elapsed {snapshot['elapsed_seconds']:.1f}s, {tasks} tasks ({snapshot['tasks']['per_second'] or 0:.2f} tasks/sec), {snapshot['tasks']['error']} with errors",
+            f"Requests: {requests['sent']} sent, {requests['errors']} failed, {requests['retries']} retried, {requests['cache_hits']} cache hits"
+            + (f", {requests['stopped_early']} streams stopped early" if requests['stopped_early'] else ""),
+            f"Tokens: {snapshot['tokens']['prompt']} prompt, {snapshot['tokens']['completion']} completion ({snapshot['tokens']['per_second'] or 0:.1f} tokens/sec)"
+        ]
+        if snapshot['tokens']['cached']:
+            share = snapshot['tokens']['cached'] / snapshot['tokens']['prompt'] * 100 if snapshot['tokens']['prompt'] else 0.0
+            lines.append(f"Prompt cache: {snapshot['tokens']['cached']} prompt tokens served from the provider's cache ({share:.1f}%)")
+        if snapshot['errors_by_type']:
+            lines.append("Errors: " + ", ".join(f"{error_type} {count}" for error_type, count in sorted(snapshot['errors_by_type'].items())))
+        lines.append(f"{'Phase':<18}{'total s':>10}{'count':>9}{'mean ms':>10}")
+        for phase in PHASES:
+            values = snapshot['phases'][phase]
+            if values['count']:
+                lines.append(f"{PHASE_LABELS[phase]:<18}{values['seconds']:>10.2f}{values['count']:>9}{values['seconds'] / values['count'] * 1000:>10.2f}")
+        lines.append(f"{'Latency':<18}{'count':>10}{'p50 ms':>9}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+        for name, values in snapshot['latency'].items():
+            if values['count']:
+                lines.append(f"{name.replace('_', ' '):<18}{values['count']:>10}{values['p50'] * 1000:>9.1f}{values['p95'] * 1000:>10.1f}{values['p99'] * 1000:>10.1f}{values['max'] * 1000:>10.1f}")
+        return "\n".join(lines)
+
+
+class _PrometheusHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip('/') not in ('', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.metrics.prometheus_text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def build_metrics(config):
+    '''creates the RunMetrics of a run from the optional metrics section:
+    path (JSON file rewritten every flush_interval seconds),
+    flush_interval (default 10) and prometheus_port'''
+    metrics_config = config.get('metrics') or {}
+    return RunMetrics(
+        json_path=metrics_config.get('path'),
+        flush_interval=metrics_config.get('flush_interval', 10),
+        prometheus_port=metrics_config.get('prometheus_port')
+    ).start()
@@ -0,0 +1,233 @@
+import argparse
+import json
+import math
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from canned_replies import canned_response, completion_body, completion_chunks, estimate_prompt_tokens, request_prompt_text
+
+
+class MockSettings:
+    '''behaviour of the mock server. latency_ms is the median latency of a
+    response; latency_dist is one of fixed, uniform (0.5x-1.5x), lognormal
+    (spread set by latency_sigma) or exponential. error_rate and
+    rate_limit_rate are the fractions of requests answered with a 500 and a
+    429 (with a retry-after-ms header) respectively. with prompt_cache the
+    server imitates provider prompt caching: prompt prefixes of completed
+    requests are remembered in blocks of CACHE_BLOCK_CHARS characters and
+    reported as usage.prompt_tokens_details.cached_tokens. token_ms is the
+    generation time per word after the first: streamed responses (stream:
+    true) send one word per chunk token_ms apart, other responses are
+    delayed by the time the whole reply would have taken. with a temperature
+    above 0 each choice picks the prompt's answer 60% of the time and a
+    random option otherwise; ignore_n imitates providers that return a
+    single choice whatever n is'''
+
+    CACHE_BLOCK_CHARS = 512
+
+    def __init__(self, latency_ms=50.0, latency_dist='fixed', latency_sigma=0.5,
+                 error_rate=0.0, rate_limit_rate=0.0, retry_after_ms=200, answer=None, seed=None, prompt_cache=False,
+                 token_ms=0.0, ignore_n=False):
+        if latency_dist not in ('fixed', 'uniform', 'lognormal', 'exponential'):
+            raise ValueError(f"Unknown latency distribution '{latency_dist}', expected fixed, uniform, lognormal or exponential.")
+        self.latency_ms = latency_ms
+        self.latency_dist = latency_dist
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.answer = answer
+        self.prompt_cache = prompt_cache
+        self.token_ms = token_ms
+        self.ignore_n = ignore_n
+        self.cached_prefixes = set()
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample_latency(self):
+        '''latency of one response in seconds'''
+        with self.lock:
+            if self.latency_dist == 'uniform':
+                latency_ms = self.random.uniform(0.5 * self.latency_ms, 1.5 * self.latency_ms)
+            elif self.latency_dist == 'lognormal':
+                latency_ms = self.latency_ms * math.exp(self.random.gauss(0, self.latency_sigma))
+            elif self.latency_dist == 'exponential':
+                latency_ms = self.random.expovariate(math.log(2) / self.latency_ms) if self.latency_ms > 0 else 0
+            else:
+                latency_ms = self.latency_ms
+        return max(0.0, latency_ms) / 1000
+
+    def cached_chars(self, prompt_text):
+        '''length of the longest prefix (in whole blocks) of prompt_text that
+        an earlier completed request started with'''
+        if not self.prompt_cache:
+            return 0
+        cached = 0
+        with self.lock:
+            for end in range(self.CACHE_BLOCK_CHARS, len(prompt_text) + 1, self.CACHE_BLOCK_CHARS):
+                if hash(prompt_text[:end]) not in self.cached_prefixes:
+                    break
+                cached = end
+        return cached
+
+    def remember_prefixes(self, prompt_text):
+        if not self.prompt_cache:
+            return
+        with self.lock:
+            for end in range(self.CACHE_BLOCK_CHARS, len(prompt_text) + 1, self.CACHE_BLOCK_CHARS):
+                self.cached_prefixes.add(hash(prompt_text[:end]))
+
+    def sample_answer(self, temperature):
+        '''the option a choice answers, None for the prompt-derived answer'''
+        if self.answer or not temperature:
+            return self.answer
+        with self.lock:
+            if self.random.random() < 0.6:
+                return None
+            return self.random.randint(1, 4)
+
+    def sample_failure(self):
+        '''returns 429, 500 or None for a request'''
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.rate_limit_rate:
+            return 429
+        if draw < self.rate_limit_rate + self.error_rate:
+            return 500
+        return None
+
+
+class MockChatHandler(BaseHTTPRequestHandler):
+    '''answers POST .../chat/completions like the OpenAI API'''
+    protocol_version = 'HTTP/1.1'
+    # headers and body are separate writes; without this, Nagle's algorithm
+    # and delayed ACKs add ~40 ms to every keep-alive response
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_event(self, payload):
+        self.wfile.write(b'data: ' + json.dumps(payload).encode('utf-8') + b'\n\n')
+
+    def _stream(self, request, content, prompt_text, prompt_tokens, cached_chars):
+        '''sends content as server-sent events like the streaming API. a
+        client closing the stream early just ends the response'''
+        settings = self.server.settings
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for index, chunk in enumerate(completion_chunks(request, content, prompt_text, prompt_tokens, cached_chars)):
+                if index and settings.token_ms and chunk['choices'] and chunk['choices'][0]['delta']:
+                    time.sleep(settings.token_ms / 1000)
+                self._send_event(chunk)
+            self.wfile.write(b'data: [DONE]\n\n')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if not self.path.endswith('/chat/completions'):
+            self._send_json(404, {'error': {'message': f"Unknown path {self.path}", 'type': 'invalid_request_error'}})
+            return
+
+        settings = self.server.settings
+        prompt_text = request_prompt_text(request)
+        cached_chars = settings.cached_chars(prompt_text)
+        time.sleep(settings.sample_latency())
+        failure = settings.sample_failure()
+        if failure == 429:
+            self._send_json(429, {'error': {'message': 'Rate limit reached (mock).', 'type': 'rate_limit_error'}},
+                            {'retry-after-ms': str(settings.retry_after_ms)})
+            return
+        if failure == 500:
+            self._send_json(500, {'error': {'message': 'Internal server error (mock).', 'type': 'server_error'}})
+            return
+
+        settings.remember_prefixes(prompt_text)
+        n = 1 if settings.ignore_n else int(request.get('n') or 1)
+        temperature = request.get('temperature') or 0
+        contents = [canned_response(prompt_text, settings.sample_answer(temperature)) for _ in range(n)]
+        content = contents[0]
+        prompt_tokens = estimate_prompt_tokens(prompt_text)
+        if request.get('stream'):
+            self._stream(request, content, prompt_text, prompt_tokens, cached_chars)
+            return
+        if settings.token_ms:
+            time.sleep(settings.token_ms * (max(len(re.findall(r'\s*\S+', text)) for text in contents) - 1) / 1000)
+        self._send_json(200, completion_body(request, contents, prompt_text, prompt_tokens, cached_chars))
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, settings):
+        super().__init__(address, MockChatHandler)
+        self.settings = settings
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def start_mock_server(settings=None, host='127.0.0.1', port=0):
+    '''starts a mock server in a background thread (port 0 picks a free
+    port) and returns it; stop it with server.shutdown()'''
+    server = MockServer((host, port), settings or MockSettings())
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_mock_arguments(parser):
+    parser.add_argument('--latency_ms', type=float, default=50.0, help='Median response latency in milliseconds (default: 50)')
+    parser.add_argument('--latency_dist', type=str, default='fixed', choices=['fixed', 'uniform', 'lognormal', 'exponential'], help='Latency distribution (default: fixed)')
+    parser.add_argument('--latency_sigma', type=float, default=0.5, help='Spread of the lognormal latency distribution (default: 0.5)')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='Fraction of requests answered with a 500 error (default: 0)')
+    parser.add_argument('--rate_limit_rate', type=float, default=0.0, help='Fraction of requests answered with a 429 rate limit error (default: 0)')
+    parser.add_argument('--retry_after_ms', type=int, default=200, help='retry-after-ms header sent with 429 responses (default: 200)')
+    parser.add_argument('--answer', type=int, default=None, choices=[1, 2, 3, 4], help='Always answer this option instead of one derived from the prompt')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for the latency and failure sampling')
+    parser.add_argument('--prompt_cache', action='store_true', help='Imitate provider prompt caching and report cached_tokens for repeated prompt prefixes')
+    parser.add_argument('--ignore_n', action='store_true', help='Return a single choice whatever n is, like providers without n support')
+    parser.add_argument('--token_ms', type=float, default=0.0, help='Delay between the chunks of a streamed response in milliseconds (default: 0)')
+
+
+def settings_from_args(args):
+    return MockSettings(latency_ms=args.latency_ms, latency_dist=args.latency_dist, latency_sigma=args.latency_sigma,
+                        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate,
+                        retry_after_ms=args.retry_after_ms, answer=args.answer, seed=args.seed,
+                        prompt_cache=args.prompt_cache, token_ms=args.token_ms,
+                        ignore_n=args.ignore_n)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a local OpenAI-compatible chat completions mock for testing the pipeline without API costs.")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Host to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on (default: 8000)')
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockServer((args.host, args.port), settings_from_args(args))
+    print(f"Mock server listening on {server.base_url} (set model.base_url to this URL and OPENAI_API_KEY to any value).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nMock server stopped.")
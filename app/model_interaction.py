@@ -1,55 +1,407 @@
-
-from openai import OpenAI
+from openai.types.chat import ChatCompletion
+import asyncio
 import time
-import os
+from types import SimpleNamespace
+
+from data_handler import FINAL_ANSWER_PATTERN, option_probabilities
+from response_cache import CacheMissError
 
 
-def get_model_response(client, messages, current_config, task_type):
-    '''sends requests and recieves answers from the openai API'''
+def build_api_params(messages, current_config, task_type):
+    '''builds the keyword arguments for a chat completions request. batched
+    MCQ prompts (MCQ_BATCH) answer several turns, so they get
+    model.batch_max_tokens and none of the per-turn MCQ options (logit bias,
+    logprobs, self-consistency, streaming)'''
     model_config = current_config['model']
     default_max_tokens = model_config.get('max_tokens', 200)
     QA_max_tokens = 200
 
     if task_type == 'QA':
             effective_max_tokens = QA_max_tokens
+    elif task_type == 'MCQ_BATCH':
+        effective_max_tokens = model_config.get('batch_max_tokens', 2000)
     else:
         effective_max_tokens = default_max_tokens
-    try:
-        model_config = current_config['model']
-        api_params = {
-            'model': model_config['model'],
-            'messages': messages,
-            'max_tokens': effective_max_tokens,
-            'temperature': model_config['temperature'],
-            'timeout': model_config.get('timeout', 30) 
+
+    api_params = {
+        'model': model_config['model'],
+        'messages': messages,
+        'max_tokens': effective_max_tokens,
+        'temperature': model_config['temperature'],
+        'timeout': model_config.get('timeout', 30)
+    }
+
+    if task_type == 'MCQ' and model_config.get('use_logit_bias', False):
+        logit_bias_config = model_config.get('logit_bias_map', {
+            '16': 100,
+            '17': 100,
+            '18': 100,
+            '19': 100
+        })
+        api_params['logit_bias'] = logit_bias_config
+    if task_type == 'MCQ' and model_config.get('logprobs', False):
+        api_params['logprobs'] = True
+        api_params['top_logprobs'] = model_config.get('top_logprobs', 20)
+    if task_type == 'MCQ' and self_consistency_samples(current_config) > 1:
+        api_params['n'] = self_consistency_samples(current_config)
+    return api_params
+
+
+def self_consistency_samples(current_config):
+    '''number of reasoning chains sampled per MCQ item (model.self_consistency,
+    default 1 = no self-consistency)'''
+    return max(1, int(current_config['model'].get('self_consistency', 1) or 1))
+
+
+def stream_grace_tokens(current_config, task_type):
+    '''None when the request is sent normally, otherwise the number of
+    chunks to keep reading after the answer was parsed (model.stream_grace_tokens).
+    model.stream only applies to MCQ tasks, whose answer can be parsed
+    before the response is complete. self-consistency requests are not
+    streamed'''
+    model_config = current_config['model']
+    if task_type != 'MCQ' or not model_config.get('stream', False) or self_consistency_samples(current_config) > 1:
+        return None
+    return max(0, int(model_config.get('stream_grace_tokens', 0)))
+
+
+def cached_prompt_tokens(usage):
+    '''prompt tokens the provider served from its prompt cache
+    (usage.prompt_tokens_details.cached_tokens), None when not reported'''
+    details = getattr(usage, 'prompt_tokens_details', None) if usage else None
+    return getattr(details, 'cached_tokens', None) if details else None
+
+
+def _token_logprobs(logprobs):
+    '''the (token, [(token, logprob), ...]) pairs of a choice's logprobs'''
+    if logprobs is None or not logprobs.content:
+        return []
+    return [(item.token, [(top.token, top.logprob) for top in item.top_logprobs or []]) for item in logprobs.content]
+
+
+def _unpack_response(response, response_time):
+    '''turns a chat completion into the tuple returned by get_model_response:
+    (content, response_time, prompt_tokens, completion_tokens, total_tokens,
+    error, details), where details holds the optional extra result columns'''
+    model_response = response.choices[0].message.content.strip()
+
+    prompt_tokens = response.usage.prompt_tokens if response.usage else 0
+    completion_tokens = response.usage.completion_tokens if response.usage else 0
+    total_tokens = response.usage.total_tokens if response.usage else 0
+    details = {'cached_tokens': cached_prompt_tokens(response.usage)}
+    token_logprobs = _token_logprobs(response.choices[0].logprobs)
+    if token_logprobs:
+        details['option_probs'] = option_probabilities(token_logprobs)
+
+    return model_response, response_time, prompt_tokens, completion_tokens, total_tokens, None, details
+
+
+class _StreamReader:
+    '''collects a streamed chat completion chunk by chunk. feed returns True
+    once "Final Answer: N" has been parsed and grace_tokens more chunks have
+    arrived, so the caller can close the stream before the model finishes.
+    when the stream is closed before the usage chunk, the token counts are
+    estimated (one token per content chunk)'''
+
+    def __init__(self, api_params, start_time, grace_tokens=0):
+        self.api_params = api_params
+        self.start_time = start_time
+        self.grace_tokens = grace_tokens
+        self.text = ''
+        self.chunks = 0
+        self.chunks_after_answer = 0
+        self.usage = None
+        self.token_logprobs = []
+        self.time_to_first_token = None
+        self.time_to_answer = None
+        self.stopped_early = False
+
+    def feed(self, chunk):
+        if getattr(chunk, 'usage', None):
+            self.usage = chunk.usage
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            return False
+        delta = chunk.choices[0].delta.content
+        self.token_logprobs.extend(_token_logprobs(chunk.choices[0].logprobs))
+        now = time.perf_counter()
+        if self.time_to_first_token is None:
+            self.time_to_first_token = now - self.start_time
+        self.chunks += 1
+        search_from = max(0, len(self.text) - 32)
+        self.text += delta
+        if self.time_to_answer is None:
+            if not FINAL_ANSWER_PATTERN.search(self.text, search_from):
+                return False
+            self.time_to_answer = now - self.start_time
+        else:
+            self.chunks_after_answer += 1
+        if self.chunks_after_answer >= self.grace_tokens:
+            self.stopped_early = True
+            return True
+        return False
+
+    def result(self):
+        response_time = time.perf_counter() - self.start_time
+        if self.usage is None:
+            prompt_chars = sum(len(message['content']) for message in self.api_params['messages'])
+            prompt_tokens = prompt_chars // 4 + 1
+            self.usage = SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=self.chunks,
+                                         total_tokens=prompt_tokens + self.chunks, prompt_tokens_details=None)
+        details = {
+            'cached_tokens': cached_prompt_tokens(self.usage),
+            'time_to_first_token': self.time_to_first_token,
+            'time_to_answer': self.time_to_answer,
+            'stream_stopped_early': self.stopped_early
         }
+        if self.token_logprobs:
+            details['option_probs'] = option_probabilities(self.token_logprobs)
+        return (self.text.strip(), response_time, self.usage.prompt_tokens, self.usage.completion_tokens,
+                self.usage.total_tokens, None, details)
 
-        if task_type == 'MCQ' and model_config.get('use_logit_bias', False):
-            logit_bias_config = model_config.get('logit_bias_map', {
-                '16': 100, 
-                '17': 100, 
-                '18': 100, 
-                '19': 100 
-            })
-            api_params['logit_bias'] = logit_bias_config
 
-        start_time = time.time()
-        response = client.chat.completions.create(**api_params)
-        end_time = time.time()
+def _unpack_samples(responses, samples, response_time):
+    '''combines the responses of a self-consistency request into one result
+    tuple. details['samples'] holds every reasoning chain (build_result votes
+    over them) and the usage is summed over the responses'''
+    chains = [choice.message.content.strip() for response in responses for choice in response.choices
+              if choice.message.content][:samples]
+    usages = [response.usage for response in responses if response.usage]
+    cached = [cached_prompt_tokens(usage) for usage in usages if cached_prompt_tokens(usage) is not None]
+    usage = SimpleNamespace(
+        prompt_tokens=sum(usage.prompt_tokens for usage in usages),
+        completion_tokens=sum(usage.completion_tokens for usage in usages),
+        total_tokens=sum(usage.total_tokens for usage in usages),
+        prompt_tokens_details=SimpleNamespace(cached_tokens=sum(cached)) if cached else None
+    )
+    details = {'cached_tokens': cached_prompt_tokens(usage), 'samples': chains}
+    result = (chains[0] if chains else "", response_time, usage.prompt_tokens, usage.completion_tokens,
+              usage.total_tokens, None, details)
+    return result, usage
 
-        response_time = end_time - start_time
-        model_response = response.choices[0].message.content.strip()
 
-        prompt_tokens = response.usage.prompt_tokens if response.usage else 0
-        completion_tokens = response.usage.completion_tokens if response.usage else 0
-        total_tokens = response.usage.total_tokens if response.usage else 0
+def _missing_samples(responses, samples):
+    return samples - sum(len(response.choices) for response in responses)
 
-        return model_response, response_time, prompt_tokens, completion_tokens, total_tokens, None
 
-    except Exception as e:
+def _single_sample_params(api_params):
+    return {key: value for key, value in api_params.items() if key != 'n'}
+
+
+STREAM_PARAMS = {'stream': True, 'stream_options': {'include_usage': True}}
+
+
+def _send(backend, api_params, grace_tokens=None, use_n=True):
+    '''sends one request and returns (result tuple, usage). with grace_tokens
+    the response is streamed and closed once the answer is parsed. a
+    request for n > 1 samples is sent once with n, and topped up with single
+    requests when the provider returns fewer choices (or, with use_n false,
+    sent as n single requests)'''
+    start_time = time.perf_counter()
+    samples = api_params.get('n', 1)
+    if samples > 1:
+        responses = [backend.create(**api_params)] if use_n else []
+        single_params = _single_sample_params(api_params)
+        for _ in range(_missing_samples(responses, samples)):
+            responses.append(backend.create(**single_params))
+        return _unpack_samples(responses, samples, time.perf_counter() - start_time)
+    if grace_tokens is None:
+        response = backend.create(**api_params)
+        return _unpack_response(response, time.perf_counter() - start_time), response.usage
+    reader = _StreamReader(api_params, start_time, grace_tokens)
+    stream = backend.create(**api_params, **STREAM_PARAMS)
+    try:
+        for chunk in stream:
+            if reader.feed(chunk):
+                break
+    finally:
+        stream.close()
+    return reader.result(), reader.usage
+
+
+async def _send_async(backend, api_params, grace_tokens=None, use_n=True):
+    '''same as _send, with the single requests of a self-consistency
+    request sent concurrently'''
+    start_time = time.perf_counter()
+    samples = api_params.get('n', 1)
+    if samples > 1:
+        responses = [await backend.create_async(**api_params)] if use_n else []
+        single_params = _single_sample_params(api_params)
+        responses += await asyncio.gather(*[backend.create_async(**single_params)
+                                            for _ in range(_missing_samples(responses, samples))])
+        return _unpack_samples(responses, samples, time.perf_counter() - start_time)
+    if grace_tokens is None:
+        response = await backend.create_async(**api_params)
+        return _unpack_response(response, time.perf_counter() - start_time), response.usage
+    reader = _StreamReader(api_params, start_time, grace_tokens)
+    stream = await backend.create_async(**api_params, **STREAM_PARAMS)
+    try:
+        async for chunk in stream:
+            if reader.feed(chunk):
+                break
+    finally:
+        await stream.close()
+    return reader.result(), reader.usage
+
+
+def unpack_completion(body, api_params):
+    '''the result tuple of a chat completion given as JSON, e.g. a line of a
+    batch job's results file. there is no response time for these'''
+    response = ChatCompletion.model_validate(body)
+    if api_params.get('n', 1) > 1:
+        return _unpack_samples([response], api_params['n'], None)[0]
+    return _unpack_response(response, None)
+
+
+def _error_response(e):
+    if isinstance(e, CacheMissError):
+        error_message = f"Cache Miss: {str(e)}"
+    else:
         error_message = f"API Error: {str(e)}"
-        print(f"\n{error_message}") 
-        return None, 0, 0, 0, 0, error_message
+    print(f"\n{error_message}")
+    return None, 0, 0, 0, 0, error_message, {}
+
+
+def _lookup_cache(response_cache, api_params, grace_tokens=None):
+    '''returns the cache key and the cached result tuple (or None). a
+    streamed request (grace_tokens set) may be cut off after its answer, so
+    it is keyed apart from the same request sent normally. in replay mode a
+    miss raises CacheMissError so no request is sent'''
+    if response_cache is None:
+        return None, None
+    if grace_tokens is not None:
+        api_params = {**api_params, 'stream': True, 'stream_grace_tokens': grace_tokens}
+    cache_key = response_cache.make_key(api_params)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        model_response, response_time, prompt_tokens, completion_tokens, total_tokens, details = cached
+        return cache_key, (model_response, response_time, prompt_tokens, completion_tokens, total_tokens, None, details)
+    if response_cache.replay:
+        raise CacheMissError(f"no cached response for request {cache_key[:12]} in replay mode")
+    return cache_key, None
+
+
+def _store_cache(response_cache, cache_key, result):
+    if response_cache is not None:
+        response_cache.put(cache_key, *result[:5], details=result[6])
+
+
+def get_model_response(backend, messages, current_config, task_type, rate_limiter=None, response_cache=None, metrics=None):
+    '''sends requests and recieves answers through a model backend (see
+    backends.py). with a rate_limiter the request waits for the RPM/TPM
+    budget and transient failures (429s, timeouts, 5xx) are retried with
+    backoff before the task is given up as an error. a response_cache is
+    consulted before anything is sent and stores every successful response. metrics records waits,
+    request latencies, tokens and errors. with model.stream, MCQ responses
+    are streamed and the stream is closed as soon as the answer is parsed.
+    with model.self_consistency: k, k reasoning chains are sampled per MCQ
+    item in one request (n=k)'''
+    try:
+        api_params = build_api_params(messages, current_config, task_type)
+        grace_tokens = stream_grace_tokens(current_config, task_type)
+        use_n = current_config['model'].get('use_n', True)
+        cache_key, cached = _lookup_cache(response_cache, api_params, grace_tokens)
+        if cached is not None:
+            if metrics is not None:
+                metrics.count('cache_hits')
+            return cached
+        attempt = 0
+        while True:
+            estimated_tokens = 0
+            if rate_limiter is not None:
+                estimated_tokens = rate_limiter.estimate_tokens(api_params)
+                wait = rate_limiter.reserve(estimated_tokens)
+                if wait > 0:
+                    time.sleep(wait)
+                    if metrics is not None:
+                        metrics.add_time('rate_limit_wait', wait)
+            if metrics is not None:
+                metrics.request_started()
+            start_time = time.perf_counter()
+            try:
+                result, usage = _send(backend, api_params, grace_tokens, use_n)
+            except Exception as e:
+                delay = rate_limiter.on_error(e, attempt, estimated_tokens) if rate_limiter is not None else None
+                if metrics is not None:
+                    metrics.request_failed(time.perf_counter() - start_time, e, retried=delay is not None)
+                if delay is None:
+                    raise
+                attempt += 1
+                time.sleep(delay)
+                if metrics is not None:
+                    metrics.add_time('rate_limit_wait', delay)
+                continue
+
+            if rate_limiter is not None:
+                rate_limiter.on_success(estimated_tokens, usage)
+            if metrics is not None:
+                metrics.request_finished(result[1], usage, result[6])
+            _store_cache(response_cache, cache_key, result)
+            return result
+
+    except Exception as e:
+        return _error_response(e)
+
+
+async def get_model_response_async(backend, messages, current_config, task_type, rate_limiter=None, response_cache=None, metrics=None):
+    '''same as get_model_response but awaits the backend's async interface,
+    so many requests can be in flight at once'''
+    try:
+        api_params = build_api_params(messages, current_config, task_type)
+        grace_tokens = stream_grace_tokens(current_config, task_type)
+        use_n = current_config['model'].get('use_n', True)
+        cache_key, cached = _lookup_cache(response_cache, api_params, grace_tokens)
+        if cached is not None:
+            if metrics is not None:
+                metrics.count('cache_hits')
+            return cached
+        attempt = 0
+        while True:
+            estimated_tokens = 0
+            if rate_limiter is not None:
+                wait_start = time.perf_counter()
+                estimated_tokens = rate_limiter.estimate_tokens(api_params)
+                wait = rate_limiter.reserve(estimated_tokens)
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                await rate_limiter.acquire_slot()
+                if metrics is not None:
+                    metrics.add_time('rate_limit_wait', time.perf_counter() - wait_start)
+            # the slot is released however the request ends, including when
+            # the run is cancelled while it is in flight
+            try:
+                if metrics is not None:
+                    metrics.request_started()
+                start_time = time.perf_counter()
+                try:
+                    result, usage = await _send_async(backend, api_params, grace_tokens, use_n)
+                except Exception as e:
+                    delay = rate_limiter.on_error(e, attempt, estimated_tokens) if rate_limiter is not None else None
+                    if metrics is not None:
+                        metrics.request_failed(time.perf_counter() - start_time, e, retried=delay is not None)
+                    if delay is None:
+                        raise
+                else:
+                    delay = None
+                    if rate_limiter is not None:
+                        rate_limiter.on_success(estimated_tokens, usage)
+            finally:
+                if rate_limiter is not None:
+                    await rate_limiter.release_slot()
+
+            if delay is not None:
+                attempt += 1
+                await asyncio.sleep(delay)
+                if metrics is not None:
+                    metrics.add_time('rate_limit_wait', delay)
+                continue
+            if metrics is not None:
+                metrics.request_finished(result[1], usage, result[6])
+            _store_cache(response_cache, cache_key, result)
+            return result
+
+    except Exception as e:
+        return _error_response(e)
+
 
 if __name__ == '__main__':
     print("Testing model interface (requires valid config and API key)...")
@@ -0,0 +1,330 @@
+from string import Formatter
+
+
+# fields a template can use. {history} is the dialogue so far, {question} and
+# {answer} the last Question-Answer pair (MCQ) or the question about the
+# conversation (QA), and {options} the numbered answer options
+MCQ_FIELDS = ('history', 'question', 'answer', 'options')
+QA_FIELDS = ('history', 'question')
+# batched MCQ prompts ask about several turns of a dialog at once: {turns}
+# is the dialogue from the first of them on, with those turns numbered,
+# {turn_numbers} their numbers and {options} the options of each turn
+BATCH_MCQ_FIELDS = ('history', 'turns', 'turn_numbers', 'options')
+
+COT_MCQ_TEMPLATE = """Consider the dialogue context below, paying close attention to the final Question-Answer pair.
+
+Dialogue Context:
+{history}
+Last Question: {question}
+Last Answer: {answer}
+
+Task: What is the most likely implied meaning (implicature) of the *last Answer* ("{answer}") in response to the *last Question* ("{question}"), given the preceding dialogue?First, perform reasoning step-by-step based on the Dialogue Context to determine the implied meaning of the last Answer, then choose the best option (1-4) representing this implied meaning.
+
+Options:
+{options}
+
+[Reasoning and answer here]:
+"""
+
+ZERO_SHOT_MCQ_TEMPLATE = """Consider the dialogue context below, paying close attention to the final Question-Answer pair.
+
+Dialogue Context:
+{history}
+Last Question: {question}
+Last Answer: {answer}
+
+Task: What is the most likely implied meaning (implicature) of the *last Answer* ("{answer}") in response to the *last Question* ("{question}"), given the preceding dialogue? Choose the best option representing this implied meaning.
+
+Options:
+{options}
+
+Choice (1-4):"""
+
+COT_QA_TEMPLATE = """Based on the conversation history provided below and the question: First provide step-by-step reasoning to determine the answer to the question about the conversation and then write down your answer.
+
+    Conversation History:
+    {history}
+    Question: {question}
+
+    Answer:"""
+
+ZERO_SHOT_QA_TEMPLATE = """Based on the conversation history provided below and the question: Answer the question about the conversation.
+
+    Conversation History:
+    {history}
+    Question: {question}
+
+    Answer:"""
+
+# prefix layout: a fixed instruction, then the dialogue with the current turn
+# written exactly like a history segment, then the task. the prompt of each
+# turn therefore starts with the whole prompt prefix of the turn before it
+# (and the QA prompts with that of the last turn), which is what provider
+# side prompt caching can reuse
+PREFIX_INSTRUCTION = """Read the dialogue below and complete the task that follows it.
+
+Dialogue:
+"""
+
+COT_PREFIX_MCQ_TEMPLATE = PREFIX_INSTRUCTION + """{history}Question: {question}
+Answer: {answer}
+
+Task: What is the most likely implied meaning (implicature) of the last Answer ("{answer}") in response to the last Question ("{question}"), given the preceding dialogue? First, perform reasoning step-by-step based on the dialogue to determine the implied meaning of the last Answer, then choose the best option (1-4) representing this implied meaning.
+
+Options:
+{options}
+
+[Reasoning and answer here]:
+"""
+
+ZERO_SHOT_PREFIX_MCQ_TEMPLATE = PREFIX_INSTRUCTION + """{history}Question: {question}
+Answer: {answer}
+
+Task: What is the most likely implied meaning (implicature) of the last Answer ("{answer}") in response to the last Question ("{question}"), given the preceding dialogue? Choose the best option representing this implied meaning.
+
+Options:
+{options}
+
+Choice (1-4):"""
+
+COT_PREFIX_QA_TEMPLATE = PREFIX_INSTRUCTION + """{history}Task: First provide step-by-step reasoning to determine the answer to the question about the conversation and then write down your answer.
+Question: {question}
+
+Answer:"""
+
+ZERO_SHOT_PREFIX_QA_TEMPLATE = PREFIX_INSTRUCTION + """{history}Task: Answer the question about the conversation.
+Question: {question}
+
+Answer:"""
+
+# batched turns: every numbered turn is written as a BATCH_TURN_SEGMENT and
+# the answers are asked for as "Turn N ..." lines (see split_batch_response)
+BATCH_TURN_SEGMENT = "Turn {number}:\nQuestion: {question}\nAnswer: {answer}\n\n"
+
+COT_BATCH_MCQ_TEMPLATE = """Consider the dialogue context below. The numbered turns are the Question-Answer pairs to interpret.
+
+Dialogue Context:
+{history}{turns}Task: For each numbered turn ({turn_numbers}), what is the most likely implied meaning (implicature) of its Answer in response to its Question, given the dialogue up to that turn? For each turn, first perform reasoning step-by-step based on the Dialogue Context to determine the implied meaning of the Answer, then choose the best option (1-4) representing this implied meaning.
+
+{options}Use this format for every numbered turn:
+Turn <number> Reasoning: <reasoning>
+Turn <number> Final Answer: <option 1-4>
+"""
+
+ZERO_SHOT_BATCH_MCQ_TEMPLATE = """Consider the dialogue context below. The numbered turns are the Question-Answer pairs to interpret.
+
+Dialogue Context:
+{history}{turns}Task: For each numbered turn ({turn_numbers}), what is the most likely implied meaning (implicature) of its Answer in response to its Question, given the dialogue up to that turn? Choose the best option representing this implied meaning.
+
+{options}Answer with one line per numbered turn, in this format:
+Turn <number>: <option 1-4>
+"""
+
+PROMPT_LAYOUTS = ('standard', 'prefix')
+
+
+class DialogHistory:
+    '''the Question/Answer turns of a dialog so far, kept as a list of
+    segments that prompts reference instead of copying a growing string'''
+
+    def __init__(self):
+        self.segments = []
+
+    def add_turn(self, question, answer):
+        self.segments.append(f"Question: {question}\nAnswer: {answer}\n\n")
+
+
+class PromptTemplate:
+    '''a template with {field} placeholders, parsed once into literal text
+    and field references. literal braces are written as {{ and }}'''
+
+    def __init__(self, text, fields):
+        self.text = text
+        self.parts = []
+        for literal, field_name, format_spec, conversion in Formatter().parse(text):
+            if field_name is not None and (field_name not in fields or format_spec or conversion):
+                raise ValueError(f"Unknown placeholder '{{{field_name}}}' in prompt template, available are: {', '.join('{' + field + '}' for field in fields)}")
+            self.parts.append((literal, field_name))
+
+    def render_segments(self, values):
+        '''the prompt as a list of strings. list values (the history) are
+        spliced in segment by segment, so prompts of the same dialog share
+        their history segments'''
+        segments = []
+        for literal, field_name in self.parts:
+            if literal:
+                segments.append(literal)
+            if field_name is not None:
+                value = values[field_name]
+                if isinstance(value, list):
+                    segments.extend(value)
+                else:
+                    segments.append(value)
+        return segments
+
+    def render(self, values):
+        return ''.join(self.render_segments(values))
+
+
+class PromptStyle:
+    '''the MCQ and QA templates of a prompt style, for the standard layout
+    and the prefix layout (which falls back to the standard templates when
+    a style has none), plus an optional template for batched MCQ turns.
+    reasoning marks styles whose responses contain
+    "Reasoning: ... Final Answer:" so that the reasoning is extracted into
+    model_reasoning'''
+
+    def __init__(self, name, mcq_template, qa_template, reasoning=False, prefix_mcq_template=None, prefix_qa_template=None,
+                 batch_mcq_template=None):
+        self.name = name
+        self.mcq = PromptTemplate(mcq_template, MCQ_FIELDS)
+        self.qa = PromptTemplate(qa_template, QA_FIELDS)
+        self.prefix_mcq = PromptTemplate(prefix_mcq_template, MCQ_FIELDS) if prefix_mcq_template else self.mcq
+        self.prefix_qa = PromptTemplate(prefix_qa_template, QA_FIELDS) if prefix_qa_template else self.qa
+        self.batch_mcq = PromptTemplate(batch_mcq_template, BATCH_MCQ_FIELDS) if batch_mcq_template else None
+        self.reasoning = reasoning
+
+    def templates(self, layout='standard'):
+        return (self.prefix_mcq, self.prefix_qa) if layout == 'prefix' else (self.mcq, self.qa)
+
+    def mcq_values(self, history, question, answer, options):
+        options_text = "\n".join([f"{i+1}) {opt}" for i, opt in enumerate(options)])
+        return {'history': history.segments, 'question': question, 'answer': answer, 'options': options_text}
+
+    def mcq_prompt(self, history, question, answer, options, layout='standard'):
+        return self.templates(layout)[0].render(self.mcq_values(history, question, answer, options))
+
+    def qa_prompt(self, history, question, layout='standard'):
+        return self.templates(layout)[1].render({'history': history.segments, 'question': question})
+
+    def batch_mcq_prompt(self, history, turns):
+        '''one prompt for several MCQ turns of a dialog. turns are (position,
+        question, answer, options), with position the index of the turn in
+        history.segments; turns between them that are not asked about (e.g.
+        already done on resume) are shown unnumbered'''
+        numbered = {position: (question, answer) for position, question, answer, _ in turns}
+        dialogue = []
+        for position in range(turns[0][0], turns[-1][0] + 1):
+            if position in numbered:
+                question, answer = numbered[position]
+                dialogue.append(BATCH_TURN_SEGMENT.format(number=position + 1, question=question, answer=answer))
+            else:
+                dialogue.append(history.segments[position])
+        options = "".join(
+            f"Turn {position + 1} options:\n" + "\n".join(f"{i+1}) {opt}" for i, opt in enumerate(turn_options)) + "\n\n"
+            for position, _, _, turn_options in turns
+        )
+        return self.batch_mcq.render({
+            'history': history.segments[:turns[0][0]], 'turns': dialogue,
+            'turn_numbers': ", ".join(str(position + 1) for position, _, _, _ in turns), 'options': options
+        })
+
+
+PROMPT_STYLES = {}
+
+
+def register_prompt_style(name, mcq_template, qa_template, reasoning=False, prefix_mcq_template=None, prefix_qa_template=None,
+                          batch_mcq_template=None):
+    '''adds a prompt style that can be selected with model.prompt_style'''
+    PROMPT_STYLES[name.lower()] = PromptStyle(name.lower(), mcq_template, qa_template, reasoning, prefix_mcq_template, prefix_qa_template,
+                                              batch_mcq_template)
+    return PROMPT_STYLES[name.lower()]
+
+
+register_prompt_style('cot', COT_MCQ_TEMPLATE, COT_QA_TEMPLATE, reasoning=True,
+                      prefix_mcq_template=COT_PREFIX_MCQ_TEMPLATE, prefix_qa_template=COT_PREFIX_QA_TEMPLATE,
+                      batch_mcq_template=COT_BATCH_MCQ_TEMPLATE)
+register_prompt_style('zero-shot', ZERO_SHOT_MCQ_TEMPLATE, ZERO_SHOT_QA_TEMPLATE,
+                      prefix_mcq_template=ZERO_SHOT_PREFIX_MCQ_TEMPLATE, prefix_qa_template=ZERO_SHOT_PREFIX_QA_TEMPLATE,
+                      batch_mcq_template=ZERO_SHOT_BATCH_MCQ_TEMPLATE)
+
+
+def build_config_styles(config):
+    '''compiles the styles of the config's prompt_styles section, e.g.
+
+        prompt_styles:
+          short-cot:
+            base: cot          # style to take missing templates from
+            mcq: "...{history}...{question}...{answer}...{options}..."
+            prefix_mcq: "..."  # optional, used with model.prompt_layout: prefix
+            batch_mcq: "..."   # optional, used with model.turn_batch
+            reasoning: true
+
+    returns {name: PromptStyle}. raises ValueError for a bad template or base'''
+    styles = {}
+    for name, style_config in (config.get('prompt_styles') or {}).items():
+        style_config = style_config or {}
+        base_name = str(style_config.get('base', 'cot')).lower()
+        base = PROMPT_STYLES.get(base_name) or styles.get(base_name)
+        if base is None:
+            raise ValueError(f"prompt style '{name}' is based on unknown style '{base_name}'")
+        try:
+            styles[str(name).lower()] = PromptStyle(
+                str(name).lower(), style_config.get('mcq', base.mcq.text), style_config.get('qa', base.qa.text),
+                style_config.get('reasoning', base.reasoning),
+                style_config.get('prefix_mcq', base.prefix_mcq.text), style_config.get('prefix_qa', base.prefix_qa.text),
+                style_config.get('batch_mcq', base.batch_mcq.text if base.batch_mcq else None)
+            )
+        except ValueError as e:
+            raise ValueError(f"prompt style '{name}': {e}")
+    return styles
+
+
+def config_prompt_styles(current_config):
+    '''the compiled styles of the config's prompt_styles section. they are
+    built once per config (by load_config, or on first use for a config
+    made in code) and kept under prompt_style_registry, so later lookups
+    do not compile the templates again'''
+    styles = current_config.get('prompt_style_registry')
+    if styles is None:
+        styles = build_config_styles(current_config)
+        current_config['prompt_style_registry'] = styles
+    return styles
+
+
+def resolve_prompt_style(current_config, name=None):
+    '''the PromptStyle selected by model.prompt_style (or named by name),
+    looked up in the config's prompt_styles first and then in the
+    registered styles. unknown names fall back to cot with a warning'''
+    name = (name or current_config.get('model', {}).get('prompt_style', 'cot')).lower()
+    style = config_prompt_styles(current_config).get(name) or PROMPT_STYLES.get(name)
+    if style is None:
+        print(f"Warning: Unknown prompt_style '{name}'. Defaulting to 'cot'.")
+        style = PROMPT_STYLES['cot']
+    return style
+
+
+def resolve_prompt_layout(current_config):
+    '''model.prompt_layout: standard (default, the prompts of the study) or
+    prefix (prompt-cache friendly ordering)'''
+    layout = str(current_config.get('model', {}).get('prompt_layout', 'standard')).lower()
+    if layout not in PROMPT_LAYOUTS:
+        print(f"Warning: Unknown prompt_layout '{layout}'. Defaulting to 'standard'.")
+        layout = 'standard'
+    return layout
+
+
+def resolve_turn_batch(current_config):
+    '''model.turn_batch: None (default, one request per MCQ turn), a number
+    of turns to ask about per request (2 or more, smaller numbers mean one
+    request per turn), or all (every MCQ turn of a dialog in one request)'''
+    turn_batch = current_config.get('model', {}).get('turn_batch')
+    if turn_batch is None or turn_batch is False:
+        return None
+    if str(turn_batch).lower() == 'all':
+        return float('inf')
+    try:
+        turn_batch = int(turn_batch)
+    except ValueError:
+        print(f"Warning: Unknown turn_batch '{turn_batch}'. Sending one request per turn.")
+        return None
+    return turn_batch if turn_batch > 1 else None
+
+
+def effective_turn_batch(current_config):
+    '''the turn batch actually used by a run: resolve_turn_batch, or None
+    when the prompt style has no batch_mcq template'''
+    turn_batch = resolve_turn_batch(current_config)
+    if turn_batch is not None and resolve_prompt_style(current_config).batch_mcq is None:
+        return None
+    return turn_batch
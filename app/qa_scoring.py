@@ -0,0 +1,241 @@
+import argparse
+import difflib
+import os
+import re
+import sys
+import time
+
+import pandas as pd
+
+
+SCORED_COLUMNS = ('is_correct', 'qa_label', 'qa_confidence')
+
+# ground truths answered by polarity, "unknown" is expected as a hedge
+POLAR_LABELS = {'yes': 'yes', 'no': 'no', 'unknown': 'unsure'}
+
+# the answer is the text after the last "Answer:" (the CoT prompts end with
+# it), or else the last paragraph of the response
+ANSWER_MARKER_PATTERN = re.compile(r'\bAnswer\s*:', re.IGNORECASE)
+PARAGRAPH_BREAK_PATTERN = re.compile(r'\n\s*\n')
+
+LEADING_YES_PATTERN = re.compile(r'^\W*(?:yes|yeah|yep|correct|true)\b')
+LEADING_NO_PATTERN = re.compile(r'^\W*(?:no|nope|false|incorrect)\b')
+# '... the answer to the question "does the woman know ..." is: yes.'
+TRAILING_YES_PATTERN = re.compile(r'\byes\W*$')
+TRAILING_NO_PATTERN = re.compile(r'\bno\W*$')
+QUOTE_PATTERN = re.compile(r'"[^"]*"')
+HEDGE_PATTERN = re.compile(
+    r"\b(?:cannot|can't|can not|not possible to|impossible to|unable to) (?:be )?(?:determine|determined|know|known|say|tell|infer|inferred)"
+    r"|\bnot (?:specified|mentioned|stated|clear|known|given|provided|indicated|enough information)"
+    r"|\b(?:does not|doesn't|do not|don't) (?:say|specify|mention|state|indicate)"
+    r"|\b(?:unclear|unknown|uncertain|unspecified|no information)\b"
+)
+NEGATION_PATTERN = re.compile(r"\b(?:not|never|no|none|nobody|neither|nor|cannot)\b|n't\b")
+
+NUMBER_WORDS = {str(number): word for number, word in enumerate(
+    ['zero', 'one', 'two', 'three', 'four', 'five', 'six', 'seven', 'eight', 'nine', 'ten'])}
+NUMBER_PATTERN = re.compile(r'\b(?:10|[0-9])\b')
+
+# counts compete only with counts and places/names only with places/names,
+# so "some of the limes are in the den" names one place
+QUANTITY_TERMS = set(NUMBER_WORDS.values()) | {'all', 'some', 'none'}
+
+# other ways answers name a ground truth term
+TERM_ALIASES = {
+    'none': ('zero', 'no one', 'nobody', 'nothing'),
+    'all': ('every', 'everything'),
+    'some': ('several', 'a few', 'not all'),
+}
+
+# free-form answers without an exact term are matched by token overlap or
+# string similarity to the ground truth, at least this high
+FUZZY_THRESHOLD = 0.85
+
+
+def normalize_text(texts):
+    '''lowercase, "_" and "-" as spaces, digits as number words, single spaces'''
+    texts = texts.fillna('').astype(str).str.lower()
+    texts = texts.str.replace('’', "'", regex=False).str.replace(r'[_\-]', ' ', regex=True)
+    texts = texts.str.replace(NUMBER_PATTERN, lambda match: NUMBER_WORDS[match.group(0)], regex=True)
+    return texts.str.replace(r'\s+', ' ', regex=True).str.strip()
+
+
+def answer_text(response):
+    '''the part of a response that holds the answer'''
+    parts = ANSWER_MARKER_PATTERN.split(response)
+    if len(parts) > 1 and parts[-1].strip():
+        return parts[-1].strip()
+    return PARAGRAPH_BREAK_PATTERN.split(response.strip())[-1]
+
+
+def extract_answer_text(responses):
+    return responses.fillna('').astype(str).map(answer_text)
+
+
+def detect_polarity(answers):
+    '''yes/no/unsure label and confidence of normalized answers. a leading
+    or closing yes or no decides (1.0), then a hedge such as "cannot be
+    determined" (0.75), then any negation (0.6); an answer without any is a
+    yes (0.6). quoted text (the question repeated) is ignored'''
+    answers = answers.str.replace(QUOTE_PATTERN, ' ', regex=True)
+    leading_yes = answers.str.contains(LEADING_YES_PATTERN)
+    leading_no = answers.str.contains(LEADING_NO_PATTERN)
+    leading_yes = leading_yes | (~leading_no & answers.str.contains(TRAILING_YES_PATTERN))
+    leading_no = leading_no | (~leading_yes & answers.str.contains(TRAILING_NO_PATTERN))
+    hedge = answers.str.contains(HEDGE_PATTERN)
+    negation = answers.str.contains(NEGATION_PATTERN)
+
+    label = pd.Series('yes', index=answers.index)
+    label = label.mask(negation, 'no').mask(hedge, 'unsure')
+    label = label.mask(leading_no, 'no').mask(leading_yes, 'yes')
+    confidence = pd.Series(0.6, index=answers.index)
+    confidence = confidence.mask(hedge, 0.75).mask(leading_yes | leading_no, 1.0)
+    return label, confidence, hedge
+
+
+def term_pattern(terms):
+    '''one regex matching every term and its aliases as whole words (also
+    written together or hyphenated, e.g. "backyard"), longest first, and a
+    map from the matched text to the term'''
+    surfaces = {}
+    for term in terms:
+        for alias in (term,) + TERM_ALIASES.get(term, ()):
+            words = alias.split()
+            for surface in (' '.join(words), ''.join(words), '-'.join(words)):
+                surfaces.setdefault(surface, term)
+    alternation = '|'.join(re.escape(surface) for surface in sorted(surfaces, key=len, reverse=True))
+    return re.compile(rf'\b(?:{alternation})\b'), surfaces
+
+
+def fuzzy_match(answer, ground_truth):
+    '''(score, matched text) of the closest run of answer tokens to the
+    ground truth, scored by string similarity or by the share of ground
+    truth tokens in the answer, whichever is higher'''
+    truth_tokens = ground_truth.split()
+    answer_tokens = re.findall(r'[a-z0-9]+', answer)
+    if not truth_tokens or not answer_tokens:
+        return 0.0, ''
+    overlap = len(set(truth_tokens) & set(answer_tokens)) / len(set(truth_tokens))
+    best_score, best_text = overlap, ground_truth if overlap == 1.0 else ''
+    width = len(truth_tokens)
+    for start in range(max(1, len(answer_tokens) - width + 1)):
+        candidate = ' '.join(answer_tokens[start:start + width])
+        score = difflib.SequenceMatcher(None, ground_truth, candidate).ratio()
+        if score > best_score:
+            best_score, best_text = score, candidate
+    return best_score, best_text
+
+
+def score_qa_frame(frame):
+    '''scores QA result rows against ground_truth_answer. yes/no ground
+    truths are compared with the polarity of the answer, "unknown" expects
+    a hedge, and free-form ground truths (places, names, counts) have to be
+    named in the answer. other terms of the same kind (the free-form ground
+    truths of the frame, counts for counts) named in the answer lower the
+    confidence, those already in the question are ignored. returns a
+    DataFrame with is_correct, qa_label (the answer as scored: yes/no/unsure
+    or a term) and qa_confidence'''
+    responses = frame['model_response_full'].fillna('').astype(str)
+    errors = frame['error_type'].fillna('').astype(str)
+    answered = (responses.str.strip() != '') & (errors == '')
+
+    answers = normalize_text(extract_answer_text(responses))
+    truths = normalize_text(frame['ground_truth_answer'])
+    polar = truths.isin(list(POLAR_LABELS))
+    polarity, polarity_confidence, hedge = detect_polarity(answers)
+
+    terms = sorted(set(truths[~polar & (truths != '')]) | set(TERM_ALIASES))
+    pattern, surfaces = term_pattern(terms)
+    question_terms = normalize_text(frame['question']).str.findall(pattern)
+    mentions = [
+        list(dict.fromkeys(term for term in (surfaces[surface] for surface in found)
+                           if term == truth or (term not in asked and (term in QUANTITY_TERMS) == (truth in QUANTITY_TERMS))))
+        for found, asked, truth in zip(answers.str.findall(pattern), question_terms.map(lambda found: {surfaces[surface] for surface in found}), truths)
+    ]
+    mentions = pd.Series(mentions, index=frame.index)
+    mention_count = mentions.str.len()
+    first_mention = mentions.str[0].fillna('')
+    named = pd.Series([truth in found for truth, found in zip(truths, mentions)], index=frame.index)
+
+    expected = truths.map(POLAR_LABELS)
+    is_correct = (polar & (polarity == expected)) | (~polar & named)
+    label = polarity.where(polar, first_mention.mask((mention_count == 0) & hedge, 'unsure'))
+    confidence = polarity_confidence.where(polar, (1 / mention_count.clip(lower=1)).mask(mention_count == 0, 0.0))
+    confidence = confidence.mask(~polar & (mention_count == 0) & hedge, 0.75)
+    # "unknown" is a free-form question answered with a hedge
+    unknown = truths == 'unknown'
+    is_correct = is_correct.mask(unknown, hedge)
+    label = label.mask(unknown & ~hedge, first_mention)
+    confidence = confidence.mask(unknown & ~hedge, (1 / mention_count.clip(lower=1)).mask(mention_count == 0, 0.0))
+
+    unresolved = answered & ~polar & (mention_count == 0) & ~hedge & (truths != '')
+    for index in unresolved[unresolved].index:
+        score, text = fuzzy_match(answers[index], truths[index])
+        if score >= FUZZY_THRESHOLD:
+            is_correct[index], label[index], confidence[index] = True, text, round(score, 3)
+
+    return pd.DataFrame({
+        'is_correct': is_correct & answered,
+        'qa_label': label.where(answered, ''),
+        'qa_confidence': confidence.where(answered)
+    }, index=frame.index)
+
+
+def score_file(csv_path, write=False, min_confidence=0.7):
+    '''scores the QA rows of one *_qa_results.csv, prints the accuracy by
+    ground truth kind, rewrites the file with is_correct, qa_label and
+    qa_confidence when write is True, and returns the rows scored with a
+    confidence below min_confidence for review'''
+    all_rows = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    frame = all_rows[all_rows['task_type'] == 'QA']
+    if frame.empty:
+        print(f"{csv_path}: no QA rows.")
+        return pd.DataFrame()
+
+    scored = score_qa_frame(frame)
+    polar = frame['ground_truth_answer'].str.lower().isin(list(POLAR_LABELS))
+    low_confidence = scored['qa_confidence'].fillna(0) < min_confidence
+    print(f"{csv_path}: {len(frame)} rows, accuracy {scored['is_correct'].mean():.4f} "
+          f"(yes/no/unknown {scored.loc[polar, 'is_correct'].mean():.4f} on {int(polar.sum())}, "
+          f"free-form {scored.loc[~polar, 'is_correct'].mean():.4f} on {int((~polar).sum())}), "
+          f"{int(low_confidence.sum())} rows below confidence {min_confidence}")
+
+    review = frame.loc[low_confidence, [column for column in ('task_id', 'dialog_id', 'qa_question_index', 'question', 'ground_truth_answer') if column in frame.columns]].copy()
+    review.insert(0, 'file', os.path.basename(csv_path))
+    review = review.join(scored.loc[low_confidence])
+    review['model_response_full'] = frame.loc[low_confidence, 'model_response_full']
+
+    if write:
+        all_rows.loc[frame.index, 'is_correct'] = scored['is_correct'].astype(str)
+        all_rows.loc[frame.index, 'qa_label'] = scored['qa_label']
+        all_rows.loc[frame.index, 'qa_confidence'] = scored['qa_confidence'].round(3).astype(str).replace('nan', '')
+        all_rows = all_rows.fillna('')
+        all_rows.to_csv(csv_path + '.tmp', index=False, encoding='utf-8')
+        os.replace(csv_path + '.tmp', csv_path)
+        print(f"  Rewrote {csv_path} with the scores.")
+    return review
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Score QA result files offline against ground_truth_answer (no API calls).")
+    parser.add_argument('csv_files', nargs='+', help='QA result CSV files, e.g. results/*_qa_results.csv')
+    parser.add_argument('--write', action='store_true', help='Write is_correct, qa_label and qa_confidence into the files')
+    parser.add_argument('--min_confidence', type=float, default=0.7, help='Rows scored with a lower confidence are counted and listed in --review_out (default: 0.7)')
+    parser.add_argument('--review_out', type=str, default=None, help='Optional CSV path for the low-confidence rows, for manual review')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    all_reviews = []
+    for csv_path in args.csv_files:
+        try:
+            all_reviews.append(score_file(csv_path, write=args.write, min_confidence=args.min_confidence))
+        except (KeyError, pd.errors.EmptyDataError) as e:
+            print(f"Skipping {csv_path}: {e}")
+    print(f"Scored {len(all_reviews)} files in {time.perf_counter() - start:.2f}s.")
+
+    if args.review_out:
+        reviews = pd.concat(all_reviews, ignore_index=True) if all_reviews else pd.DataFrame()
+        reviews.to_csv(args.review_out, index=False, encoding='utf-8')
+        print(f"{len(reviews)} low-confidence rows written to {args.review_out}")
+    if not all_reviews:
+        sys.exit(1)
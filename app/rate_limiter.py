@@ -0,0 +1,182 @@
+import asyncio
+import random
+import threading
+import time
+
+import openai
+
+
+class TokenBucket:
+    '''a token bucket refilled continuously at rate_per_minute. reserve()
+    always succeeds and returns how long the caller has to wait before the
+    reserved amount is actually available, so the bucket can go negative
+    and concurrent callers queue up behind each other fairly'''
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate_per_second = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        elapsed = now - self.last_refill
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate_per_second)
+        self.last_refill = now
+
+    def reserve(self, amount):
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.tokens -= min(amount, self.capacity)
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate_per_second
+
+    def refund(self, amount):
+        '''gives back (or, with a negative amount, takes) tokens once the
+        real cost of a request is known'''
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class RateLimiter:
+    '''client-side scheduler for chat completion requests: enforces
+    requests-per-minute and tokens-per-minute budgets, decides whether and
+    how long to back off after a failure, and adapts the number of requests
+    in flight (additive increase, multiplicative decrease) based on rate
+    limit responses'''
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, max_retries=5,
+                 backoff_base=1.0, backoff_max=60.0, max_concurrency=1, min_concurrency=1):
+        self.request_bucket = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.token_bucket = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.concurrency_limit = float(self.max_concurrency)
+        self.blocked_until = 0.0
+        self.retries = 0
+        self.rate_limited = 0
+        self.lock = threading.Lock()
+        self._in_flight = 0
+        self._slot_condition = None
+        self._slot_loop = None
+
+    @staticmethod
+    def estimate_tokens(api_params):
+        '''rough prompt token estimate (about four characters per token) plus
+        the completion budget, used to charge the token bucket before sending'''
+        prompt_chars = sum(len(str(message.get('content', ''))) for message in api_params.get('messages', []))
+        return prompt_chars // 4 + 1 + api_params.get('max_tokens', 0) * api_params.get('n', 1)
+
+    def reserve(self, estimated_tokens):
+        '''charges one request and estimated_tokens to the budgets and returns
+        the number of seconds to wait before sending'''
+        wait = 0.0
+        if self.request_bucket:
+            wait = max(wait, self.request_bucket.reserve(1))
+        if self.token_bucket:
+            wait = max(wait, self.token_bucket.reserve(estimated_tokens))
+        with self.lock:
+            wait = max(wait, self.blocked_until - time.monotonic())
+        return wait
+
+    def on_success(self, estimated_tokens, usage):
+        if self.token_bucket and usage is not None:
+            self.token_bucket.refund(estimated_tokens - usage.total_tokens)
+        with self.lock:
+            if self.concurrency_limit < self.max_concurrency:
+                self.concurrency_limit = min(self.max_concurrency, self.concurrency_limit + 1.0 / self.concurrency_limit)
+
+    def on_error(self, error, attempt, estimated_tokens):
+        '''returns the backoff delay before the next attempt, or None when the
+        error is not transient or the retries are used up. the tokens
+        reserved for the failed request are refunded whatever the error, so
+        a run of failures does not drain the TPM budget of its retries'''
+        is_transient, is_rate_limit, retry_after = classify_error(error)
+        if self.token_bucket:
+            self.token_bucket.refund(estimated_tokens)
+        if is_rate_limit:
+            with self.lock:
+                self.rate_limited += 1
+                self.concurrency_limit = max(self.min_concurrency, self.concurrency_limit / 2)
+        if not is_transient or attempt >= self.max_retries:
+            return None
+
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+            with self.lock:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+        with self.lock:
+            self.retries += 1
+        return delay
+
+    async def acquire_slot(self):
+        '''waits until fewer than the current concurrency limit of requests
+        are in flight (async dispatch only)'''
+        loop = asyncio.get_running_loop()
+        if self._slot_loop is not loop:
+            self._slot_condition = asyncio.Condition()
+            self._slot_loop = loop
+            self._in_flight = 0
+        async with self._slot_condition:
+            await self._slot_condition.wait_for(lambda: self._in_flight < int(self.concurrency_limit))
+            self._in_flight += 1
+
+    async def release_slot(self):
+        # on_success runs before the release, so waiters also see a raised limit here
+        async with self._slot_condition:
+            self._in_flight -= 1
+            self._slot_condition.notify_all()
+
+    def summary(self):
+        return f"{self.retries} retries, {self.rate_limited} rate limit responses, concurrency limit {int(self.concurrency_limit)}/{self.max_concurrency}"
+
+
+def _retry_after_seconds(response):
+    if response is None:
+        return None
+    headers = response.headers
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000.0
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        return None
+    return None
+
+
+def classify_error(error):
+    '''returns (is_transient, is_rate_limit, retry_after_seconds) for an
+    exception raised by the openai client'''
+    if isinstance(error, openai.RateLimitError):
+        return True, True, _retry_after_seconds(error.response)
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError)):
+        return True, False, None
+    if isinstance(error, openai.APIStatusError):
+        transient = error.status_code in (408, 409) or error.status_code >= 500
+        return transient, False, _retry_after_seconds(error.response) if transient else None
+    return False, False, None
+
+
+def build_rate_limiter(current_config):
+    '''creates a RateLimiter from the rate_limit section of the config, or
+    returns None when the section is missing'''
+    rate_config = current_config.get('rate_limit')
+    if not rate_config:
+        return None
+    return RateLimiter(
+        requests_per_minute=rate_config.get('requests_per_minute'),
+        tokens_per_minute=rate_config.get('tokens_per_minute'),
+        max_retries=rate_config.get('max_retries', 5),
+        backoff_base=rate_config.get('backoff_base', 1.0),
+        backoff_max=rate_config.get('backoff_max', 60.0),
+        max_concurrency=current_config.get('execution', {}).get('max_concurrency', 1),
+        min_concurrency=rate_config.get('min_concurrency', 1)
+    )
@@ -0,0 +1,284 @@
+import argparse
+import glob
+import itertools
+import json
+import math
+import os
+import re
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from qa_scoring import score_qa_frame
+
+
+RESULT_NAME_PATTERN = re.compile(r'^(?P<split>[a-z]{2}|unknown_type)_(?P<style>.+)_(?P<task>mcq|qa)_results(?:\.csv)?$')
+SHARD_PATTERN = re.compile(r'_shard\d+of\d+$')
+REPORT_COLUMNS = (
+    'dialog_id', 'turn_index', 'qa_question_index', 'task_type', 'question', 'is_correct',
+    'model_response_full', 'error_type', 'ground_truth_answer', 'prompt_tokens', 'completion_tokens',
+    'total_tokens', 'response_time'
+)
+
+
+def find_result_files(paths):
+    '''result CSV files and parquet result directories under paths (files
+    or directories), as (path, split, style, task type). the style is
+    everything between split and task type, e.g. "cot", "zero-shot" or
+    "cot_prefix". shard files are left out, merge them first'''
+    found = []
+    for path in paths:
+        name = os.path.basename(path.rstrip('/\\'))
+        if os.path.isdir(path) and not RESULT_NAME_PATTERN.match(name):
+            candidates = sorted(glob.glob(os.path.join(path, '*_results*')))
+        else:
+            candidates = [path]
+        for candidate in candidates:
+            match = RESULT_NAME_PATTERN.match(os.path.basename(candidate.rstrip('/\\')))
+            if not match or (os.path.isfile(candidate) and not candidate.endswith('.csv')):
+                continue
+            if SHARD_PATTERN.search(match.group('style')):
+                print(f"Skipping shard file {candidate}, merge the shards with merge_shards.py first.")
+                continue
+            found.append((candidate, match.group('split'), match.group('style'), match.group('task').upper()))
+    return found
+
+
+def _read_results(path):
+    if os.path.isdir(path):
+        from results_store import load_results
+        return load_results(path, with_prompts=False).astype(str).replace({'None': '', 'nan': '', '<NA>': ''})
+    return pd.read_csv(path, dtype=str, keep_default_na=False, usecols=lambda column: column in REPORT_COLUMNS)
+
+
+def load_result_frame(paths):
+    '''one row per scored task of every result file, with the columns the
+    report needs: split, style, task_type, dialog_id, item (MCQ turn or QA
+    question index), is_correct, error, tokens and response_time. QA files
+    without is_correct (as written by a live run) are scored with
+    qa_scoring. a task appearing twice in a file (e.g. an old error row
+    next to its resumed result) keeps its last row'''
+    frames = []
+    for path, split, style, task_type in find_result_files(paths):
+        try:
+            rows = _read_results(path)
+        except (pd.errors.EmptyDataError, OSError, ValueError) as e:
+            print(f"Skipping {path}: {e or 'empty file'}")
+            continue
+        if rows.empty or 'is_correct' not in rows.columns:
+            print(f"Skipping {path}: no result rows.")
+            continue
+        rows = rows[rows['task_type'] == task_type]
+        is_correct = rows['is_correct'].str.lower()
+        if task_type == 'QA' and not is_correct.isin(['true', 'false']).any():
+            is_correct = score_qa_frame(rows)['is_correct']
+        else:
+            is_correct = is_correct == 'true'
+        item = rows['turn_index'] if task_type == 'MCQ' else rows['qa_question_index']
+        frames.append(pd.DataFrame({
+            'split': split, 'style': style, 'task_type': task_type,
+            'dialog_id': rows['dialog_id'].str.replace(r'\.0$', '', regex=True),
+            'item': pd.to_numeric(item, errors='coerce').astype('Int64'),
+            'is_correct': is_correct.astype(bool),
+            'error': rows['error_type'].fillna('').str.strip() != '' if 'error_type' in rows.columns else False,
+            **{column: pd.to_numeric(rows[column], errors='coerce') if column in rows.columns else np.nan
+               for column in ('prompt_tokens', 'completion_tokens', 'total_tokens', 'response_time')}
+        }))
+    if not frames:
+        return pd.DataFrame()
+    frame = pd.concat(frames, ignore_index=True)
+    return frame.drop_duplicates(['split', 'style', 'task_type', 'dialog_id', 'item'], keep='last')
+
+
+def bootstrap_interval(samples, confidence):
+    low, high = np.quantile(samples, [(1 - confidence) / 2, 1 - (1 - confidence) / 2])
+    return [float(low), float(high)]
+
+
+def bootstrap_accuracy(groups, resamples, rng):
+    '''bootstrap distribution of the pooled accuracy of (n, correct) groups,
+    resampled within each group. resampling n binary outcomes with
+    replacement draws the number of correct ones from Binomial(n, correct/n),
+    so each group takes one vectorized binomial draw per resample instead
+    of indexing n rows'''
+    total = sum(n for n, _ in groups)
+    correct = np.zeros(resamples)
+    for n, k in groups:
+        correct += rng.binomial(n, k / n, size=resamples)
+    return correct / total
+
+
+def bootstrap_paired_difference(groups, resamples, rng):
+    '''bootstrap distribution of accuracy(A) - accuracy(B) over paired
+    outcomes, resampled within each group. a group is the counts of pairs
+    (both correct, only A, only B, both wrong), resampled as one multinomial
+    draw per resample'''
+    total = sum(sum(counts) for counts in groups)
+    difference = np.zeros(resamples)
+    for counts in groups:
+        n = sum(counts)
+        draws = rng.multinomial(n, np.array(counts) / n, size=resamples)
+        difference += draws[:, 1] - draws[:, 2]
+    return difference / total
+
+
+def mcnemar_p_value(only_a, only_b):
+    '''two-sided McNemar test on the discordant pairs: exact binomial below
+    25 discordant pairs, chi-square with continuity correction above'''
+    discordant = only_a + only_b
+    if discordant == 0:
+        return 1.0
+    if discordant < 25:
+        tail = sum(math.comb(discordant, i) for i in range(min(only_a, only_b) + 1))
+        return min(1.0, 2 * tail / 2 ** discordant)
+    statistic = (abs(only_a - only_b) - 1) ** 2 / discordant
+    return math.erfc(math.sqrt(statistic / 2))
+
+
+def accuracy_rows(frame, resamples, confidence, rng):
+    '''accuracy with bootstrap interval per split, task type and style, plus
+    an "all" row per task type and style pooling the splits'''
+    rows = []
+    counts = frame.groupby(['task_type', 'style', 'split'])['is_correct'].agg(['size', 'sum'])
+    errors = frame.groupby(['task_type', 'style', 'split'])['error'].sum()
+    for (task_type, style), per_split in counts.groupby(level=[0, 1]):
+        splits = [(split, int(n), int(k)) for (_, _, split), (n, k) in per_split.iterrows()]
+        for split, n, k in splits + [('all', sum(n for _, n, _ in splits), sum(k for _, _, k in splits))]:
+            groups = [(n, k)] if split != 'all' else [(n, k) for _, n, k in splits]
+            rows.append({
+                'split': split, 'task_type': task_type, 'style': style, 'n': n, 'correct': k,
+                'accuracy': k / n if n else None,
+                'ci': bootstrap_interval(bootstrap_accuracy(groups, resamples, rng), confidence) if n else None,
+                'errors': int(errors.loc[task_type, style].sum() if split == 'all' else errors.loc[task_type, style, split])
+            })
+    return rows
+
+
+def paired_rows(frame, resamples, confidence, rng):
+    '''paired comparison of every two styles of a task type on the tasks
+    both answered, aligned by (split, dialog_id, item): accuracies, their
+    difference with bootstrap interval, and McNemar's test. the "all" row
+    pools the splits, resampling within each split'''
+    rows = []
+    outcomes = frame.pivot_table(index=['task_type', 'split', 'dialog_id', 'item'], columns='style', values='is_correct', aggfunc='last')
+    for task_type, by_task in outcomes.groupby(level=0):
+        styles = [style for style in sorted(by_task.columns) if by_task[style].notna().any()]
+        for style_a, style_b in itertools.combinations(styles, 2):
+            pairs = by_task[[style_a, style_b]].dropna().astype(bool)
+            if pairs.empty:
+                continue
+            a, b = pairs[style_a].to_numpy(), pairs[style_b].to_numpy()
+            split_names = pairs.index.get_level_values('split').to_numpy()
+            per_split = {}
+            for split in sorted(set(split_names)):
+                mask = split_names == split
+                per_split[split] = [int(np.sum(a[mask] & b[mask])), int(np.sum(a[mask] & ~b[mask])),
+                                    int(np.sum(~a[mask] & b[mask])), int(np.sum(~a[mask] & ~b[mask]))]
+            pooled = [sum(counts[i] for counts in per_split.values()) for i in range(4)]
+            for split, counts in list(per_split.items()) + [('all', pooled)]:
+                groups = [counts] if split != 'all' else list(per_split.values())
+                n = sum(counts)
+                rows.append({
+                    'split': split, 'task_type': task_type, 'style_a': style_a, 'style_b': style_b, 'n': n,
+                    'accuracy_a': (counts[0] + counts[1]) / n, 'accuracy_b': (counts[0] + counts[2]) / n,
+                    'difference': (counts[1] - counts[2]) / n,
+                    'ci': bootstrap_interval(bootstrap_paired_difference(groups, resamples, rng), confidence),
+                    'only_a_correct': counts[1], 'only_b_correct': counts[2],
+                    'mcnemar_p': mcnemar_p_value(counts[1], counts[2])
+                })
+    return rows
+
+
+def usage_rows(frame):
+    '''mean tokens per task and latency percentiles per split, task type and style'''
+    grouped = frame.groupby(['split', 'task_type', 'style'])
+    summary = grouped.agg(
+        n=('is_correct', 'size'), prompt_tokens=('prompt_tokens', 'mean'), completion_tokens=('completion_tokens', 'mean'),
+        total_tokens=('total_tokens', 'sum'), latency_mean=('response_time', 'mean'),
+        latency_p50=('response_time', 'median'), latency_p95=('response_time', lambda times: times.quantile(0.95))
+    ).reset_index()
+    summary = summary.astype(object).where(summary.notna(), None)
+    return summary.to_dict('records')
+
+
+def build_report(frame, resamples=10000, confidence=0.95, seed=0):
+    '''the report of a result frame from load_result_frame as a dict'''
+    rng = np.random.default_rng(seed)
+    return {
+        'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'resamples': resamples, 'confidence': confidence, 'seed': seed,
+        'accuracy': accuracy_rows(frame, resamples, confidence, rng),
+        'paired': paired_rows(frame, resamples, confidence, rng),
+        'usage': usage_rows(frame)
+    }
+
+
+def _number(value, digits=4):
+    return '' if value is None or (isinstance(value, float) and math.isnan(value)) else f"{value:.{digits}f}"
+
+
+def _p_value(value):
+    return '< 0.0001' if value < 0.0001 else f"{value:.4f}"
+
+
+def report_markdown(report):
+    '''the report as Markdown tables'''
+    level = f"{report['confidence']:.0%}"
+    lines = [f"# Results report", "", f"Created {report['created_at']}, {report['resamples']} bootstrap resamples, {level} intervals.", "",
+             "## Accuracy", "", f"| split | task | style | n | accuracy | {level} CI | errors |", "|---|---|---|---|---|---|---|"]
+    for row in report['accuracy']:
+        interval = f"[{_number(row['ci'][0])}, {_number(row['ci'][1])}]" if row['ci'] else ''
+        lines.append(f"| {row['split']} | {row['task_type']} | {row['style']} | {row['n']} | {_number(row['accuracy'])} | {interval} | {row['errors']} |")
+
+    lines += ["", "## Paired comparisons", "",
+              "Tasks answered under both styles, aligned by split, dialog_id and turn or question index. difference = accuracy A - accuracy B.", "",
+              f"| split | task | A | B | n | acc A | acc B | difference | {level} CI | only A / only B correct | McNemar p |", "|---|---|---|---|---|---|---|---|---|---|---|"]
+    for row in report['paired']:
+        lines.append(f"| {row['split']} | {row['task_type']} | {row['style_a']} | {row['style_b']} | {row['n']} | {_number(row['accuracy_a'])} | "
+                     f"{_number(row['accuracy_b'])} | {_number(row['difference'])} | [{_number(row['ci'][0])}, {_number(row['ci'][1])}] | "
+                     f"{row['only_a_correct']} / {row['only_b_correct']} | {_p_value(row['mcnemar_p'])} |")
+    if not report['paired']:
+        lines.append("| | | | | | | | | | no split has results of two styles | |")
+
+    lines += ["", "## Tokens and latency", "",
+              "| split | task | style | n | prompt tokens | completion tokens | total tokens | latency mean (s) | p50 | p95 |", "|---|---|---|---|---|---|---|---|---|---|"]
+    for row in report['usage']:
+        lines.append(f"| {row['split']} | {row['task_type']} | {row['style']} | {row['n']} | {_number(row['prompt_tokens'], 1)} | "
+                     f"{_number(row['completion_tokens'], 1)} | {_number(row['total_tokens'], 0)} | {_number(row['latency_mean'], 3)} | "
+                     f"{_number(row['latency_p50'], 3)} | {_number(row['latency_p95'], 3)} |")
+    return "\n".join(lines) + "\n"
+
+
+def write_report(paths, output_prefix, resamples=10000, confidence=0.95, seed=0):
+    '''loads the result files under paths and writes {output_prefix}.json
+    and {output_prefix}.md. returns the report, None when there are no
+    results'''
+    frame = load_result_frame(paths)
+    if frame.empty:
+        print(f"No result files found in {', '.join(paths)}.")
+        return None
+    report = build_report(frame, resamples, confidence, seed)
+    with open(output_prefix + '.json', 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    with open(output_prefix + '.md', 'w', encoding='utf-8') as f:
+        f.write(report_markdown(report))
+    print(f"Report of {len(frame)} tasks written to {output_prefix}.json and {output_prefix}.md")
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Compare result files across splits and prompt styles: accuracy with bootstrap intervals, paired McNemar tests, tokens and latency.")
+    parser.add_argument('paths', nargs='*', default=['results'], help='Result directories or files (default: results)')
+    parser.add_argument('--out', '-o', type=str, default=None, help='Output path without extension (default: report in the first directory)')
+    parser.add_argument('--resamples', type=int, default=10000, help='Bootstrap resamples (default: 10000)')
+    parser.add_argument('--confidence', type=float, default=0.95, help='Confidence level of the intervals (default: 0.95)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the bootstrap (default: 0)')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    output_prefix = args.out or os.path.join(args.paths[0] if os.path.isdir(args.paths[0]) else os.path.dirname(args.paths[0]), 'report')
+    if write_report(args.paths, output_prefix, args.resamples, args.confidence, args.seed) is None:
+        sys.exit(1)
+    print(f"Done in {time.perf_counter() - start:.2f}s.")
@@ -0,0 +1,131 @@
+import argparse
+import os
+import sys
+import time
+
+import pandas as pd
+
+from config_loader import load_config
+from data_handler import FINAL_ANSWER_PATTERN, LAST_CHOICE_PATTERN, REASONING_PATTERN
+from prompt_builder import resolve_prompt_style
+
+
+RESCORED_COLUMNS = ('predicted_index', 'predicted_choice', 'is_correct', 'model_reasoning')
+
+
+def reasoning_styles(style_names, config=None):
+    '''the names among style_names whose responses build_result parses for
+    reasoning, resolved through the prompt style registry (and the
+    config's prompt_styles) like resolve_prompt_style'''
+    config = config or {}
+    return {name for name in style_names if name and resolve_prompt_style(config, name).reasoning}
+
+
+def rescore_frame(frame, config=None):
+    '''re-parses model_response_full of MCQ result rows with the same rules as
+    build_result, but column-wise. config supplies the prompt styles
+    registered in a config file. returns a DataFrame with the re-scored
+    predicted_index, predicted_choice, is_correct and model_reasoning'''
+    responses = frame['model_response_full'].fillna('').astype(str)
+    errors = frame['error_type'].fillna('').astype(str)
+    answered = (responses != '') & (errors == '')
+
+    choice = responses.str.extract(FINAL_ANSWER_PATTERN, expand=False)
+    choice = choice.fillna(responses.str.extract(LAST_CHOICE_PATTERN, expand=False))
+    choice = pd.to_numeric(choice).where(answered)
+    parsed = choice.notna()
+
+    correct_index = pd.to_numeric(frame['correct_index'], errors='coerce')
+    predicted_index = (choice - 1).fillna(-1).astype(int)
+    is_correct = parsed & (correct_index != -1) & (predicted_index == correct_index)
+
+    prompt_styles = frame['prompt_style'].fillna('').astype(str)
+    is_cot = prompt_styles.isin(reasoning_styles(prompt_styles.unique(), config))
+    reasoning = responses.str.extract(REASONING_PATTERN, expand=False).str.strip()
+    reasoning = reasoning.where(is_cot)
+    reasoning = reasoning.fillna(("[Parse Error or No Final Answer] Full Response: " + responses).where(is_cot & ~parsed))
+    reasoning = reasoning.fillna(("[Parse Error] Full Response: " + responses).where(~is_cot & ~parsed))
+    reasoning = reasoning.where(answered).fillna('')
+
+    return pd.DataFrame({
+        'predicted_index': predicted_index,
+        'predicted_choice': choice.astype('Int64'),
+        'is_correct': is_correct,
+        'model_reasoning': reasoning
+    }, index=frame.index)
+
+
+def diff_against_stored(frame, rescored):
+    '''boolean columns marking the rows where the re-scored values differ from
+    the stored ones. numbers are compared numerically since older files
+    store them as floats (e.g. "1.0")'''
+    stored_index = pd.to_numeric(frame['predicted_index'], errors='coerce').fillna(-1)
+    stored_choice = pd.to_numeric(frame['predicted_choice'], errors='coerce')
+    new_choice = rescored['predicted_choice'].astype('float')
+    stored_correct = frame['is_correct'].fillna('').astype(str) == 'True'
+    stored_reasoning = frame['model_reasoning'].fillna('').astype(str)
+    return pd.DataFrame({
+        'predicted_index': stored_index != rescored['predicted_index'],
+        'predicted_choice': ~((stored_choice == new_choice) | (stored_choice.isna() & new_choice.isna())),
+        'is_correct': stored_correct != rescored['is_correct'],
+        'model_reasoning': stored_reasoning != rescored['model_reasoning']
+    }, index=frame.index)
+
+
+def rescore_file(csv_path, write=False, config=None):
+    '''re-scores one *_mcq_results.csv. prints a summary of the changes,
+    rewrites the file in place when write is True, and returns the rows
+    whose prediction changed'''
+    all_rows = pd.read_csv(csv_path, dtype=str, keep_default_na=False)
+    frame = all_rows[all_rows['task_type'] == 'MCQ']
+    if frame.empty:
+        print(f"{csv_path}: no MCQ rows.")
+        return pd.DataFrame()
+
+    rescored = rescore_frame(frame, config)
+    changed = diff_against_stored(frame, rescored)
+    old_accuracy = (frame['is_correct'] == 'True').mean()
+    new_accuracy = rescored['is_correct'].mean()
+    print(f"{csv_path}: {len(frame)} rows, {int(changed['predicted_index'].sum())} predictions changed, "
+          f"{int(changed['is_correct'].sum())} correctness changed, {int(changed['model_reasoning'].sum())} reasonings changed, "
+          f"accuracy {old_accuracy:.4f} -> {new_accuracy:.4f}")
+
+    changed_rows = frame.loc[changed['predicted_index'], [column for column in ('task_id', 'dialog_id', 'turn_index', 'correct_index') if column in frame.columns]].copy()
+    changed_rows.insert(0, 'file', os.path.basename(csv_path))
+    changed_rows['old_predicted_index'] = frame.loc[changed['predicted_index'], 'predicted_index']
+    changed_rows['new_predicted_index'] = rescored.loc[changed['predicted_index'], 'predicted_index']
+    changed_rows['model_response_full'] = frame.loc[changed['predicted_index'], 'model_response_full']
+
+    if write and changed.any(axis=None):
+        for column in RESCORED_COLUMNS:
+            all_rows.loc[frame.index, column] = rescored[column].astype(str).replace('<NA>', '')
+        all_rows.to_csv(csv_path + '.tmp', index=False, encoding='utf-8')
+        os.replace(csv_path + '.tmp', csv_path)
+        print(f"  Rewrote {csv_path} with the re-scored values.")
+    return changed_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Re-score MCQ result files offline by re-parsing the stored model responses (no API calls).")
+    parser.add_argument('csv_files', nargs='+', help='MCQ result CSV files, e.g. results/*_mcq_results.csv')
+    parser.add_argument('--write', action='store_true', help='Overwrite predicted_index, predicted_choice, is_correct and model_reasoning in the files with the re-scored values')
+    parser.add_argument('--config', type=str, default=None, help='Config file whose prompt_styles section registered the styles of the results')
+    parser.add_argument('--diff_out', type=str, default=None, help='Optional CSV path for the rows whose prediction changed')
+    args = parser.parse_args()
+
+    config = load_config(args.config) if args.config else None
+    start = time.perf_counter()
+    all_changes = []
+    for csv_path in args.csv_files:
+        try:
+            all_changes.append(rescore_file(csv_path, write=args.write, config=config))
+        except (KeyError, pd.errors.EmptyDataError) as e:
+            print(f"Skipping {csv_path}: {e}")
+    print(f"Re-scored {len(all_changes)} files in {time.perf_counter() - start:.2f}s.")
+
+    if args.diff_out:
+        changes = pd.concat(all_changes, ignore_index=True) if all_changes else pd.DataFrame()
+        changes.to_csv(args.diff_out, index=False, encoding='utf-8')
+        print(f"{len(changes)} changed predictions written to {args.diff_out}")
+    if not all_changes:
+        sys.exit(1)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class CacheMissError(Exception):
+    '''raised by get_model_response in replay mode when a request is not cached'''
+
+
+class ResponseCache:
+    '''disk-backed cache of model responses, keyed by a hash of everything
+    that determines the completion (model, messages, temperature, max_tokens
+    and logit_bias, plus logprobs, top_logprobs, n, stream and
+    stream_grace_tokens when they are used, so the keys of earlier entries
+    stay valid). least recently used entries are evicted once the stored
+    responses grow past max_size_mb. in replay mode the cache is read-only
+    and a miss is reported instead of calling the API'''
+
+    KEY_FIELDS = ('model', 'messages', 'temperature', 'max_tokens', 'logit_bias')
+    OPTIONAL_KEY_FIELDS = ('logprobs', 'top_logprobs', 'n', 'stream', 'stream_grace_tokens')
+
+    def __init__(self, path, max_size_mb=None, replay=False):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        self.replay = replay
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT, response_time REAL, prompt_tokens INTEGER, "
+            "completion_tokens INTEGER, total_tokens INTEGER, size INTEGER, last_access REAL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(responses)")]
+        if 'details' not in columns:
+            self.connection.execute("ALTER TABLE responses ADD COLUMN details TEXT")
+        self.total_bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @classmethod
+    def make_key(cls, api_params):
+        key_data = {field: api_params.get(field) for field in cls.KEY_FIELDS}
+        key_data.update({field: api_params[field] for field in cls.OPTIONAL_KEY_FIELDS if field in api_params})
+        encoded = json.dumps(key_data, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+        return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''returns the cached (response, response_time, prompt_tokens,
+        completion_tokens, total_tokens, details) or None'''
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, response_time, prompt_tokens, completion_tokens, total_tokens, details FROM responses WHERE key = ?",
+                (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if not self.replay:
+                self.connection.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[:5] + (json.loads(row[5]) if row[5] else {},)
+
+    def put(self, key, model_response, response_time, prompt_tokens, completion_tokens, total_tokens, details=None):
+        if self.replay:
+            return
+        # details hold every self-consistency chain and the option
+        # distributions, so they count towards the size limit too
+        details_json = json.dumps(details) if details else None
+        size = len(model_response.encode('utf-8')) + (len(details_json.encode('utf-8')) if details_json else 0)
+        with self.lock:
+            previous = self.connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, response_time, prompt_tokens, completion_tokens, "
+                "total_tokens, size, last_access, details) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model_response, response_time, prompt_tokens, completion_tokens, total_tokens, size, time.time(),
+                 details_json)
+            )
+            self.total_bytes += size - (previous[0] if previous else 0)
+            if self.max_bytes is not None and self.total_bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        '''drops least recently used entries until the cache is back under
+        90% of its size limit, so eviction does not run on every insert'''
+        target = self.max_bytes * 0.9
+        rows = self.connection.execute("SELECT key, size FROM responses ORDER BY last_access").fetchall()
+        evicted = []
+        for key, size in rows:
+            if self.total_bytes <= target:
+                break
+            evicted.append((key,))
+            self.total_bytes -= size
+        self.connection.executemany("DELETE FROM responses WHERE key = ?", evicted)
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        mode = "replay" if self.replay else "read/write"
+        return f"{self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), {self.total_bytes / (1024 * 1024):.1f} MB stored, {mode}"
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def build_response_cache(current_config, replay=False):
+    '''creates a ResponseCache from the cache section of the config, or
+    returns None when caching is not configured. replay=True (from the
+    command line) overrides cache.replay'''
+    cache_config = current_config.get('cache')
+    if not cache_config or not cache_config.get('path'):
+        if replay:
+            raise ValueError("Replay mode needs a cache.path in the configuration file.")
+        return None
+    return ResponseCache(
+        cache_config['path'],
+        max_size_mb=cache_config.get('max_size_mb'),
+        replay=replay or cache_config.get('replay', False)
+    )
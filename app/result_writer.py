@@ -0,0 +1,155 @@
+import csv
+import os
+import sys
+
+from task_journal import TaskJournal
+
+
+RESULT_COLUMNS = [
+    'dialog_id', 'turn_index', 'qa_question_index', 'task_type', 'question',
+    'agent_answer_raw', 'options', 'correct_index', 'predicted_index',
+    'predicted_choice', 'is_correct', 'model_response_full', 'model_reasoning',
+    'response_time', 'prompt_tokens', 'completion_tokens', 'total_tokens',
+    'error_type', 'ground_truth_answer', 'prompt_style', 'full_prompt',
+    'qa_full_prompt', 'task_id', 'cached_tokens', 'time_to_first_token',
+    'time_to_answer', 'stream_stopped_early', 'prob_option_1', 'prob_option_2',
+    'prob_option_3', 'prob_option_4', 'vote_option_1', 'vote_option_2',
+    'vote_option_3', 'vote_option_4', 'batch_size', 'batch_partial'
+]
+
+
+def _read_header(path):
+    with open(path, 'r', newline='', encoding='utf-8') as f:
+        return next(csv.reader(f), None) or RESULT_COLUMNS
+
+
+class ResultWriter:
+    '''streams result rows into the {prefix}_mcq_results.csv and
+    {prefix}_qa_results.csv files as they complete instead of keeping them
+    in memory. every row is flushed to the OS right away and the files are
+    fsynced every fsync_interval rows, so a crash loses at most the requests
+    that were still in flight. with a journal, every written row is also
+    recorded there by task_id'''
+
+    def __init__(self, results_dir, base_prefix, append=False, fsync_interval=100, journal=None):
+        self.paths = {
+            'MCQ': os.path.join(results_dir, f"{base_prefix}_mcq_results.csv"),
+            'QA': os.path.join(results_dir, f"{base_prefix}_qa_results.csv")
+        }
+        self.append = append
+        self.fsync_interval = max(1, fsync_interval)
+        self.files = {}
+        self.writers = {}
+        self.counts = {'MCQ': 0, 'QA': 0}
+        self.rows_since_sync = 0
+        self.journal = journal
+
+    def _open(self, task_type):
+        path = self.paths[task_type]
+        mode = 'a' if self.append else 'w'
+        write_header = mode == 'w' or not os.path.exists(path) or os.path.getsize(path) == 0
+        # appended rows follow the columns of the existing file, so files
+        # written before a column was added stay readable
+        fieldnames = RESULT_COLUMNS if write_header else _read_header(path)
+        handle = open(path, mode, newline='', encoding='utf-8')
+        writer = csv.DictWriter(handle, fieldnames=fieldnames, extrasaction='ignore', lineterminator=os.linesep)
+        if write_header:
+            writer.writeheader()
+        self.files[task_type] = handle
+        self.writers[task_type] = writer
+        return writer
+
+    def write(self, result):
+        task_type = result['task_type']
+        writer = self.writers.get(task_type) or self._open(task_type)
+        writer.writerow(result)
+        self.files[task_type].flush()
+        if self.journal is not None:
+            self.journal.record(result['task_id'], bool(result['error_type']))
+        self.counts[task_type] += 1
+        self.rows_since_sync += 1
+        if self.rows_since_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        for handle in self.files.values():
+            handle.flush()
+            os.fsync(handle.fileno())
+        if self.journal is not None:
+            self.journal.sync()
+        self.rows_since_sync = 0
+
+    def close(self):
+        self.sync()
+        for handle in self.files.values():
+            handle.close()
+        if self.journal is not None:
+            self.journal.close()
+        self.files = {}
+        self.writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def drop_rows_by_task_id(path, task_ids):
+    '''rewrites a result CSV without the rows whose task_id is in task_ids
+    (used on resume to remove failed rows before they are re-run). the file
+    is copied row by row and swapped in atomically. returns the number of
+    rows dropped'''
+    if not task_ids or not os.path.exists(path):
+        return 0
+    csv.field_size_limit(min(sys.maxsize, 2**31 - 1))
+    temp_path = path + '.tmp'
+    dropped = 0
+    with open(path, 'r', newline='', encoding='utf-8') as source, \
+            open(temp_path, 'w', newline='', encoding='utf-8') as target:
+        reader = csv.DictReader(source)
+        writer = csv.DictWriter(target, fieldnames=reader.fieldnames, lineterminator=os.linesep)
+        writer.writeheader()
+        for row in reader:
+            if row.get('task_id') in task_ids:
+                dropped += 1
+                continue
+            writer.writerow(row)
+        target.flush()
+        os.fsync(target.fileno())
+    os.replace(temp_path, path)
+    return dropped
+
+
+def open_result_writer(results_dir, base_prefix, resume=False, append=False, fsync_interval=100, output_config=None):
+    '''creates the result writer and task journal for one output prefix,
+    a ResultWriter for CSV or a ParquetResultWriter when output.format is
+    parquet. when resuming from an existing journal, rows of failed tasks
+    are removed from the result files and the finished task ids are
+    returned so they can be skipped. returns (result_writer, completed_task_ids)'''
+    output_config = output_config or {}
+    use_parquet = output_config.get('format', 'csv').lower() == 'parquet'
+    if use_parquet:
+        from results_store import ParquetResultWriter, drop_parquet_rows_by_task_id
+    journal_path = os.path.join(results_dir, f"{base_prefix}_journal.jsonl")
+    completed_task_ids = set()
+    if resume:
+        if os.path.exists(journal_path):
+            completed_task_ids, failed_task_ids = TaskJournal.load(journal_path)
+            dropped = 0
+            for task_type in ('mcq', 'qa'):
+                if use_parquet:
+                    dropped += drop_parquet_rows_by_task_id(os.path.join(results_dir, f"{base_prefix}_{task_type}_results"), failed_task_ids)
+                else:
+                    dropped += drop_rows_by_task_id(os.path.join(results_dir, f"{base_prefix}_{task_type}_results.csv"), failed_task_ids)
+            print(f"Resuming {base_prefix}: {len(completed_task_ids)} tasks already done, {len(failed_task_ids)} failed tasks re-queued ({dropped} error rows removed).")
+            append = True
+        else:
+            print(f"Warning: No journal found at {journal_path}. Starting {base_prefix} from the beginning.")
+
+    journal = TaskJournal(journal_path, append=append)
+    if use_parquet:
+        result_writer = ParquetResultWriter(results_dir, base_prefix, append=append, batch_rows=output_config.get('parquet_batch_rows', 1000), journal=journal)
+    else:
+        result_writer = ResultWriter(results_dir, base_prefix, append=append, fsync_interval=fsync_interval, journal=journal)
+    return result_writer, completed_task_ids
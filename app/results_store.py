@@ -0,0 +1,275 @@
+import argparse
+import ast
+import glob
+import hashlib
+import os
+import sys
+
+import pandas as pd
+
+from result_writer import RESULT_COLUMNS
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+PROMPT_COLUMNS = ('full_prompt', 'qa_full_prompt')
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The parquet results store needs pyarrow. Install it with 'pip install pyarrow'.")
+
+
+def _column_types():
+    '''arrow types of the stored result columns. prompts are replaced by a
+    prompt_hash referencing the prompts side table, and any result column
+    without an entry here is stored as a string'''
+    types = {
+        'dialog_id': pa.int64(), 'turn_index': pa.int32(), 'qa_question_index': pa.int32(),
+        'task_type': pa.dictionary(pa.int8(), pa.string()), 'options': pa.list_(pa.string()),
+        'correct_index': pa.int8(), 'predicted_index': pa.int8(), 'predicted_choice': pa.int8(),
+        'is_correct': pa.bool_(), 'response_time': pa.float32(), 'prompt_tokens': pa.int32(),
+        'completion_tokens': pa.int32(), 'total_tokens': pa.int32(), 'cached_tokens': pa.int32(),
+        'time_to_first_token': pa.float32(), 'time_to_answer': pa.float32(), 'stream_stopped_early': pa.bool_(),
+        'prob_option_1': pa.float32(), 'prob_option_2': pa.float32(), 'prob_option_3': pa.float32(), 'prob_option_4': pa.float32(),
+        'vote_option_1': pa.int16(), 'vote_option_2': pa.int16(), 'vote_option_3': pa.int16(), 'vote_option_4': pa.int16(),
+        'batch_size': pa.int16(), 'batch_partial': pa.bool_(),
+        'prompt_style': pa.dictionary(pa.int8(), pa.string())
+    }
+    columns = [column for column in RESULT_COLUMNS if column not in PROMPT_COLUMNS]
+    fields = [pa.field(column, types.get(column, pa.string())) for column in columns]
+    fields.append(pa.field('prompt_hash', pa.string()))
+    return pa.schema(fields)
+
+
+def prompt_hash(prompt_text):
+    return hashlib.blake2b(prompt_text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def _parse_options(value):
+    '''options arrive as a list from a run and as its repr from an old CSV'''
+    if isinstance(value, list):
+        return [str(option) for option in value]
+    if isinstance(value, str) and value.startswith('['):
+        return [str(option) for option in ast.literal_eval(value)]
+    return None
+
+
+def _frame_to_tables(frame, seen_hashes):
+    '''converts result rows into a results table and a table of prompts not
+    stored yet (seen_hashes is updated in place)'''
+    frame = frame.copy()
+    prompts = pd.Series([None] * len(frame), index=frame.index, dtype=object)
+    for column in PROMPT_COLUMNS:
+        if column in frame.columns:
+            values = frame[column].where(frame[column].notna() & (frame[column] != ''))
+            prompts = prompts.fillna(values)
+    frame['prompt_hash'] = [prompt_hash(text) if isinstance(text, str) else None for text in prompts]
+
+    new_prompts = {}
+    for hash_value, text in zip(frame['prompt_hash'], prompts):
+        if hash_value is not None and hash_value not in seen_hashes:
+            seen_hashes.add(hash_value)
+            new_prompts[hash_value] = text
+
+    schema = _column_types()
+    if 'options' in frame.columns:
+        frame['options'] = frame['options'].map(_parse_options)
+    arrays = []
+    for field in schema:
+        raw = frame[field.name].tolist() if field.name in frame.columns else [None] * len(frame)
+        values = [None if value is None or (isinstance(value, float) and value != value) or value == '' else value for value in raw]
+        if pa.types.is_integer(field.type):
+            values = [None if value is None else int(float(value)) for value in values]
+        elif pa.types.is_floating(field.type):
+            values = [None if value is None else float(value) for value in values]
+        elif pa.types.is_boolean(field.type):
+            values = [None if value is None else str(value) == 'True' for value in values]
+        elif pa.types.is_string(field.type) or pa.types.is_dictionary(field.type):
+            values = [None if value is None else str(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    results_table = pa.Table.from_arrays(arrays, schema=schema)
+
+    prompts_table = pa.table({
+        'prompt_hash': pa.array(list(new_prompts.keys()), type=pa.string()),
+        'prompt_text': pa.array(list(new_prompts.values()), type=pa.string())
+    })
+    return results_table, prompts_table
+
+
+class _PartDirectory:
+    '''a directory of numbered parquet part files. every part is a complete
+    file, so everything written before a crash stays readable. the
+    directory is only created once a part is written'''
+
+    def __init__(self, path):
+        self.path = path
+        self.next_part = len(glob.glob(os.path.join(path, 'part-*.parquet')))
+
+    def write(self, table):
+        if table.num_rows == 0:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        part_path = os.path.join(self.path, f"part-{self.next_part:05d}.parquet")
+        pq.write_table(table, part_path + '.tmp', compression='zstd')
+        os.replace(part_path + '.tmp', part_path)
+        self.next_part += 1
+
+
+def _existing_prompt_hashes(path):
+    if not glob.glob(os.path.join(path, 'part-*.parquet')):
+        return set()
+    return set(ds.dataset(path, format='parquet').to_table(columns=['prompt_hash'])['prompt_hash'].to_pylist())
+
+
+class ParquetResultWriter:
+    '''same interface as ResultWriter, but buffers rows and writes them as
+    zstd-compressed parquet parts to {prefix}_mcq_results/ and
+    {prefix}_qa_results/, with the prompt texts stored once in
+    {prefix}_prompts/ and referenced by prompt_hash. tasks are only
+    recorded in the journal once their part is on disk, so a crash loses at
+    most the buffered rows and --resume re-runs exactly those'''
+
+    def __init__(self, results_dir, base_prefix, append=False, batch_rows=1000, journal=None):
+        _require_pyarrow()
+        self.paths = {
+            'MCQ': os.path.join(results_dir, f"{base_prefix}_mcq_results"),
+            'QA': os.path.join(results_dir, f"{base_prefix}_qa_results")
+        }
+        prompts_path = os.path.join(results_dir, f"{base_prefix}_prompts")
+        if not append:
+            for path in list(self.paths.values()) + [prompts_path]:
+                for part in glob.glob(os.path.join(path, 'part-*.parquet')):
+                    os.remove(part)
+        self.parts = {task_type: _PartDirectory(path) for task_type, path in self.paths.items()}
+        self.prompt_parts = _PartDirectory(prompts_path)
+        self.seen_hashes = _existing_prompt_hashes(prompts_path)
+        self.batch_rows = max(1, batch_rows)
+        self.buffers = {'MCQ': [], 'QA': []}
+        self.counts = {'MCQ': 0, 'QA': 0}
+        self.journal = journal
+
+    def write(self, result):
+        task_type = result['task_type']
+        self.buffers[task_type].append(result)
+        self.counts[task_type] += 1
+        if len(self.buffers[task_type]) >= self.batch_rows:
+            self._flush(task_type)
+
+    def _flush(self, task_type):
+        rows = self.buffers[task_type]
+        if not rows:
+            return
+        results_table, prompts_table = _frame_to_tables(pd.DataFrame(rows), self.seen_hashes)
+        self.prompt_parts.write(prompts_table)
+        self.parts[task_type].write(results_table)
+        if self.journal is not None:
+            for row in rows:
+                self.journal.record(row['task_id'], bool(row['error_type']))
+            self.journal.sync()
+        self.buffers[task_type] = []
+
+    def sync(self):
+        for task_type in self.buffers:
+            self._flush(task_type)
+
+    def close(self):
+        self.sync()
+        if self.journal is not None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def drop_parquet_rows_by_task_id(path, task_ids):
+    '''rewrites the parts of a parquet results directory that contain any of
+    task_ids without those rows. returns the number of rows dropped'''
+    _require_pyarrow()
+    dropped = 0
+    if not task_ids:
+        return 0
+    for part_path in sorted(glob.glob(os.path.join(path, 'part-*.parquet'))):
+        table = pq.read_table(part_path)
+        keep = pa.array([task_id not in task_ids for task_id in table['task_id'].to_pylist()])
+        removed = table.num_rows - sum(keep.to_pylist())
+        if removed:
+            pq.write_table(table.filter(keep), part_path + '.tmp', compression='zstd')
+            os.replace(part_path + '.tmp', part_path)
+            dropped += removed
+    return dropped
+
+
+def load_results(path, columns=None, filters=None, with_prompts=False):
+    '''reads a parquet results directory (e.g. results/cb_cot_mcq_results)
+    into a DataFrame. columns and filters (e.g. [('is_correct', '=', False)])
+    are pushed down to the parquet reader, so only the needed columns and
+    row groups are read. with_prompts=True joins the prompt texts back in.
+    a store without any parts gives an empty frame with the stored columns'''
+    _require_pyarrow()
+    if with_prompts and columns is not None and 'prompt_hash' not in columns:
+        columns = list(columns) + ['prompt_hash']
+    if glob.glob(os.path.join(path, 'part-*.parquet')):
+        frame = pq.read_table(path, columns=columns, filters=filters).to_pandas()
+    else:
+        schema = _column_types()
+        frame = schema.empty_table().select(columns or schema.names).to_pandas()
+    if with_prompts:
+        prompts_path = path.rstrip('/\\').rsplit('_', 2)[0] + '_prompts'
+        hashes = list(set(frame['prompt_hash'].dropna()))
+        prompts = pq.read_table(prompts_path, filters=[('prompt_hash', 'in', hashes)]).to_pandas() if hashes else pd.DataFrame({'prompt_hash': pd.Series(dtype=object), 'prompt_text': pd.Series(dtype=object)})
+        frame = frame.merge(prompts.drop_duplicates('prompt_hash'), on='prompt_hash', how='left')
+    return frame
+
+
+def import_csv_results(csv_path, output_dir, chunk_rows=5000):
+    '''converts an existing {prefix}_{mcq,qa}_results.csv into the parquet
+    layout in output_dir. the CSV is read in chunks so memory stays flat'''
+    _require_pyarrow()
+    filename = os.path.basename(csv_path)
+    for suffix, task_type in (('_mcq_results.csv', 'MCQ'), ('_qa_results.csv', 'QA')):
+        if filename.endswith(suffix):
+            base_prefix = filename[:-len(suffix)]
+            break
+    else:
+        raise ValueError(f"Cannot tell the prefix and task type of '{filename}', expected *_mcq_results.csv or *_qa_results.csv.")
+
+    results_parts = _PartDirectory(os.path.join(output_dir, f"{base_prefix}_{task_type.lower()}_results"))
+    prompts_path = os.path.join(output_dir, f"{base_prefix}_prompts")
+    prompt_parts = _PartDirectory(prompts_path)
+    seen_hashes = _existing_prompt_hashes(prompts_path)
+    rows = 0
+    for chunk in pd.read_csv(csv_path, dtype=str, keep_default_na=False, chunksize=chunk_rows):
+        results_table, prompts_table = _frame_to_tables(chunk, seen_hashes)
+        prompt_parts.write(prompts_table)
+        results_parts.write(results_table)
+        rows += len(chunk)
+    return base_prefix, task_type, rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Import result CSV files into the parquet results store.")
+    parser.add_argument('csv_files', nargs='+', help='Result CSV files, e.g. results/*_results.csv')
+    parser.add_argument('--output_dir', '-o', type=str, default='results_parquet', help='Directory for the parquet store (default: results_parquet)')
+    args = parser.parse_args()
+
+    try:
+        _require_pyarrow()
+    except ImportError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for csv_path in args.csv_files:
+        try:
+            base_prefix, task_type, rows = import_csv_results(csv_path, args.output_dir)
+            print(f"Imported {rows} {task_type} rows from {csv_path} into {args.output_dir} ({base_prefix}).")
+        except (ValueError, pd.errors.EmptyDataError) as e:
+            print(f"Skipping {csv_path}: {e}")
@@ -0,0 +1,31 @@
+import re
+import zlib
+
+
+def parse_shard(shard_text):
+    '''parses a --shard value such as "2/4" into (2, 4). shards are
+    numbered from 1'''
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', shard_text or '')
+    if not match:
+        raise ValueError(f"Invalid shard '{shard_text}', expected the form i/N (e.g. 1/4).")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or not 1 <= index <= count:
+        raise ValueError(f"Invalid shard '{shard_text}', i must be between 1 and N.")
+    return index, count
+
+
+def shard_of(dialog_id, shard_count):
+    '''1-based shard a dialog belongs to. a CRC32 of the dialog_id is used
+    so the assignment is the same on every machine and Python version, and
+    a dialog (with its history) is never split across shards'''
+    return zlib.crc32(str(dialog_id).encode('utf-8')) % shard_count + 1
+
+
+def select_shard(dialogs_data, shard_index, shard_count):
+    '''returns the dialogs belonging to shard shard_index of shard_count'''
+    return [dialog for dialog in dialogs_data if shard_of(dialog['dialog_id'], shard_count) == shard_index]
+
+
+def shard_suffix(shard_index, shard_count):
+    '''suffix added to the output prefix of a shard, e.g. "_shard2of4"'''
+    return f"_shard{shard_index}of{shard_count}"
@@ -0,0 +1,119 @@
+import copy
+import itertools
+import os
+import re
+
+from tqdm import tqdm
+
+from data_handler import extract_type_code
+from dataset_index import load_index
+from evaluation_processor import iter_dialog_tasks, run_tasks, count_tasks
+from prompt_builder import resolve_prompt_layout, effective_turn_batch
+from result_writer import open_result_writer
+from sharding import parse_shard, shard_suffix
+
+
+def expand_sweep(config):
+    '''expands data.paths (or data.path) x sweep.prompt_styles x sweep.models
+    into one run config per combination. a prompt style entry is either a
+    style name or a mapping of model settings for that style, e.g.
+    {prompt_style: zero-shot, max_tokens: 1, use_logit_bias: true}.
+    returns a list of (base_prefix, run_config)'''
+    data_config = config.get('data', {})
+    data_paths = data_config.get('paths') or ([data_config['path']] if data_config.get('path') else [])
+    sweep_config = config.get('sweep') or {}
+    prompt_styles = sweep_config.get('prompt_styles') or [config['model'].get('prompt_style', 'cot')]
+    models = sweep_config.get('models') or [config['model']['model']]
+
+    runs = []
+    for data_path, style, model in itertools.product(data_paths, prompt_styles, models):
+        model_overrides = {'prompt_style': style} if isinstance(style, str) else dict(style)
+        run_config = copy.deepcopy(config)
+        run_config.pop('sweep', None)
+        run_config['model'].update(model_overrides)
+        run_config['model']['model'] = model
+        run_config['data'] = {'path': data_path}
+
+        type_code = extract_type_code(os.path.basename(data_path))
+        prompt_style = run_config['model'].get('prompt_style', 'cot').lower()
+        base_prefix = f"{type_code}_{prompt_style}"
+        if resolve_prompt_layout(run_config) == 'prefix':
+            base_prefix += "_prefix"
+        if effective_turn_batch(run_config) is not None:
+            base_prefix += "_batch"
+        if len(models) > 1:
+            base_prefix += "_" + re.sub(r'[^A-Za-z0-9.-]+', '-', model)
+        run_config['type_code'] = type_code
+        runs.append((base_prefix, run_config))
+    return runs
+
+
+def run_sweep(config, args, results_dir, backend, rate_limiter=None, response_cache=None, metrics=None):
+    '''runs every combination of the sweep through one shared task stream, so
+    all splits and prompt styles share the worker pool, the rate limiter
+    and the response cache. each combination streams into its own
+    {type}_{style}_{mcq,qa}_results.csv files (with a shard suffix when
+    args.shard is set). returns the number of results written'''
+    runs = expand_sweep(config)
+    shard = parse_shard(args.shard) if args.shard else None
+    if not runs:
+        print("Error: The sweep did not produce any runs. Check data.paths in the configuration file.")
+        return 0
+    print(f"--- Sweep: {len(runs)} runs ---")
+    for base_prefix, run_config in runs:
+        print(f"  {base_prefix}: {run_config['data']['path']} ({run_config['model']['model']})")
+
+    max_concurrency = config.get('execution', {}).get('max_concurrency', 1)
+    save_interval = config.get('save_interval', 100)
+    progress_bar = tqdm(total=0, desc="Processing Sweep", unit="task")
+    result_writers = []
+    written = 0
+
+    def sweep_tasks():
+        loaded_path, dataset, positions = None, None, None
+        for base_prefix, run_config in runs:
+            data_path = run_config['data']['path']
+            if data_path != loaded_path:
+                try:
+                    dataset = load_index(data_path, config.get('data', {}).get('index_dir'))
+                    positions = dataset.select_shard(*shard) if shard else None
+                    loaded_path = data_path
+                except SystemExit:
+                    tqdm.write(f"Skipping {base_prefix}: data file could not be loaded.")
+                    loaded_path, dataset, positions = None, None, None
+                    continue
+
+            if shard:
+                base_prefix += shard_suffix(*shard)
+            result_writer, completed_task_ids = open_result_writer(
+                results_dir, base_prefix, resume=args.resume, fsync_interval=save_interval,
+                output_config=config.get('output')
+            )
+            result_writers.append((base_prefix, result_writer))
+            dialogs_data = dataset.load_dialogs(positions, run_config, completed_task_ids)
+            run_iterations = count_tasks(dialogs_data, run_config)
+            progress_bar.total += run_iterations
+            progress_bar.refresh()
+
+            for task in iter_dialog_tasks(dialogs_data, run_config, 1, run_iterations, progress_bar, completed_task_ids):
+                task['result_writer'] = result_writer
+                yield task
+
+    def on_result(task, result):
+        nonlocal written
+        task['result_writer'].write(result)
+        written += 1
+
+    try:
+        run_tasks(sweep_tasks(), backend, max_concurrency, on_result, rate_limiter, response_cache, metrics)
+    finally:
+        progress_bar.close()
+        for base_prefix, result_writer in result_writers:
+            result_writer.close()
+            print(f"{base_prefix}: {result_writer.counts['MCQ']} MCQ and {result_writer.counts['QA']} QA results written.")
+
+    if rate_limiter is not None:
+        print(f"Rate limiter: {rate_limiter.summary()}")
+    if response_cache is not None:
+        print(f"Response cache: {response_cache.summary()}")
+    return written
@@ -0,0 +1,51 @@
+import json
+import os
+
+
+def make_task_id(type_code, dialog_id, task_type, index, prompt_style):
+    '''stable identifier of a task, independent of where a run started or
+    how max_iterations was set, e.g. "cb:12:mcq:3:cot" or "cb:12:qa:0:cot"'''
+    return f"{type_code}:{dialog_id}:{task_type.lower()}:{index}:{prompt_style}"
+
+
+class TaskJournal:
+    '''append-only record of finished tasks, one JSON line per task with its
+    task_id and whether it ended with an error. the latest line for a task
+    wins, so a task that failed and was retried later counts as done'''
+
+    def __init__(self, path, append=True):
+        self.path = path
+        self.handle = open(path, 'a' if append else 'w', encoding='utf-8')
+
+    @staticmethod
+    def load(path):
+        '''returns (completed_ids, failed_ids) recorded in the journal at path'''
+        statuses = {}
+        if not os.path.exists(path):
+            return set(), set()
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # a line cut off by a crash, the task will simply run again
+                    continue
+                if not isinstance(entry, dict) or 'task_id' not in entry or 'status' not in entry:
+                    # not a journal entry, skipped like an undecodable line
+                    continue
+                statuses[entry['task_id']] = entry['status']
+        completed = {task_id for task_id, status in statuses.items() if status == 'ok'}
+        failed = {task_id for task_id, status in statuses.items() if status == 'error'}
+        return completed, failed
+
+    def record(self, task_id, failed):
+        self.handle.write(json.dumps({'task_id': task_id, 'status': 'error' if failed else 'ok'}) + "\n")
+        self.handle.flush()
+
+    def sync(self):
+        self.handle.flush()
+        os.fsync(self.handle.fileno())
+
+    def close(self):
+        self.sync()
+        self.handle.close()
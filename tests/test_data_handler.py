@@ -0,0 +1,88 @@
+import math
+
+import pytest
+
+from data_handler import option_probabilities, parse_mcq_choice_number, split_batch_response
+
+
+def choices(texts):
+    return {number: parse_mcq_choice_number(text) for number, text in texts.items()}
+
+
+@pytest.mark.parametrize('response', [
+    "Turn 1: 2\nTurn 2: 4\nTurn 3: 1",
+    "Turn 1: 2, Turn 2: 4, Turn 3: 1",
+    "**Turn 1**: 2\n**Turn 2**: 4\n**Turn 3**: 1",
+    "Turn 1 Reasoning: the answer implies 3.\nTurn 1 Final Answer: 2\n"
+    "Turn 2 Reasoning: option 1 fits.\nTurn 2 Final Answer: 4\n"
+    "Turn 3 Reasoning: see above.\nTurn 3 Final Answer: 1",
+    "2\n4\n1",
+])
+def test_split_batch_response_formats(response):
+    assert choices(split_batch_response(response, [1, 2, 3])) == {1: 2, 2: 4, 3: 1}
+
+
+def test_cot_sections_keep_reasoning_and_answer():
+    texts = split_batch_response("Turn 4 Reasoning: she was home.\nTurn 4 Final Answer: 3", [4])
+    assert texts == {4: "Reasoning: she was home.\nFinal Answer: 3"}
+
+
+def test_missing_sections_are_none():
+    texts = split_batch_response("Turn 1: 2\nTurn 3: 1", [1, 2, 3])
+    assert choices(texts) == {1: 2, 2: None, 3: 1}
+    assert split_batch_response("I cannot answer these.", [1, 2]) == {1: None, 2: None}
+
+
+def test_unmarked_responses_need_one_choice_per_turn():
+    assert split_batch_response("2 or maybe 4, then 1", [1, 2]) == {1: None, 2: None}
+
+
+def test_out_of_order_sections():
+    texts = split_batch_response(
+        "Turn 2 Reasoning: b.\nTurn 1 Reasoning: a.\nTurn 1 Final Answer: 3\nTurn 2 Final Answer: 4", [1, 2])
+    assert texts == {1: "Reasoning: a.\nFinal Answer: 3", 2: "Reasoning: b.\nFinal Answer: 4"}
+
+
+def test_sections_of_turns_outside_the_batch_are_ignored():
+    assert choices(split_batch_response("Turn 7: 1\nTurn 8: 2\nTurn 9: 3", [8])) == {8: 2}
+
+
+@pytest.mark.parametrize('response', [
+    "Turn 1: 2\nTurn 2: 4\nTurn 1: 3",
+    "Turn 1 Final Answer: 2\nTurn 2 Final Answer: 4\nTurn 1 Final Answer: 3",
+    "Turn 1 Reasoning: a.\nTurn 1 Final Answer: 2\nTurn 1 Reasoning: on second thought.\nTurn 1 Final Answer: 3\nTurn 2: 4",
+])
+def test_duplicate_sections_keep_the_first_answer(response):
+    assert choices(split_batch_response(response, [1, 2])) == {1: 2, 2: 4}
+
+
+def logprobs(probabilities):
+    return [(token, math.log(probability)) for token, probability in probabilities.items()]
+
+
+def test_option_probabilities_are_read_at_the_final_answer():
+    tokens = [("Reasoning: option 1 is close.", logprobs({"x": 1.0})), ("\nFinal Answer: ", []),
+              ("3", logprobs({"3": 0.6, " 2": 0.2, "2": 0.1, "4": 0.1}))]
+    assert option_probabilities(tokens) == pytest.approx([0.0, 0.3, 0.6, 0.1])
+
+
+def test_option_probabilities_of_a_tie():
+    tokens = [("Final Answer: ", []), ("1", logprobs({"1": 0.4, "4": 0.4, "2": 0.2}))]
+    assert option_probabilities(tokens) == pytest.approx([0.4, 0.2, 0.0, 0.4])
+
+
+def test_option_probabilities_are_normalized_over_the_options():
+    # tokens that are not options 1-4 do not count
+    tokens = [("2", logprobs({"2": 0.3, "5": 0.3, "A": 0.2, "1": 0.1, "2.": 0.1}))]
+    assert option_probabilities(tokens) == pytest.approx([0.25, 0.75, 0.0, 0.0])
+
+
+def test_option_probabilities_without_top_logprobs():
+    assert option_probabilities([("Final Answer: ", []), ("2", [])]) is None
+    assert option_probabilities([("Final Answer: ", []), ("2", logprobs({"B": 0.9, "5": 0.1}))]) is None
+
+
+def test_option_probabilities_of_unparseable_responses():
+    assert option_probabilities([]) is None
+    assert option_probabilities([("I do not know.", logprobs({"I": 1.0}))]) is None
+    assert option_probabilities([("Final Answer: ", []), ("5", logprobs({"5": 0.9, "2": 0.1}))]) is None
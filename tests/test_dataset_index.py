@@ -0,0 +1,96 @@
+import io
+import json
+
+import pytest
+
+import dataset_index
+from dataset_index import _JsonStream, compile_index, file_sha256
+
+
+def mcq(question, answer_index=0):
+    return {'question': question, 'answer': 'svar', 'explict_answer': 'e', 'option': ['a', 'b', 'c', 'd'], 'answer_index': answer_index}
+
+
+DATASET = {
+    'version': 0.1,
+    'data': {
+        'count': 12345678,
+        'dialogs': [
+            {'dialog_id': 0, 'dialog': [mcq('Var lämnade du gurkan?'), mcq('Är det där ditt kök? 🥒', 2)],
+             'question': [{'question': 'Var är gurkan?', 'answer': 'i köket'}]},
+            {'dialog_id': 1, 'dialog': [mcq('日本語の質問'), {'note': 'not a task'}], 'question': []},
+            {'dialog_id': 1234567, 'dialog': [], 'question': [{'question': 'ø' * 50, 'answer': '€'}]},
+        ],
+    },
+}
+
+
+@pytest.fixture(params=[1, 2, 3, 7, 64])
+def read_size(request, monkeypatch):
+    monkeypatch.setattr(dataset_index, 'READ_SIZE', request.param)
+    return request.param
+
+
+@pytest.fixture
+def data_path(tmp_path):
+    path = tmp_path / 'impl_dial_v0.1_cb.json'
+    # indented, so values and multibyte characters fall on every chunk boundary
+    path.write_text(json.dumps(DATASET, ensure_ascii=False, indent=1), encoding='utf-8')
+    return str(path)
+
+
+def test_byte_ranges_hold_each_dialog(read_size, data_path):
+    index = compile_index(data_path)
+    with open(data_path, 'rb') as f:
+        raw = f.read()
+    dialogs = json.loads(raw)['data']['dialogs']
+    assert [entry[0] for entry in index.dialogs] == [0, 1, 1234567]
+    for entry, dialog in zip(index.dialogs, dialogs):
+        _, offset, length, _, _ = entry
+        assert json.loads(raw[offset:offset + length].decode('utf-8')) == dialog
+    assert [entry[3:] for entry in index.dialogs] == [['MM', 'Q'], ['MU', ''], ['', 'Q']]
+    assert index.sha256 == file_sha256(data_path)
+
+
+def test_load_dialogs_matches_json_load(read_size, data_path):
+    with open(data_path, 'r', encoding='utf-8') as f:
+        expected = json.load(f)['data']['dialogs']
+    index = compile_index(data_path)
+    assert index.load_dialogs() == expected
+    assert index.load_dialogs([2, 0]) == [expected[2], expected[0]]
+
+
+def test_multibyte_characters_split_across_chunks(read_size):
+    text = '["å", "🥒", "€€"]'
+    stream = _JsonStream(io.BytesIO(text.encode('utf-8')))
+    stream.expect('[')
+    values, offsets = [], []
+    while True:
+        stream.peek()
+        offsets.append(stream.offset())
+        values.append(stream.value())
+        if stream.expect(',]') == ']':
+            break
+    assert values == ['å', '🥒', '€€']
+    assert offsets == [len(text[:text.index(value) - 1].encode('utf-8')) for value in values]
+
+
+def test_number_split_at_a_chunk_boundary(read_size):
+    stream = _JsonStream(io.BytesIO(b'{"a": 1234567, "b": -0.125e3, "c": 98}'))
+    assert stream.find_key('b')
+    assert stream.value() == -125.0
+    assert stream.expect(',') == ','
+    assert stream.value() == 'c'
+    stream.expect(':')
+    assert stream.value() == 98
+    # a number that ends the file is not re-read forever
+    assert _JsonStream(io.BytesIO(b'  31415926')).value() == 31415926
+
+
+def test_truncated_file_is_an_error(read_size):
+    stream = _JsonStream(io.BytesIO(b'[123, {"a": '))
+    stream.expect('[')
+    assert stream.value() == 123
+    stream.expect(',')
+    with pytest.raises(json.JSONDecodeError):
+        stream.value()
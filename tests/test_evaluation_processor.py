@@ -0,0 +1,167 @@
+import asyncio
+import re
+
+from backends import LocalBackend
+from evaluation_processor import build_batch_results, build_result, dispatch_tasks_async, majority_vote
+
+
+CONFIG = {'model': {'model': 'local', 'temperature': 0.0, 'prompt_style': 'zero-shot'}}
+TASK_PATTERN = re.compile(r'Task (\d+)\b')
+
+
+class DelayedBackend(LocalBackend):
+    '''LocalBackend that takes delays[i] seconds to answer task i and records
+    the order in which requests start and finish'''
+
+    def __init__(self, delays):
+        self.delays = delays
+        self.events = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def create_async(self, **params):
+        number = int(TASK_PATTERN.search(params['messages'][0]['content']).group(1))
+        self.events.append(('start', number))
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delays.get(number, 0.0))
+            return await super().create_async(**params)
+        finally:
+            self.in_flight -= 1
+            self.events.append(('finish', number))
+
+
+def make_task(number, dialog_id=0, layout='suffix'):
+    prompt_text = f"Task {number}\nOptions:\n1. a\n2. b\n3. c\n4. d"
+    return {
+        'iteration': number + 1, 'task_id': f"t{number}", 'dialog_id': dialog_id, 'turn_index': number,
+        'qa_question_index': None, 'task_type': 'MCQ', 'question': 'q', 'agent_answer_raw': 'a',
+        'options': ['a', 'b', 'c', 'd'], 'correct_index': 0, 'ground_truth_answer': None,
+        'prompt_style': 'zero-shot', 'parse_reasoning': False, 'prompt_layout': layout,
+        'prompt_text': prompt_text, 'messages': [{"role": "user", "content": prompt_text}], 'config': CONFIG
+    }
+
+
+def dispatch(tasks, backend, max_concurrency):
+    released = []
+    asyncio.run(dispatch_tasks_async(tasks, backend, max_concurrency, lambda task, result: released.append(task['task_id'])))
+    return released
+
+
+def test_results_are_released_in_task_order():
+    # later tasks finish first
+    backend = DelayedBackend({number: 0.01 * (8 - number) for number in range(8)})
+    released = dispatch([make_task(number) for number in range(8)], backend, max_concurrency=4)
+    assert released == [f"t{number}" for number in range(8)]
+    finished = [number for event, number in backend.events if event == 'finish']
+    assert finished != sorted(finished)
+    assert backend.max_in_flight == 4
+
+
+def test_reorder_window_caps_tasks_pulled_ahead_of_a_slow_one():
+    max_concurrency = 2
+    pulled = []
+    pulled_at_release = []
+
+    def tasks():
+        for number in range(40):
+            pulled.append(number)
+            yield make_task(number)
+
+    def on_result(task, result):
+        pulled_at_release.append(len(pulled))
+
+    backend = DelayedBackend({0: 0.2})
+    asyncio.run(dispatch_tasks_async(tasks(), backend, max_concurrency, on_result))
+    # while task 0 is in flight the window fills up to max_concurrency * 4
+    # tasks and then no further task is pulled
+    assert pulled_at_release[0] == max_concurrency * 4
+    assert all(count - released <= max_concurrency * 4 for released, count in enumerate(pulled_at_release))
+    assert len(pulled_at_release) == 40
+
+
+def test_prefix_layout_chains_the_turns_of_a_dialog():
+    tasks = [make_task(dialog * 10 + turn, dialog_id=dialog, layout='prefix') for dialog in range(3) for turn in range(4)]
+    backend = DelayedBackend({number: 0.005 for number in range(40)})
+    released = dispatch(tasks, backend, max_concurrency=4)
+    assert released == [task['task_id'] for task in tasks]
+    for dialog in range(3):
+        turns = [number for event, number in backend.events if event == 'start' and number // 10 == dialog]
+        assert turns == sorted(turns)
+        # a turn starts only after the previous turn of its dialog finished
+        for previous, turn in zip(turns, turns[1:]):
+            assert backend.events.index(('finish', previous)) < backend.events.index(('start', turn))
+    # the dialogs still run concurrently
+    assert backend.max_in_flight > 1
+
+
+def make_batch_task(numbers):
+    turns = [dict(make_task(number), history_position=number - 1, correct_index=1) for number in numbers]
+    return {'task_type': 'MCQ_BATCH', 'batch': turns, 'task_id': turns[0]['task_id'], 'dialog_id': 0}
+
+
+def test_batch_results_score_every_turn_and_share_the_tokens():
+    task = make_batch_task([1, 2, 3])
+    details = {'cached_tokens': 10}
+    results = build_batch_results(task, ("Turn 1: 2\nTurn 2: 4\nTurn 3: 2", 0.5, 100, 11, 111, None, details))
+    assert [result['predicted_choice'] for result in results] == [2, 4, 2]
+    assert [result['is_correct'] for result in results] == [True, False, True]
+    assert sum(result['prompt_tokens'] for result in results) == 100
+    assert sum(result['completion_tokens'] for result in results) == 11
+    assert sum(result['cached_tokens'] for result in results) == 10
+    assert all(result['response_time'] == 0.5 and result['batch_size'] == 3 for result in results)
+    assert not any(result['batch_partial'] for result in results)
+
+
+def test_batch_results_flag_missing_turns():
+    task = make_batch_task([1, 2, 3])
+    results = build_batch_results(task, ("Turn 3: 1\nTurn 1: 2", 0.5, 90, 9, 99, None, {}))
+    assert [result['predicted_choice'] for result in results] == [2, None, 1]
+    assert results[1]['predicted_index'] == -1
+    assert results[1]['model_reasoning'].startswith("[Parse Error: no answer for turn 2]")
+    assert all(result['batch_partial'] for result in results)
+
+
+def test_batch_results_of_a_duplicate_section_use_its_first_answer():
+    task = make_batch_task([1, 2])
+    results = build_batch_results(task, ("Turn 1: 2\nTurn 2: 3\nTurn 1: 4", 0.5, 10, 3, 13, None, {}))
+    assert [result['predicted_choice'] for result in results] == [2, 3]
+    assert not any(result['batch_partial'] for result in results)
+
+
+def test_batch_results_of_a_failed_request():
+    task = make_batch_task([1, 2])
+    results = build_batch_results(task, (None, 0, 0, 0, 0, "API Error: timeout", {}))
+    assert [result['error_type'] for result in results] == ["API Error: timeout"] * 2
+    assert [result['predicted_index'] for result in results] == [-1, -1]
+
+
+def test_majority_vote_counts_the_parsed_choices():
+    chains = ["Final Answer: 2", "Final Answer: 3", "I think 3", "Final Answer: 2 or 3?", "Final Answer: 3"]
+    assert majority_vote(chains) == ([0, 2, 3, 0], "Final Answer: 3")
+
+
+def test_majority_vote_tie_goes_to_the_option_voted_for_first():
+    assert majority_vote(["Final Answer: 4", "Final Answer: 1", "Final Answer: 1", "Final Answer: 4"]) == ([2, 0, 0, 2], "Final Answer: 4")
+
+
+def test_majority_vote_ignores_choices_outside_1_to_4():
+    chains = ["Final Answer: 5", "Final Answer: 0", "Option B", "Final Answer: 1"]
+    assert majority_vote(chains) == ([1, 0, 0, 0], "Final Answer: 1")
+
+
+def test_majority_vote_of_unparseable_samples():
+    chains = ["I am not sure.", "Final Answer: 7"]
+    assert majority_vote(chains) == ([0, 0, 0, 0], "I am not sure.")
+
+
+def test_self_consistency_result_row():
+    task = make_task(0)
+    details = {'samples': ["Final Answer: 2", "Final Answer: 1", "Final Answer: 1"]}
+    result = build_result(task, ("Final Answer: 2", 1.0, 30, 9, 39, None, details))
+    assert result['predicted_choice'] == 1 and result['is_correct']
+    assert [result[f"vote_option_{option}"] for option in range(1, 5)] == [2, 1, 0, 0]
+    unparsed = build_result(task, ("no idea", 1.0, 30, 9, 39, None, {'samples': ["no idea", "pass"]}))
+    assert unparsed['predicted_index'] == -1 and unparsed['model_reasoning'].startswith("[Parse Error]")
+    assert [unparsed[f"vote_option_{option}"] for option in range(1, 5)] == [0, 0, 0, 0]
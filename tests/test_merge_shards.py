@@ -0,0 +1,78 @@
+import pandas as pd
+import pytest
+
+from merge_shards import merge_shards
+from result_writer import ResultWriter
+
+
+def mcq_row(dialog_id, turn_index, choice, error=''):
+    return {
+        'dialog_id': dialog_id, 'turn_index': turn_index, 'task_type': 'MCQ', 'question': f"q{dialog_id}.{turn_index}",
+        'agent_answer_raw': 'a', 'options': ['o1', 'o2', 'o3', 'o4'], 'correct_index': 0,
+        'predicted_index': choice - 1 if not error else -1, 'predicted_choice': choice if not error else None,
+        'is_correct': choice == 1 and not error, 'model_response_full': '' if error else str(choice),
+        'error_type': error, 'prompt_style': 'zero-shot', 'full_prompt': f"prompt {dialog_id}.{turn_index}",
+        'task_id': f"cb:{dialog_id}:mcq:{turn_index}:zero-shot", 'response_time': 0.5
+    }
+
+
+def qa_row(dialog_id):
+    return {
+        'dialog_id': dialog_id, 'qa_question_index': 0, 'task_type': 'QA', 'question': 'where?',
+        'model_response_full': 'kitchen', 'error_type': '', 'ground_truth_answer': 'kitchen', 'prompt_style': 'qa',
+        'qa_full_prompt': f"qa prompt {dialog_id}", 'task_id': f"cb:{dialog_id}:qa:0:zero-shot"
+    }
+
+
+SHARDS = {
+    1: [mcq_row(2, 0, 1), mcq_row(2, 1, 3), mcq_row(0, 0, 2), qa_row(2)],
+    # a retried task: the row without an error wins
+    2: [mcq_row(1, 0, 4), mcq_row(0, 0, 2, error='API Error: timeout'), qa_row(1)],
+}
+
+
+def write_shards(results_dir, writer_class):
+    for shard_index, rows in SHARDS.items():
+        with writer_class(str(results_dir), f"cb_zero-shot_shard{shard_index}of2") as writer:
+            for row in rows:
+                writer.write(row)
+
+
+def test_merge_csv_shards(tmp_path):
+    write_shards(tmp_path, ResultWriter)
+    merge_shards(str(tmp_path), 'cb_zero-shot')
+    mcq = pd.read_csv(tmp_path / 'cb_zero-shot_mcq_results.csv', dtype=str, keep_default_na=False)
+    assert mcq['task_id'].tolist() == [f"cb:{dialog}:mcq:{turn}:zero-shot" for dialog, turn in ((0, 0), (1, 0), (2, 0), (2, 1))]
+    assert (mcq['error_type'] == '').all()
+    qa = pd.read_csv(tmp_path / 'cb_zero-shot_qa_results.csv', dtype=str, keep_default_na=False)
+    assert qa['dialog_id'].tolist() == ['1', '2']
+
+
+def test_merge_parquet_shards(tmp_path):
+    pytest.importorskip('pyarrow')
+    from results_store import ParquetResultWriter, load_results
+
+    write_shards(tmp_path, ParquetResultWriter)
+    merge_shards(str(tmp_path), 'cb_zero-shot')
+    mcq = load_results(str(tmp_path / 'cb_zero-shot_mcq_results'), with_prompts=True)
+    assert mcq['task_id'].tolist() == [f"cb:{dialog}:mcq:{turn}:zero-shot" for dialog, turn in ((0, 0), (1, 0), (2, 0), (2, 1))]
+    assert mcq['error_type'].isna().all()
+    assert mcq['predicted_choice'].tolist() == [2, 4, 1, 3]
+    assert mcq['is_correct'].tolist() == [False, False, True, False]
+    assert mcq['options'].map(list).tolist() == [['o1', 'o2', 'o3', 'o4']] * 4
+    assert mcq['prompt_text'].tolist() == ['prompt 0.0', 'prompt 1.0', 'prompt 2.0', 'prompt 2.1']
+    qa = load_results(str(tmp_path / 'cb_zero-shot_qa_results'), with_prompts=True)
+    assert qa['dialog_id'].tolist() == [1, 2]
+    assert qa['prompt_text'].tolist() == ['qa prompt 1', 'qa prompt 2']
+
+
+def test_mixed_shard_formats_are_rejected(tmp_path):
+    pytest.importorskip('pyarrow')
+    from results_store import ParquetResultWriter
+
+    with ResultWriter(str(tmp_path), 'cb_zero-shot_shard1of2') as writer:
+        writer.write(mcq_row(0, 0, 1))
+    with ParquetResultWriter(str(tmp_path), 'cb_zero-shot_shard2of2') as writer:
+        writer.write(mcq_row(1, 0, 1))
+    with pytest.raises(ValueError, match='both as CSV and as parquet'):
+        merge_shards(str(tmp_path), 'cb_zero-shot')
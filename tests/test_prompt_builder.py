@@ -0,0 +1,23 @@
+import prompt_builder
+from prompt_builder import PROMPT_STYLES, resolve_prompt_style
+
+
+CONFIG_STYLES = {'short-cot': {'base': 'cot', 'mcq': "{history}{question}{answer}{options} Answer briefly."}}
+
+
+def test_config_styles_are_compiled_once_per_config(monkeypatch):
+    calls = []
+    build = prompt_builder.build_config_styles
+    monkeypatch.setattr(prompt_builder, 'build_config_styles', lambda config: calls.append(1) or build(config))
+    config = {'model': {'prompt_style': 'short-cot'}, 'prompt_styles': CONFIG_STYLES}
+    styles = [resolve_prompt_style(config) for _ in range(5)]
+    assert len(calls) == 1
+    assert all(style is styles[0] for style in styles)
+    assert styles[0].reasoning and styles[0].mcq.text.endswith("Answer briefly.")
+
+
+def test_lookup_by_name_falls_back_to_registered_styles():
+    config = {'prompt_styles': CONFIG_STYLES}
+    assert resolve_prompt_style(config, 'zero-shot') is PROMPT_STYLES['zero-shot']
+    assert resolve_prompt_style(config, 'Short-CoT').name == 'short-cot'
+    assert resolve_prompt_style(config, 'missing') is PROMPT_STYLES['cot']
@@ -0,0 +1,138 @@
+import sys
+from types import SimpleNamespace
+
+import openai
+import pytest
+from openai import DEFAULT_CONNECTION_LIMITS
+
+import rate_limiter
+from rate_limiter import RateLimiter, TokenBucket
+
+# the HTTP library the installed openai package is built on
+http = sys.modules[type(DEFAULT_CONNECTION_LIMITS).__module__.split('.')[0]]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rate_limiter.time, 'monotonic', clock)
+    return clock
+
+
+def status_error(error_class, status_code, headers=None):
+    request = http.Request('POST', 'http://localhost/v1/chat/completions')
+    response = http.Response(status_code, headers=headers or {}, request=request)
+    return error_class(f"status {status_code}", response=response, body=None)
+
+
+def rate_limit_error(headers=None):
+    return status_error(openai.RateLimitError, 429, headers)
+
+
+def server_error():
+    return status_error(openai.InternalServerError, 500)
+
+
+def timeout_error():
+    return openai.APITimeoutError(request=http.Request('POST', 'http://localhost/v1/chat/completions'))
+
+
+def test_token_bucket_reserve_waits_for_the_refill(clock):
+    bucket = TokenBucket(60)
+    assert bucket.reserve(60) == 0.0
+    # one token per second: 30 tokens are 30 seconds away
+    assert bucket.reserve(30) == pytest.approx(30.0)
+    clock.now += 10
+    assert bucket.reserve(0) == pytest.approx(20.0)
+
+
+def test_token_bucket_caps_a_reservation_at_its_capacity(clock):
+    bucket = TokenBucket(60)
+    assert bucket.reserve(1000) == 0.0
+    assert bucket.tokens == 0
+
+
+def test_token_bucket_refund_is_capped_at_capacity(clock):
+    bucket = TokenBucket(60)
+    bucket.reserve(50)
+    bucket.refund(40)
+    assert bucket.tokens == pytest.approx(50)
+    bucket.refund(1000)
+    assert bucket.tokens == 60
+    # a negative refund charges tokens the estimate missed
+    bucket.refund(-90)
+    assert bucket.reserve(0) == pytest.approx(30.0)
+
+
+def test_on_success_settles_the_estimate_against_the_usage(clock):
+    limiter = RateLimiter(tokens_per_minute=1000)
+    limiter.reserve(300)
+    limiter.on_success(300, SimpleNamespace(total_tokens=100))
+    assert limiter.token_bucket.tokens == pytest.approx(900)
+
+
+@pytest.mark.parametrize('make_error', [rate_limit_error, server_error, timeout_error, lambda: ValueError("bad request")])
+def test_on_error_refunds_the_reserved_tokens(clock, make_error):
+    limiter = RateLimiter(tokens_per_minute=1000)
+    limiter.reserve(400)
+    limiter.on_error(make_error(), 0, 400)
+    assert limiter.token_bucket.tokens == pytest.approx(1000)
+
+
+def test_rate_limit_errors_halve_the_concurrency_limit(clock):
+    limiter = RateLimiter(max_concurrency=8, min_concurrency=2)
+    for expected in (4, 2, 2):
+        limiter.on_error(rate_limit_error(), 0, 0)
+        assert limiter.concurrency_limit == expected
+    assert limiter.rate_limited == 3
+    # other errors leave the limit alone
+    limiter.on_error(server_error(), 0, 0)
+    assert limiter.concurrency_limit == 2
+
+
+def test_successes_raise_the_concurrency_limit_additively(clock):
+    limiter = RateLimiter(max_concurrency=4)
+    limiter.concurrency_limit = 2.0
+    limiter.on_success(0, None)
+    limiter.on_success(0, None)
+    # 1/limit per success: about one slot per limit's worth of successes
+    assert limiter.concurrency_limit == pytest.approx(2.0 + 1 / 2.0 + 1 / 2.5)
+    for _ in range(20):
+        limiter.on_success(0, None)
+    assert limiter.concurrency_limit == 4
+
+
+def test_backoff_doubles_per_attempt_up_to_the_maximum(clock, monkeypatch):
+    monkeypatch.setattr(rate_limiter.random, 'uniform', lambda low, high: high)
+    limiter = RateLimiter(max_retries=10, backoff_base=1.0, backoff_max=5.0)
+    delays = [limiter.on_error(server_error(), attempt, 0) for attempt in range(5)]
+    assert delays == [1.0, 2.0, 4.0, 5.0, 5.0]
+    assert limiter.retries == 5
+
+
+def test_backoff_is_jittered_between_half_and_full_delay(clock):
+    limiter = RateLimiter(max_retries=10, backoff_base=1.0)
+    delays = [limiter.on_error(timeout_error(), 3, 0) for _ in range(50)]
+    assert all(4.0 <= delay <= 8.0 for delay in delays)
+
+
+def test_retry_after_sets_a_minimum_delay_and_blocks_new_requests(clock):
+    limiter = RateLimiter(requests_per_minute=600, backoff_base=0.01)
+    delay = limiter.on_error(rate_limit_error({'retry-after-ms': '2500'}), 0, 0)
+    assert delay == pytest.approx(2.5)
+    assert limiter.reserve(0) == pytest.approx(2.5)
+
+
+def test_no_retry_after_the_last_attempt_or_for_permanent_errors(clock):
+    limiter = RateLimiter(max_retries=2)
+    assert limiter.on_error(server_error(), 2, 0) is None
+    assert limiter.on_error(status_error(openai.BadRequestError, 400), 0, 0) is None
+    assert limiter.retries == 0
@@ -0,0 +1,44 @@
+import os
+
+import pandas as pd
+import pytest
+
+pytest.importorskip('pyarrow')
+
+from results_store import import_csv_results, load_results
+
+
+def test_import_of_an_empty_csv_leaves_no_directories(tmp_path):
+    csv_path = tmp_path / 'cb_cot_mcq_results.csv'
+    csv_path.write_text('\r\n')
+    output_dir = tmp_path / 'store'
+    output_dir.mkdir()
+    with pytest.raises(pd.errors.EmptyDataError):
+        import_csv_results(str(csv_path), str(output_dir))
+    assert os.listdir(output_dir) == []
+
+
+def test_load_results_of_an_empty_store(tmp_path):
+    path = str(tmp_path / 'cb_cot_mcq_results')
+    frame = load_results(path, with_prompts=True)
+    assert frame.empty
+    assert {'task_id', 'is_correct', 'prompt_hash', 'prompt_text'} <= set(frame.columns)
+    frame = load_results(path, columns=['task_id', 'is_correct'])
+    assert list(frame.columns) == ['task_id', 'is_correct']
+
+
+def test_imported_csv_loads_back_with_prompts(tmp_path):
+    csv_path = tmp_path / 'cb_cot_mcq_results.csv'
+    pd.DataFrame([
+        {'dialog_id': 1, 'turn_index': 0, 'task_type': 'MCQ', 'options': "['a', 'b']", 'is_correct': 'True',
+         'full_prompt': 'prompt one', 'task_id': 'cb:1:mcq:0:cot'},
+        {'dialog_id': 1, 'turn_index': 1, 'task_type': 'MCQ', 'options': "['a', 'b']", 'is_correct': 'False',
+         'full_prompt': 'prompt one', 'task_id': 'cb:1:mcq:1:cot'},
+    ]).to_csv(csv_path, index=False)
+    output_dir = tmp_path / 'store'
+    assert import_csv_results(str(csv_path), str(output_dir)) == ('cb_cot', 'MCQ', 2)
+    frame = load_results(str(output_dir / 'cb_cot_mcq_results'), with_prompts=True)
+    assert frame['is_correct'].tolist() == [True, False]
+    assert frame['options'].map(list).tolist() == [['a', 'b'], ['a', 'b']]
+    assert frame['prompt_text'].tolist() == ['prompt one', 'prompt one']
+    assert len(load_results(str(output_dir / 'cb_cot_prompts'))) == 1
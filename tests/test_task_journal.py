@@ -0,0 +1,27 @@
+from task_journal import TaskJournal
+
+
+def test_load_skips_malformed_entries(tmp_path):
+    path = tmp_path / 'run.journal'
+    path.write_text('\n'.join([
+        '{"task_id": "cb:1:mcq:0:cot", "status": "ok"}',
+        '{"task_id": "cb:1:mcq:1:cot", "status": "error"}',
+        '{"status": "ok"}',
+        '{"task_id": "cb:1:mcq:2:cot"}',
+        '["cb:1:mcq:3:cot", "ok"]',
+        '42',
+        '{"task_id": "cb:1:mcq:1:cot", "status": "ok"}',
+        '{"task_id": "cb:1:qa:0:cot", "sta',
+    ]), encoding='utf-8')
+    completed, failed = TaskJournal.load(str(path))
+    assert completed == {'cb:1:mcq:0:cot', 'cb:1:mcq:1:cot'}
+    assert failed == set()
+
+
+def test_recorded_tasks_load_back(tmp_path):
+    path = str(tmp_path / 'run.journal')
+    journal = TaskJournal(path)
+    journal.record('cb:1:mcq:0:cot', failed=False)
+    journal.record('cb:1:qa:0:cot', failed=True)
+    journal.close()
+    assert TaskJournal.load(path) == ({'cb:1:mcq:0:cot'}, {'cb:1:qa:0:cot'})